@@ -0,0 +1,222 @@
+from gitindex import ReachabilityIndex
+from patchmodel import PatchBuffer
+
+import asyncio
+import atexit
+import enum
+import logging
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger('rom.asyncreviewer')
+
+class CallType(enum.Enum):
+  CHECK_OUTPUT = 0
+  CHECK_CALL = 1
+  CALL = 2
+
+
+class GitLoop(object):
+  # One event loop in a background thread, shared by every reviewer in the
+  # daemon. All git work is awaited on it, so the per-repository limits below
+  # hold no matter which thread asked for the work.
+  loop = None
+  thread = None
+  lock = threading.Lock()
+  # Per-repository git process limits, tied to the loop which made them
+  semaphores = {}
+
+  @classmethod
+  def get(cls):
+    with cls.lock:
+      if not cls.loop:
+        cls.loop = asyncio.new_event_loop()
+        cls.thread = threading.Thread(target=cls.loop.run_forever,
+                                      daemon=True, name='rom-git-loop')
+        cls.thread.start()
+      return cls.loop
+
+  @classmethod
+  def submit(cls, coro):
+    # Returns a concurrent.futures.Future, for callers on other loops or threads
+    return asyncio.run_coroutine_threadsafe(coro, cls.get())
+
+  @classmethod
+  def run(cls, coro):
+    # Blocks until coro is done, which can never happen on the loop itself
+    if threading.current_thread() is cls.thread:
+      coro.close()
+      raise RuntimeError('Blocking on the git loop from the git loop')
+    return cls.submit(coro).result()
+
+  @classmethod
+  def shutdown(cls):
+    with cls.lock:
+      if not cls.loop:
+        return
+      cls.loop.call_soon_threadsafe(cls.loop.stop)
+      cls.thread.join(timeout=5)
+      cls.loop = None
+      cls.thread = None
+      cls.semaphores = {}
+
+atexit.register(GitLoop.shutdown)
+
+
+class AsyncReviewer(object):
+  # The git side of a Reviewer. Every coroutine here runs on GitLoop, and
+  # Reviewer's blocking git(), fetch_remote(s) and get_commit_from_sha() just
+  # wait on them, so sync and async callers share one set of limits.
+
+  # Default number of git processes allowed to run at once in one repository
+  MAX_GIT_PROCS = 4
+
+  def __init__(self, git_dir=None, fetches=None, git_stats=None,
+               commit_lookup=None, max_git_procs=None):
+    self.git_dir = git_dir
+    if git_dir:
+      self.git_cmd = ['git', '-C', git_dir ]
+    else:
+      self.git_cmd = ['git']
+    self.fetches = fetches
+    self.git_stats = git_stats
+    # Answers commit lookups without forking (patch cache, object store), it
+    # blocks so it's run off the loop
+    self.commit_lookup = commit_lookup
+    self.max_git_procs = max_git_procs or self.MAX_GIT_PROCS
+
+  def semaphore(self):
+    # Only ever called on the loop, so no locking needed
+    sem = GitLoop.semaphores.get(self.git_dir)
+    if not sem:
+      sem = asyncio.Semaphore(self.max_git_procs)
+      GitLoop.semaphores[self.git_dir] = sem
+    return sem
+
+  async def run_sync(self, func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+  async def git(self, cmd, call_type, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL, skip_err=False, input=None,
+                raw=False):
+    if not self.git_stats:
+      return await self.__git(cmd, call_type, stdout, stderr, skip_err, input,
+                              raw)
+
+    start = time.monotonic()
+    ret = None
+    exit_code = 0
+    try:
+      ret = await self.__git(cmd, call_type, stdout, stderr, skip_err, input,
+                             raw)
+      if isinstance(ret, int):
+        exit_code = ret
+    except subprocess.CalledProcessError as e:
+      exit_code = e.returncode
+      raise
+    finally:
+      nbytes = len(ret) if isinstance(ret, (bytes, str)) else 0
+      self.git_stats.record(cmd, time.monotonic() - start, exit_code, nbytes)
+    return ret
+
+  async def __git(self, cmd, call_type, stdout, stderr, skip_err, input, raw):
+    run_cmd = self.git_cmd + cmd
+    if call_type == CallType.CHECK_OUTPUT:
+      stdout = subprocess.PIPE
+    elif call_type not in (CallType.CHECK_CALL, CallType.CALL):
+      raise ValueError('Invalid call type {}'.format(call_type))
+
+    stdin = subprocess.DEVNULL
+    if input != None:
+      stdin = subprocess.PIPE
+
+    async with self.semaphore():
+      logger.debug('GIT: {}'.format(' '.join(run_cmd)))
+      proc = await asyncio.create_subprocess_exec(*run_cmd, stdin=stdin,
+                                                  stdout=stdout, stderr=stderr)
+      out,_ = await proc.communicate(input=input)
+
+    if call_type == CallType.CHECK_OUTPUT:
+      if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, run_cmd,
+                                            output=out)
+      if raw:
+        return out
+      return out.decode('UTF-8')
+    elif call_type == CallType.CHECK_CALL:
+      if proc.returncode != 0 and not skip_err:
+        e = subprocess.CalledProcessError(proc.returncode, run_cmd)
+        logger.error('Exception running git: {}'.format(e))
+        logger.error('FAIL: {}'.format(' '.join(run_cmd)))
+        raise e
+      return proc.returncode
+    return proc.returncode
+
+  async def add_or_update_remote(self, ref):
+    cmd = ['remote', 'set-url', ref.remote_name, ref.remote]
+    ret = await self.git(cmd, CallType.CHECK_CALL, skip_err=True)
+    if ret == 0:
+      return
+
+    cmd = ['remote', 'add', ref.remote_name, ref.remote]
+    ret = await self.git(cmd, CallType.CHECK_CALL)
+    if ret != 0:
+      logger.error('Failed to add remote {} ({})'.format(str(ref), ret))
+
+  async def __fetch(self, refs):
+    cmd = ['fetch', '--prune', '--tags', refs[0].remote_name]
+    cmd += [r.refs() for r in refs]
+    ret = await self.git(cmd, CallType.CHECK_CALL, skip_err=True)
+    if ret != 0:
+      logger.error('Fetch remote ({}) failed: ({})'.format(refs, ret))
+    return ret == 0
+
+  async def __fetch_refs(self, refs):
+    # The fetch manager guarantees all refs share a remote. Returns the refs
+    # which were fetched.
+    logger.debug('Fetching {}'.format(refs))
+
+    await self.add_or_update_remote(refs[0])
+
+    fetched = refs
+    if not await self.__fetch(refs):
+      # One bad ref (ie: a deleted branch) fails the whole fetch, so try them
+      # one at a time so the rest still make it
+      fetched = []
+      if len(refs) > 1:
+        for r in refs:
+          if await self.__fetch([r]):
+            fetched.append(r)
+    for r in refs:
+      index = ReachabilityIndex.lookup(self.git_dir, r.refs(True))
+      if index:
+        index.invalidate()
+    return fetched
+
+  async def fetch_remotes(self, refs, force=False):
+    # The fetch manager blocks while it coalesces with other fetches of the same
+    # remote, so it waits in a worker thread while the fetch itself runs back on
+    # the loop
+    loop = asyncio.get_running_loop()
+    def do_fetch(stale):
+      future = asyncio.run_coroutine_threadsafe(self.__fetch_refs(stale), loop)
+      return future.result()
+
+    return await self.run_sync(lambda: self.fetches.fetch(refs, do_fetch,
+                                                          force=force))
+
+  async def fetch_remote(self, ref, force=False):
+    return await self.fetch_remotes([ref], force=force)
+
+  async def get_commit_from_sha(self, ref, context):
+    if self.commit_lookup:
+      ret = (await self.run_sync(self.commit_lookup, [ref]))[0]
+      if ret != None:
+        return ret
+
+    # Fall back to forking git so we get its error handling for free
+    cmd = ['show', '--minimal', '-U{}'.format(context), r'--format=%B', ref.sha]
+    return PatchBuffer(await self.git(cmd, CallType.CHECK_OUTPUT, stderr=None,
+                                      raw=True))
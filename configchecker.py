@@ -24,7 +24,8 @@ class KernelConfigChecker():
   def is_config_change(self, patch):
       # Running the kernelconfig script is a little slow, so for now
       # only do it on CLs that have changed the configs.
-      return '+++ b/chromeos/config' in patch
+      files = self.reviewer.parse_patch(patch).new_names()
+      return any(f.startswith('chromeos/config') for f in files)
 
   def create_kernel_configs(self):
       cmd = [str(self.config_cmd), 'genconfig']
@@ -0,0 +1,525 @@
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger('rom.diffengine')
+
+def _text(line):
+  # Lines may be str, or bytes-like slices of a patch which are only decoded
+  # once they make it into the output
+  if isinstance(line, str):
+    return line
+  return str(line, 'UTF-8', errors='replace')
+
+
+def _picklable(lines):
+  return [bytes(l) if isinstance(l, memoryview) else l for l in lines]
+
+
+class FileDiff(object):
+  def __init__(self, old='', new=''):
+    self.old = old
+    self.new = new
+    self.lines = []
+    # 0 for changed lines, N for the Nth last line of a run of context
+    self.ranks = []
+
+  def key(self):
+    return (self.old, self.new)
+
+  def __str__(self):
+    return '{} {} ({} lines)'.format(self.old, self.new, len(self.lines))
+
+  def __repr__(self):
+    return self.__str__()
+
+
+def with_context(files, context):
+  # Narrows ranked files down to the given amount of context
+  ret = []
+  for f in files:
+    n = FileDiff(old=f.old, new=f.new)
+    for l,r in zip(f.lines, f.ranks):
+      if r <= context:
+        n.lines.append(l)
+        n.ranks.append(r)
+    if n.old or n.new or n.lines:
+      ret.append(n)
+  return ret
+
+
+# Past this many edits, give up on finding the shortest script for a region and
+# call it a replacement. Patience anchors usually keep regions well under this
+MAX_MYERS_COST = 1024
+
+class DiffTimeout(Exception):
+  pass
+
+
+def _check_deadline(deadline):
+  if deadline and time.monotonic() > deadline:
+    raise DiffTimeout()
+
+
+def _count_changes(a, b):
+  # The cheap fallback, counts lines which aren't on both sides without
+  # caring about their order
+  ca = collections.Counter(a)
+  cb = collections.Counter(b)
+  return sum(((ca - cb) + (cb - ca)).values())
+
+
+def _myers_matches(a, a_lo, a_hi, b, b_lo, b_hi, deadline=None):
+  # Classic O((N+M)D) greedy diff, walking back through the saved frontiers to
+  # recover the matching lines
+  n = a_hi - a_lo
+  m = b_hi - b_lo
+  if set(a[a_lo:a_hi]).isdisjoint(b[b_lo:b_hi]):
+    return []
+
+  v = {1: 0}
+  trace = []
+  done = False
+  for d in range(0, n + m + 1):
+    if d > MAX_MYERS_COST:
+      logger.debug('Diff region too expensive ({}x{}), replacing'.format(n, m))
+      return []
+    _check_deadline(deadline)
+    trace.append(v.copy())
+    for k in range(-d, d + 1, 2):
+      if k == -d or (k != d and v[k - 1] < v[k + 1]):
+        x = v[k + 1]
+      else:
+        x = v[k - 1] + 1
+      y = x - k
+      while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+        x += 1
+        y += 1
+      v[k] = x
+      if x >= n and y >= m:
+        done = True
+        break
+    if done:
+      break
+
+  ret = []
+  x = n
+  y = m
+  for d in range(len(trace) - 1, -1, -1):
+    v = trace[d]
+    k = x - y
+    if k == -d or (k != d and v[k - 1] < v[k + 1]):
+      prev_k = k + 1
+    else:
+      prev_k = k - 1
+    prev_x = v[prev_k]
+    prev_y = prev_x - prev_k
+    while x > prev_x and y > prev_y:
+      x -= 1
+      y -= 1
+      ret.append((a_lo + x, b_lo + y))
+    x = prev_x
+    y = prev_y
+  ret.reverse()
+  return ret
+
+
+def _unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi):
+  # Patience diff: lines that appear exactly once on each side, in the longest
+  # order-preserving run
+  counts = {}
+  for i in range(a_lo, a_hi):
+    c = counts.setdefault(a[i], [0, 0, i, 0])
+    c[0] += 1
+  for j in range(b_lo, b_hi):
+    c = counts.get(b[j])
+    if c:
+      c[1] += 1
+      c[3] = j
+
+  pairs = [(c[2], c[3]) for c in counts.values() if c[0] == 1 and c[1] == 1]
+  if not pairs:
+    return []
+  pairs.sort()
+
+  # Longest increasing subsequence on the b indices
+  tails = []
+  tail_idx = []
+  prev = [None] * len(pairs)
+  for i,(_,bj) in enumerate(pairs):
+    pos = bisect.bisect_left(tails, bj)
+    if pos > 0:
+      prev[i] = tail_idx[pos - 1]
+    if pos == len(tails):
+      tails.append(bj)
+      tail_idx.append(i)
+    else:
+      tails[pos] = bj
+      tail_idx[pos] = i
+
+  ret = []
+  i = tail_idx[-1]
+  while i != None:
+    ret.append(pairs[i])
+    i = prev[i]
+  ret.reverse()
+  return ret
+
+
+def _patience_matches(a, a_lo, a_hi, b, b_lo, b_hi, ret, deadline=None):
+  _check_deadline(deadline)
+  while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+    ret.append((a_lo, b_lo))
+    a_lo += 1
+    b_lo += 1
+
+  suffix = []
+  while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+    a_hi -= 1
+    b_hi -= 1
+    suffix.append((a_hi, b_hi))
+
+  if a_lo < a_hi and b_lo < b_hi:
+    anchors = _unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi)
+    if anchors:
+      for ai,bj in anchors:
+        _patience_matches(a, a_lo, ai, b, b_lo, bj, ret, deadline)
+        ret.append((ai, bj))
+        a_lo = ai + 1
+        b_lo = bj + 1
+      _patience_matches(a, a_lo, a_hi, b, b_lo, b_hi, ret, deadline)
+    else:
+      ret.extend(_myers_matches(a, a_lo, a_hi, b, b_lo, b_hi, deadline))
+
+  suffix.reverse()
+  ret.extend(suffix)
+
+
+def opcodes(a, b, deadline=None):
+  # Raises DiffTimeout if matching is still going at <deadline>
+  matches = []
+  _patience_matches(a, 0, len(a), b, 0, len(b), matches, deadline)
+
+  i = 0
+  j = 0
+  for mi,mj in matches + [(len(a), len(b))]:
+    if i < mi and j < mj:
+      yield ('replace', i, mi, j, mj)
+    elif i < mi:
+      yield ('delete', i, mi, j, j)
+    elif j < mj:
+      yield ('insert', i, i, j, mj)
+    i = mi
+    j = mj
+    if mi < len(a):
+      yield ('equal', mi, mi + 1, mj, mj + 1)
+      i += 1
+      j += 1
+
+
+def diff_lines(a, b):
+  ret = []
+  for tag,i1,i2,j1,j2 in opcodes(a, b):
+    if tag == 'equal':
+      continue
+    for l in a[i1:i2]:
+      ret.append('- {}'.format(_text(l)))
+    for l in b[j1:j2]:
+      ret.append('+ {}'.format(_text(l)))
+  return ret
+
+
+def _file_pairs(a_files, b_files):
+  # Line up the files in each patch first so each pair can be diffed on its
+  # own, this keeps the expensive part proportional to the size of a file
+  # rather than the whole patch
+  # Yields the file header lines to print for each pair which differs, both
+  # sides' headers when the paths differ (even if the contents match)
+  a_keys = [f.key() for f in a_files]
+  b_keys = [f.key() for f in b_files]
+  for tag,i1,i2,j1,j2 in opcodes(a_keys, b_keys):
+    # Files which were renamed (or only exist on one side) are paired up in
+    # order
+    pairs = itertools.zip_longest(a_files[i1:i2], b_files[j1:j2])
+    for fa,fb in pairs:
+      a = fa.lines if fa else []
+      b = fb.lines if fb else []
+      if fa and fb and fa.key() != fb.key():
+        yield ([fa.old, fa.new, fb.old, fb.new], a, b)
+      elif a != b:
+        n = fb or fa
+        yield ([n.old, n.new], a, b)
+
+
+def _change_opcodes(a, b, deadline):
+  # Runs in a pool worker, only the changes are worth sending back
+  return [op for op in opcodes(a, b, deadline) if op[0] != 'equal']
+
+
+class ComparePool(object):
+  # One process pool shared by every comparison, files are spread across it
+  # once a patch is big enough to make the pickling worth it
+  pool = None
+  workers = 0
+  lock = threading.Lock()
+
+  @classmethod
+  def get(cls, workers):
+    with cls.lock:
+      if cls.pool and cls.workers != workers:
+        cls.pool.shutdown(wait=False)
+        cls.pool = None
+      if not cls.pool:
+        logger.debug('Starting compare pool with {} workers'.format(workers))
+        cls.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        cls.workers = workers
+      return cls.pool
+
+  @classmethod
+  def discard(cls, pool):
+    # A worker died (OOM, a signal) and took the pool with it, the next get()
+    # starts a fresh one
+    with cls.lock:
+      if cls.pool is pool:
+        logger.warning('Compare pool is broken, restarting it')
+        cls.pool.shutdown(wait=False)
+        cls.pool = None
+
+  @classmethod
+  def shutdown(cls):
+    with cls.lock:
+      if cls.pool:
+        cls.pool.shutdown(wait=False)
+        cls.pool = None
+
+atexit.register(ComparePool.shutdown)
+
+
+class DiffStream(object):
+  # Produces the same lines as compare_files(), but only diffs as far as it's
+  # read. Lines already produced are kept so the stream can be walked again.
+  #
+  # Past the deadline (or from the start if summarize is set), the remaining
+  # files are only summarized with a count of the lines which differ, and the
+  # stream is marked as degraded.
+  #
+  # Given a pool, every file is handed to it up front and the results are
+  # taken back in file order, so the output matches the serial path.
+  def __init__(self, a_files, b_files, deadline=None, summarize=False,
+               pool=None):
+    self.pairs = ((h, a, b, None) for h,a,b in _file_pairs(a_files, b_files))
+    self.futures = []
+    self.pool = None
+    if pool and not summarize:
+      self.pool = pool
+      pairs = []
+      for n,a,b,_ in self.pairs:
+        f = None
+        if self.pool:
+          try:
+            f = pool.submit(_change_opcodes, _picklable(a), _picklable(b),
+                            deadline)
+            self.futures.append(f)
+          except concurrent.futures.process.BrokenProcessPool:
+            self.__pool_broken()
+        pairs.append((n, a, b, f))
+      self.pairs = iter(pairs)
+    self.deadline = deadline
+    self.summarize = summarize
+    self.degraded = False
+    # Whether the deadline (rather than size) is what cut the diff short
+    self.timed_out = False
+    self.lines = []
+    self.cur = None
+    self.done = False
+    self.unread = None
+
+  @classmethod
+  def from_lines(cls, lines):
+    # A stream which has already been read to the end
+    ret = cls([], [])
+    ret.lines = list(lines)
+    ret.done = True
+    return ret
+
+  def is_complete(self):
+    # Read to the end, in full, with nothing summarized or left out
+    return self.done and not self.degraded and self.unread == None
+
+  def __add_summary(self, headers, a, b):
+    self.lines.extend(headers)
+    if a == b:
+      return
+    n = _count_changes(a, b)
+    if n:
+      self.lines.append('~ {} lines differ (not compared in full)'.format(n))
+    else:
+      self.lines.append('~ lines reordered (not compared in full)')
+    self.degraded = True
+
+  def __pool_broken(self):
+    # Whatever the pool didn't finish is diffed here instead
+    ComparePool.discard(self.pool)
+    self.pool = None
+    self.__cancel()
+
+  def __opcodes(self, a, b, future):
+    if future and self.pool:
+      timeout = None
+      if self.deadline:
+        timeout = max(0, self.deadline - time.monotonic())
+      try:
+        return iter(future.result(timeout=timeout))
+      except concurrent.futures.TimeoutError:
+        raise DiffTimeout()
+      except concurrent.futures.process.BrokenProcessPool:
+        self.__pool_broken()
+
+    _check_deadline(self.deadline)
+    return (op for op in opcodes(a, b, self.deadline) if op[0] != 'equal')
+
+  def __cancel(self):
+    # Stop the pool from diffing files whose results won't be read
+    for f in self.futures:
+      f.cancel()
+
+  def __next_file(self):
+    for headers,a,b,future in self.pairs:
+      if not self.summarize:
+        try:
+          ops = self.__opcodes(a, b, future)
+          first = next(ops, None)
+        except DiffTimeout:
+          logger.info('Diff out of time, summarizing the remaining files')
+          self.summarize = True
+          self.timed_out = True
+          self.__cancel()
+
+      if self.summarize:
+        self.__add_summary(headers, a, b)
+        return True
+
+      if not first:
+        if len(headers) > 2:
+          # Only the paths differ
+          self.lines.extend(headers)
+          return True
+        continue
+      self.lines.extend(headers)
+      # Position within the current op is tracked so huge replacements are
+      # also only formatted as far as they're read
+      self.cur = [a, b, itertools.chain([first], ops), None, 0]
+      return True
+    self.done = True
+    return False
+
+  def __fill(self):
+    # Diff just enough to produce at least one more line
+    while not self.done:
+      if not self.cur:
+        if self.__next_file():
+          return True
+        continue
+
+      a,b,ops,op,pos = self.cur
+      if not op:
+        op = next(ops, None)
+        if not op:
+          self.cur = None
+          continue
+        self.cur[3] = op
+        self.cur[4] = pos = 0
+
+      _,i1,i2,j1,j2 = op
+      if i1 + pos < i2:
+        self.lines.append('- {}'.format(_text(a[i1 + pos])))
+      else:
+        self.lines.append('+ {}'.format(_text(b[j1 + pos - (i2 - i1)])))
+      pos += 1
+      self.cur[4] = pos
+      if pos >= (i2 - i1) + (j2 - j1):
+        self.cur[3] = None
+      return True
+    return False
+
+  def __iter__(self):
+    i = 0
+    while i < len(self.lines) or self.__fill():
+      yield self.lines[i]
+      i += 1
+
+  def __bool__(self):
+    return bool(self.lines) or self.__fill()
+
+  def omitted(self, shown):
+    # Counts what's left after the first <shown> lines without diffing any file
+    # past the current one, which ends the stream. Returns (lines, files)
+    if not self.unread:
+      lines = 0
+      if self.cur:
+        _,_,ops,op,pos = self.cur
+        if op:
+          lines += (op[2] - op[1]) + (op[4] - op[3]) - pos
+        for _,i1,i2,j1,j2 in ops:
+          lines += (i2 - i1) + (j2 - j1)
+        self.cur = None
+      self.__cancel()
+      self.unread = (lines, sum(1 for _ in self.pairs))
+      self.done = True
+    return (len(self.lines) - shown + self.unread[0], self.unread[1])
+
+
+class DiffMemo(object):
+  # Comparison results keyed by the fingerprints of both patches and the
+  # context, shared across reviewers so identical backports and re-uploads are
+  # only compared once. Only the lines of diffs which were read to the end are
+  # kept, and every get() hands out a stream of its own.
+  memo = None
+  memo_lock = threading.Lock()
+
+  @classmethod
+  def get_shared(cls, size):
+    with cls.memo_lock:
+      if not cls.memo:
+        cls.memo = cls(size)
+      cls.memo.size = size
+      return cls.memo
+
+  def __init__(self, size):
+    self.size = size
+    self.lock = threading.Lock()
+    self.results = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    with self.lock:
+      lines = self.results.get(key)
+      if lines == None:
+        self.misses += 1
+        return None
+      self.results.move_to_end(key)
+      self.hits += 1
+    return DiffStream.from_lines(lines)
+
+  def put(self, key, diff):
+    # Diffs which were cut short or summarized depend on how much of them the
+    # reviewer read and how much time it had, so they're never kept
+    if not diff.is_complete():
+      return False
+    with self.lock:
+      self.results[key] = tuple(diff.lines)
+      self.results.move_to_end(key)
+      while len(self.results) > self.size:
+        self.results.popitem(last=False)
+    return True
+
+
+def compare_files(a_files, b_files):
+  return list(DiffStream(a_files, b_files))
@@ -0,0 +1,220 @@
+import collections
+import json
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+import urllib.parse
+
+logger = logging.getLogger('rom.events')
+
+GerritEvent = collections.namedtuple('GerritEvent',
+                                     ['type', 'project', 'branch', 'number',
+                                      'subject', 'revision', 'comment'])
+
+PATCHSET_CREATED = 'patchset-created'
+COMMENT_ADDED = 'comment-added'
+CHANGE_MERGED = 'change-merged'
+CHANGE_ABANDONED = 'change-abandoned'
+EVENT_TYPES = (PATCHSET_CREATED, COMMENT_ADDED, CHANGE_MERGED,
+               CHANGE_ABANDONED)
+CLOSED_TYPES = (CHANGE_MERGED, CHANGE_ABANDONED)
+
+
+def parse_event(line):
+  # One line of gerrit stream-events JSON, or None if it isn't one we use
+  if isinstance(line, bytes):
+    line = line.decode('UTF-8', errors='replace')
+  line = line.strip()
+  if not line:
+    return None
+  try:
+    e = json.loads(line)
+    if e.get('type') not in EVENT_TYPES:
+      return None
+    change = e['change']
+    return GerritEvent(type=e['type'], project=change['project'],
+                       branch=change['branch'], number=int(change['number']),
+                       subject=change.get('subject', ''),
+                       revision=int(e.get('patchSet', {}).get('number', 0)),
+                       comment=e.get('comment', ''))
+  except (ValueError, KeyError, TypeError, AttributeError) as e:
+    logger.warning('Ignoring malformed event ({}): {}'.format(e, line[:200]))
+    return None
+
+
+class EventSource(object):
+  # Yields raw stream-events lines forever. Sources reconnect on their own, and
+  # anything missed while they're down is left to the reconciliation poll.
+  RECONNECT_MIN = 1.0
+  RECONNECT_MAX = 300.0
+
+  def __init__(self):
+    self.reconnect_delay = self.RECONNECT_MIN
+
+  def backoff(self, connected):
+    if connected:
+      self.reconnect_delay = self.RECONNECT_MIN
+    logger.warning('{} disconnected, reconnecting in {:.0f}s'.format(
+                      self, self.reconnect_delay))
+    time.sleep(self.reconnect_delay)
+    self.reconnect_delay = min(self.reconnect_delay * 2, self.RECONNECT_MAX)
+
+  def lines(self):
+    raise NotImplementedError()
+
+
+class SshEventSource(EventSource):
+  DEFAULT_PORT = 29418
+
+  def __init__(self, url):
+    super().__init__()
+    parsed = urllib.parse.urlsplit(url)
+    self.host = parsed.hostname
+    self.port = parsed.port or self.DEFAULT_PORT
+    self.user = parsed.username
+
+  def __str__(self):
+    return 'ssh://{}{}:{}'.format('{}@'.format(self.user) if self.user else '',
+                                  self.host, self.port)
+
+  def cmd(self):
+    target = self.host
+    if self.user:
+      target = '{}@{}'.format(self.user, self.host)
+    cmd = ['ssh', '-o', 'BatchMode=yes', '-o', 'ServerAliveInterval=30',
+           '-p', str(self.port), target, 'gerrit', 'stream-events']
+    for t in EVENT_TYPES:
+      cmd += ['-s', t]
+    return cmd
+
+  def lines(self):
+    while True:
+      connected = False
+      proc = subprocess.Popen(self.cmd(), stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE)
+      try:
+        for line in proc.stdout:
+          connected = True
+          yield line
+      finally:
+        proc.kill()
+        proc.wait()
+      self.backoff(connected)
+
+
+class FifoEventSource(EventSource):
+  def __init__(self, path):
+    super().__init__()
+    self.path = path
+
+  def __str__(self):
+    return 'fifo:{}'.format(self.path)
+
+  def lines(self):
+    while True:
+      # Blocks until a writer shows up, and hits EOF once the last one leaves
+      with open(self.path, 'rb') as f:
+        for line in f:
+          yield line
+
+
+class FileEventSource(EventSource):
+  # Follows a file like tail -f, starting at the end unless from_start is set
+  POLL_INTERVAL = 1.0
+
+  def __init__(self, path, from_start=False):
+    super().__init__()
+    self.path = path
+    self.from_start = from_start
+
+  def __str__(self):
+    return 'file:{}'.format(self.path)
+
+  def lines(self):
+    from_start = self.from_start
+    while True:
+      try:
+        f = open(self.path, 'rb')
+      except FileNotFoundError:
+        time.sleep(self.POLL_INTERVAL)
+        from_start = True
+        continue
+
+      with f:
+        if not from_start:
+          f.seek(0, os.SEEK_END)
+        # Anything after a rotation is new
+        from_start = True
+        partial = b''
+        while True:
+          line = f.readline()
+          if line.endswith(b'\n'):
+            yield partial + line
+            partial = b''
+            continue
+          partial += line
+
+          try:
+            st = os.stat(self.path)
+          except FileNotFoundError:
+            break
+          if (st.st_ino != os.fstat(f.fileno()).st_ino or
+              st.st_size < f.tell()):
+            break
+          time.sleep(self.POLL_INTERVAL)
+
+
+def source_for(spec):
+  if spec.startswith('ssh://'):
+    return SshEventSource(spec)
+  if spec.startswith('fifo:'):
+    return FifoEventSource(spec[len('fifo:'):])
+  if spec.startswith('file:'):
+    return FileEventSource(spec[len('file:'):])
+  raise ValueError('Unknown event source "{}"'.format(spec))
+
+
+class EventListener(object):
+  # Reads a source in the background and hands over events in batches
+  # Once an event arrives, wait this long for the rest of a series to show up
+  SETTLE_TIME = 2.0
+  MAX_BATCH = 500
+
+  def __init__(self, source):
+    self.source = source
+    self.events = queue.Queue()
+    self.thread = threading.Thread(target=self.listen, daemon=True,
+                                   name='rom-events')
+
+  def start(self):
+    logger.info('Listening for events from {}'.format(self.source))
+    self.thread.start()
+
+  def listen(self):
+    while True:
+      try:
+        for line in self.source.lines():
+          e = parse_event(line)
+          if e:
+            self.events.put(e)
+      except Exception as e:
+        logger.error('Event source {} failed'.format(self.source))
+        logger.exception('Exception: {}'.format(e))
+      self.source.backoff(False)
+
+  def wait(self, timeout):
+    # Returns whatever arrived within timeout seconds, possibly nothing
+    try:
+      ret = [self.events.get(timeout=timeout)]
+    except queue.Empty:
+      return []
+
+    while len(ret) < self.MAX_BATCH:
+      try:
+        ret.append(self.events.get(timeout=self.SETTLE_TIME))
+      except queue.Empty:
+        break
+    return ret
@@ -1,10 +1,14 @@
+import base64
 from datetime import datetime
 import json
 import logging
 from logging import handlers
 from pygerrit2 import GerritRestAPI, HTTPBasicAuthFromNetrc
 import pprint
+import queue
 import requests
+import threading
+import transport
 import urllib
 
 logger = logging.getLogger('rom')
@@ -13,6 +17,46 @@ logger.setLevel(logging.DEBUG) # leave this to handlers
 def parse_gerrit_timestamp(ts):
   return datetime.strptime(ts[:-10], '%Y-%m-%d %H:%M:%S')
 
+def prefetch(pages):
+  # Pulls items from the pages iterator in a background thread, so the next
+  # page is downloading while the caller works on the current one. Errors are
+  # raised in the caller, where they would have happened without it.
+  ready = queue.Queue(maxsize=1)
+  stop = threading.Event()
+  done = object()
+
+  def put(item):
+    while not stop.is_set():
+      try:
+        ready.put(item, timeout=1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def run():
+    try:
+      for p in pages:
+        if not put((p, None)):
+          return
+      put((done, None))
+    except Exception as e:
+      put((None, e))
+
+  threading.Thread(target=run, daemon=True, name='rom-prefetch').start()
+  try:
+    while True:
+      page,err = ready.get()
+      if err != None:
+        raise err
+      if page is done:
+        return
+      yield page
+  finally:
+    # The caller stopped early, don't leave the thread waiting on it
+    stop.set()
+
+
 class AuthFromNetrc(HTTPBasicAuthFromNetrc):
   def __init__(self, url, use_internal):
     # This is a nasty little hack, that is probably going to be forgotten the
@@ -154,10 +198,15 @@ class GerritChange(object):
     return
 
 class Gerrit(object):
+  # Changes asked for per query request
+  QUERY_PAGE_SIZE = 100
+
   def __init__(self, url, use_internal=False):
     auth = AuthFromNetrc(url, use_internal)
     self.timeout = 90
     self.rest = GerritRestAPI(url=url, auth=auth)
+    # Share the pooled (and instrumented) session for this host
+    self.rest.session = transport.session_for(url)
     self.url = url
     self.change_options = ['CURRENT_REVISION', 'MESSAGES', 'DETAILED_LABELS',
                            'DETAILED_ACCOUNTS', 'COMMIT_FOOTERS']
@@ -221,12 +270,44 @@ class Gerrit(object):
   def query_changes(self, status=None, message=None, after=None, age_days=None,
                     change_id=None, change_num=None, project=None, owner=None,
                     branches=None):
+    return list(self.iter_query_changes(status=status, message=message,
+                                        after=after, age_days=age_days,
+                                        change_id=change_id,
+                                        change_num=change_num, project=project,
+                                        owner=owner, branches=branches))
+
+  def iter_query_changes(self, **kwargs):
+    for page in self.iter_query_pages(**kwargs):
+      for c in page:
+        yield c
+
+  def iter_query_pages(self, status=None, message=None, after=None,
+                       age_days=None, change_id=None, change_num=None,
+                       project=None, owner=None, branches=None,
+                       page_size=None):
+    # Yields lists of changes as each page arrives, the next page is requested
+    # in the background while the caller works on the current one
+    return prefetch(self.__query_pages(status=status, message=message,
+                                       after=after, age_days=age_days,
+                                       change_id=change_id,
+                                       change_num=change_num, project=project,
+                                       owner=owner, branches=branches,
+                                       page_size=page_size))
+
+  def __query_pages(self, status=None, message=None, after=None,
+                    age_days=None, change_id=None, change_num=None,
+                    project=None, owner=None, branches=None, page_size=None):
     query = []
     if message:
       query.append('message:"{}"'.format(urllib.parse.quote(message)))
     if status:
       query.append('status:{}'.format(status))
-    if after:
+    if isinstance(after, datetime):
+      # Gerrit timestamps are UTC, the offset keeps gerrit from assuming its own
+      # timezone (and has to be quoted so the + survives)
+      query.append('after:"{}"'.format(urllib.parse.quote(
+                      after.strftime('%Y-%m-%d %H:%M:%S +0000'))))
+    elif after:
       query.append('after:"{}"'.format(after.isoformat()))
     if age_days:
       query.append('age:{}d'.format(age_days))
@@ -249,16 +330,36 @@ class Gerrit(object):
 
     uri = '/changes/?q={}&o={}'.format('+'.join(query),
                                        '&o='.join(self.change_options))
-    changes = []
-    for c in self.rest.get(uri, timeout=self.timeout):
-      changes.append(GerritChange(self.url, c))
-    return changes
+    page_size = page_size or self.QUERY_PAGE_SIZE
+    start = 0
+    seen = set()
+    while True:
+      rest = self.rest.get('{}&n={}&S={}'.format(uri, page_size, start),
+                           timeout=self.timeout)
+      page = []
+      for c in rest:
+        # Changes updated mid-query can shift onto the next page
+        if c['_number'] in seen:
+          continue
+        seen.add(c['_number'])
+        page.append(GerritChange(self.url, c))
+      if page:
+        yield page
+
+      # Gerrit flags the last change of a page if there are more to come
+      if not rest or not rest[-1].get('_more_changes'):
+        return
+      start += len(rest)
 
   def get_patch(self, change):
     uri = '/changes/{}/revisions/{}/patch'.format(change.id,
                                                   change.current_revision.id)
     return self.rest.get(uri, timeout=self.timeout)
 
+  def get_formatted_patch(self, change):
+    # /patch is 'git format-patch' output, base64 encoded
+    return base64.b64decode(self.get_patch(change))
+
   def get_messages(self, change):
     uri = '/changes/{}/messages'.format(change.id)
     return self.rest.get(uri, timeout=self.timeout)
@@ -0,0 +1,107 @@
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger('rom.gitfetch')
+
+class FetchRequest(object):
+  def __init__(self, refspecs):
+    self.refspecs = set(refspecs)
+    self.done = threading.Event()
+
+
+class FetchManager(object):
+  managers = {}
+  managers_lock = threading.Lock()
+
+  @classmethod
+  def for_git_dir(cls, git_dir, ttl):
+    # Reviewers are recreated every cycle, but fetch freshness needs to survive
+    # across cycles to be of any use
+    with cls.managers_lock:
+      mgr = cls.managers.get(git_dir)
+      if not mgr:
+        mgr = cls(git_dir, ttl)
+        cls.managers[git_dir] = mgr
+      mgr.ttl = ttl
+      return mgr
+
+  def __init__(self, git_dir, ttl):
+    self.git_dir = git_dir
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.last_fetch = {}
+    self.in_flight = {}
+    self.fetches = 0
+    self.skipped = 0
+    self.coalesced = 0
+
+  def __key(self, ref):
+    return (ref.remote_name, ref.refs())
+
+  def __is_fresh(self, ref, now, since=None):
+    # Anything fetched after <since> (when the caller started waiting on a
+    # fetch in flight) is as fresh as it gets, whatever the ttl
+    last = self.last_fetch.get(self.__key(ref))
+    if last == None:
+      return False
+    return (now - last) < self.ttl or (since != None and last >= since)
+
+  def invalidate(self, ref):
+    with self.lock:
+      self.last_fetch.pop(self.__key(ref), None)
+
+  def fetch(self, refs, do_fetch, force=False):
+    # Group by remote so several branches of one remote share a single fetch
+    by_remote = collections.OrderedDict()
+    for r in refs:
+      remote_refs = by_remote.setdefault(r.remote_name, [])
+      if self.__key(r) not in [self.__key(rr) for rr in remote_refs]:
+        remote_refs.append(r)
+
+    ret = True
+    for remote_name,remote_refs in by_remote.items():
+      if not self.__fetch_remote(remote_name, remote_refs, do_fetch, force):
+        ret = False
+    return ret
+
+  def __fetch_remote(self, remote_name, refs, do_fetch, force):
+    waited_since = None
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        stale = [r for r in refs
+                 if force or not self.__is_fresh(r, now, waited_since)]
+        if not stale:
+          self.skipped += 1
+          return True
+
+        in_flight = self.in_flight.get(remote_name)
+        if not in_flight:
+          req = FetchRequest([r.refs() for r in stale])
+          self.in_flight[remote_name] = req
+          break
+
+      # Someone is already fetching this remote, piggyback on their result and
+      # only go to the network for whatever they didn't cover
+      logger.debug('Waiting on in-flight fetch of {}'.format(remote_name))
+      if waited_since == None:
+        waited_since = now
+      in_flight.done.wait()
+      self.coalesced += 1
+      force = False
+
+    # do_fetch returns the refs it managed to fetch, only those are fresh
+    fetched = []
+    try:
+      fetched = do_fetch(stale)
+    finally:
+      with self.lock:
+        self.fetches += 1
+        now = time.monotonic()
+        for r in fetched:
+          self.last_fetch[self.__key(r)] = now
+        del self.in_flight[remote_name]
+        req.done.set()
+    return len(fetched) == len(stale)
@@ -0,0 +1,381 @@
+import atexit
+import bisect
+import heapq
+import json
+import logging
+import os
+import pathlib
+import re
+import threading
+
+logger = logging.getLogger('rom.gitindex')
+
+class ShaTable(object):
+  # A sorted run of binary object ids packed into one bytes object, searched
+  # with bisect. A kernel history costs ~20 bytes a commit this way, rather than
+  # the ~100 of a set of bytes objects.
+  def __init__(self, data=b'', width=20):
+    self.data = data
+    self.width = width
+
+  @classmethod
+  def from_hex(cls, shas):
+    shas = sorted(s.lower() for s in shas)
+    width = len(shas[0]) // 2 if shas else 20
+    return cls(bytes.fromhex(''.join(shas)), width)
+
+  def __len__(self):
+    return len(self.data) // self.width
+
+  def __getitem__(self, i):
+    if i < 0 or i >= len(self):
+      raise IndexError(i)
+    return self.data[i * self.width:(i + 1) * self.width]
+
+  def __contains__(self, sha):
+    i = bisect.bisect_left(self, sha)
+    return i < len(self) and self[i] == sha
+
+  def merge(self, shas):
+    # Returns a new table, shas are binary and needn't be sorted
+    new = sorted(s for s in shas if s not in self)
+    return ShaTable(b''.join(heapq.merge(iter(self), new)), self.width)
+
+
+class ReachabilityIndex(object):
+  indexes = {}
+  indexes_lock = threading.Lock()
+
+  # Newly reachable commits are kept in a set until there are this many of
+  # them, then merged into the packed table
+  MAX_RECENT = 4096
+
+  @classmethod
+  def track(cls, git_dir, branch, monotonic=False):
+    # Called by every new Reviewer, so the tip is looked at again once a cycle
+    with cls.indexes_lock:
+      index = cls.indexes.get((git_dir, branch))
+      if not index:
+        index = cls(branch, monotonic)
+        cls.indexes[(git_dir, branch)] = index
+      index.invalidate()
+      return index
+
+  @classmethod
+  def lookup(cls, git_dir, branch):
+    with cls.indexes_lock:
+      return cls.indexes.get((git_dir, branch))
+
+  def __init__(self, branch, monotonic):
+    self.branch = branch
+    # A monotonic branch (ie: mainline) never loses commits, so once a commit
+    # is found to be reachable that answer is good forever
+    self.monotonic = monotonic
+    self.lock = threading.Lock()
+    self.tip = None
+    self.stale = True
+    self.commits = ShaTable()
+    self.recent = set()
+    self.positive = set()
+
+  def invalidate(self):
+    # The branch may have moved (ie: it was just fetched), check the tip on the
+    # next lookup
+    self.stale = True
+
+  def __rev_list(self, reviewer, rev_range):
+    return reviewer.rev_list(rev_range).split()
+
+  def update(self, reviewer):
+    if not self.stale:
+      return self.tip != None
+    # Cleared up front so an invalidate() from a fetch running meanwhile isn't
+    # lost, and set again if the tip couldn't be indexed
+    self.stale = False
+    try:
+      return self.__update(reviewer)
+    except:
+      self.stale = True
+      raise
+
+  def __update(self, reviewer):
+    tip = reviewer.objects.resolve(self.branch, 'commit')
+    if not tip:
+      self.stale = True
+      return False
+    if tip == self.tip:
+      return True
+
+    if self.tip and reviewer.is_ancestor(self.tip, tip):
+      logger.debug('Extending index {} {}..{}'.format(self.branch,
+                                                      self.tip[:12],
+                                                      tip[:12]))
+      for l in self.__rev_list(reviewer, ['{}..{}'.format(self.tip, tip)]):
+        self.recent.add(bytes.fromhex(l))
+      if len(self.recent) > self.MAX_RECENT:
+        self.commits = self.commits.merge(self.recent)
+        self.recent = set()
+    else:
+      # Either the first time through, or the branch was rewound
+      logger.debug('Building index {} at {}'.format(self.branch, tip[:12]))
+      self.commits = ShaTable.from_hex(self.__rev_list(reviewer, [tip]))
+      self.recent = set()
+    self.tip = tip
+    return True
+
+  def contains(self, reviewer, sha):
+    full_sha = reviewer.objects.resolve(sha, 'commit')
+    if not full_sha:
+      return False
+    if full_sha in self.positive:
+      return True
+
+    key = bytes.fromhex(full_sha)
+    with self.lock:
+      if not self.update(reviewer):
+        return False
+      ret = key in self.recent or key in self.commits
+
+    if ret and self.monotonic:
+      self.positive.add(full_sha)
+    return ret
+
+
+class FixesIndex(object):
+  indexes = {}
+  indexes_lock = threading.Lock()
+
+  # Mirrors the old 'git log -i --grep Fixes:.*<sha>' lookup, any hash on a
+  # Fixes: line counts. Entries are keyed by the shortest abbreviation git
+  # hands out, and the full hash from the tag is checked on lookup.
+  FIXES_RE = re.compile('Fixes:(.*)', flags=re.I)
+  HASH_RE = re.compile('[0-9a-f]{7,40}', flags=re.I)
+  KEY_LEN = 7
+  # Bumped whenever the layout on disk changes, older indexes are rebuilt
+  VERSION = 2
+
+  @classmethod
+  def track(cls, git_dir, branch, index_dir=None):
+    with cls.indexes_lock:
+      index = cls.indexes.get((git_dir, branch))
+      if not index:
+        path = None
+        if index_dir:
+          path = pathlib.Path(index_dir, 'fixes-{}.json'.format(
+                                re.sub('\W', '_', branch)))
+        index = cls(branch, path)
+        cls.indexes[(git_dir, branch)] = index
+      return index
+
+  @classmethod
+  def lookup(cls, git_dir, branch):
+    with cls.indexes_lock:
+      return cls.indexes.get((git_dir, branch))
+
+  @classmethod
+  def save_all(cls):
+    with cls.indexes_lock:
+      indexes = list(cls.indexes.values())
+    for index in indexes:
+      with index.lock:
+        if index.dirty:
+          index.save()
+
+  def __init__(self, branch, path):
+    self.branch = branch
+    self.path = path
+    self.lock = threading.Lock()
+    self.tip = None
+    # Abbreviated hash -> [[hash from the tag, fixing sha, fixing oneline]]
+    self.fixes = {}
+    # Only the tip moved since the last save, that's worth writing out at exit
+    # but not after every update
+    self.dirty = False
+    self.load()
+
+  def load(self):
+    if not self.path:
+      return
+    try:
+      with open(str(self.path), 'rt') as f:
+        data = json.load(f)
+      if data.get('version') != self.VERSION:
+        logger.info('Rebuilding old fixes index {}'.format(self.path))
+        return
+      self.tip = data['tip']
+      self.fixes = data['fixes']
+    except FileNotFoundError:
+      logger.info('Fixes index {} missing, will create'.format(self.path))
+    except (ValueError, KeyError, AttributeError) as e:
+      logger.error('Discarding malformed fixes index {} ({})'.format(self.path,
+                                                                     e))
+      self.tip = None
+      self.fixes = {}
+
+  def save(self):
+    self.dirty = False
+    if not self.path:
+      return
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = self.path.with_name('{}.{}.tmp'.format(self.path.name, os.getpid()))
+    with open(str(tmp), 'wt') as f:
+      json.dump({'version': self.VERSION, 'tip': self.tip,
+                 'fixes': self.fixes}, f)
+    os.replace(str(tmp), str(self.path))
+
+  def __index_commits(self, reviewer, rev_range):
+    new_fixes = {}
+    for entry in reviewer.log_fixes(rev_range).split('\x01')[1:]:
+      sha,oneline,body = entry.split('\x00', 2)
+      for m in self.FIXES_RE.finditer(body):
+        for h in self.HASH_RE.findall(m.group(1)):
+          h = h.lower()
+          refs = new_fixes.setdefault(h[:self.KEY_LEN], [])
+          if [h, sha, oneline] not in refs:
+            refs.append([h, sha, oneline])
+    return new_fixes
+
+  def update(self, reviewer):
+    tip = reviewer.objects.resolve(self.branch, 'commit')
+    if not tip:
+      return False
+    if tip == self.tip:
+      return True
+
+    if self.tip and reviewer.is_ancestor(self.tip, tip):
+      logger.debug('Extending fixes index {} {}..{}'.format(self.branch,
+                                                            self.tip[:12],
+                                                            tip[:12]))
+      new_fixes = self.__index_commits(reviewer,
+                                       ['{}..{}'.format(self.tip, tip)])
+      # git log is newest first, keep it that way
+      for k,v in new_fixes.items():
+        self.fixes[k] = v + self.fixes.get(k, [])
+    else:
+      logger.debug('Building fixes index {} at {}'.format(self.branch,
+                                                          tip[:12]))
+      new_fixes = self.fixes = self.__index_commits(reviewer, [tip])
+    self.tip = tip
+    if new_fixes:
+      self.save()
+    else:
+      self.dirty = True
+    return True
+
+  def find(self, reviewer, sha):
+    full_sha = reviewer.objects.resolve(sha, 'commit')
+    query = (full_sha or sha).lower()
+    with self.lock:
+      self.update(reviewer)
+      refs = list(self.fixes.get(query[:self.KEY_LEN], []))
+
+    ret = []
+    for h,fix_sha,oneline in refs:
+      if not query.startswith(h) and not h.startswith(query):
+        continue
+      # The old lookup only walked sha..branch, so nothing the commit already
+      # contains
+      if full_sha and reviewer.is_ancestor(fix_sha, full_sha):
+        continue
+      if oneline not in ret:
+        ret.append(oneline)
+    return ''.join(['{}\n'.format(r) for r in ret])
+
+atexit.register(FixesIndex.save_all)
+
+
+class PatchIdIndex(object):
+  indexes = {}
+  indexes_lock = threading.Lock()
+
+  @classmethod
+  def track(cls, git_dir, ref, index_dir=None, depth=None):
+    branch = ref.refs(True)
+    with cls.indexes_lock:
+      index = cls.indexes.get((git_dir, branch))
+      if not index:
+        path = None
+        if index_dir:
+          path = pathlib.Path(index_dir, 'patchid-{}.json'.format(
+                                re.sub('\W', '_', branch)))
+        index = cls(ref, path, depth)
+        cls.indexes[(git_dir, branch)] = index
+      return index
+
+  @classmethod
+  def for_git_dir(cls, git_dir):
+    with cls.indexes_lock:
+      return [v for k,v in cls.indexes.items() if k[0] == git_dir]
+
+  def __init__(self, ref, path, depth):
+    self.ref = ref
+    self.branch = ref.refs(True)
+    self.path = path
+    # Hashing every patch in history is far too slow, so only go back this many
+    # commits when building from scratch
+    self.depth = depth
+    self.lock = threading.Lock()
+    self.tip = None
+    self.patch_ids = {}
+    self.load()
+
+  def load(self):
+    if not self.path:
+      return
+    try:
+      with open(str(self.path), 'rt') as f:
+        data = json.load(f)
+      self.tip = data['tip']
+      self.patch_ids = data['patch_ids']
+    except FileNotFoundError:
+      logger.info('Patch-id index {} missing, will create'.format(self.path))
+    except (ValueError, KeyError) as e:
+      logger.error('Discarding malformed patch-id index {} ({})'.format(
+                      self.path, e))
+      self.tip = None
+      self.patch_ids = {}
+
+  def save(self):
+    if not self.path:
+      return
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = self.path.with_name('{}.{}.tmp'.format(self.path.name, os.getpid()))
+    with open(str(tmp), 'wt') as f:
+      json.dump({'tip': self.tip, 'patch_ids': self.patch_ids}, f)
+    os.replace(str(tmp), str(self.path))
+
+  def update(self, reviewer):
+    tip = reviewer.objects.resolve(self.branch, 'commit')
+    if not tip:
+      return False
+    if tip == self.tip:
+      return True
+
+    if self.tip and reviewer.is_ancestor(self.tip, tip):
+      logger.debug('Extending patch-id index {} {}..{}'.format(self.branch,
+                                                               self.tip[:12],
+                                                               tip[:12]))
+      new_ids = reviewer.patch_ids(['{}..{}'.format(self.tip, tip)])
+    else:
+      logger.debug('Building patch-id index {} at {}'.format(self.branch,
+                                                             tip[:12]))
+      self.patch_ids = {}
+      new_ids = reviewer.patch_ids([tip], max_count=self.depth)
+
+    # patch-id output follows log order (newest first), and the newest commit
+    # is the most useful suggestion for duplicate patches
+    for patch_id,sha in reversed(new_ids):
+      shas = self.patch_ids.setdefault(patch_id, [])
+      shas.insert(0, sha)
+
+    self.tip = tip
+    self.save()
+    return True
+
+  def find(self, reviewer, patch_id):
+    with self.lock:
+      self.update(reviewer)
+      shas = self.patch_ids.get(patch_id)
+    if not shas:
+      return None
+    return shas[0]
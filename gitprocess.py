@@ -0,0 +1,288 @@
+import atexit
+import logging
+import subprocess
+import threading
+import time
+import uuid
+
+logger = logging.getLogger('rom.gitprocess')
+
+class GitCoprocessError(Exception):
+  pass
+
+class GitCoprocess(object):
+  # Restarting more than this many times in a row means something is wrong
+  # with the repo (or git), so stop trying and let the caller fall back
+  MAX_RESTARTS = 3
+
+  def __init__(self, git_dir, args):
+    self.git_dir = git_dir
+    self.args = args
+    if git_dir:
+      self.cmd = ['git', '-C', git_dir] + args
+    else:
+      self.cmd = ['git'] + args
+    self.proc = None
+    self.lock = threading.Lock()
+    self.spawns = 0
+    self.requests = 0
+    # Optional GitStats, each request is recorded like a git command would be
+    self.git_stats = None
+    self.bytes_read = 0
+
+  def start(self):
+    logger.debug('GIT COPROCESS: {}'.format(' '.join(self.cmd)))
+    self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL)
+    self.spawns += 1
+
+  def stop(self):
+    if not self.proc:
+      return
+    try:
+      self.proc.stdin.close()
+    except OSError:
+      pass
+    try:
+      self.proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+      self.proc.kill()
+      self.proc.wait()
+    self.proc = None
+
+  def is_alive(self):
+    return self.proc is not None and self.proc.poll() is None
+
+  def forks_saved(self):
+    return max(self.requests - self.spawns, 0)
+
+  def write_line(self, line):
+    self.proc.stdin.write(line.encode('UTF-8') + b'\n')
+    self.proc.stdin.flush()
+
+  def read_line(self):
+    line = self.proc.stdout.readline()
+    if not line:
+      raise GitCoprocessError('{} exited unexpectedly'.format(self.cmd))
+    self.bytes_read += len(line)
+    return line.rstrip(b'\n')
+
+  def read_exact(self, size):
+    data = self.proc.stdout.read(size)
+    if data is None or len(data) != size:
+      raise GitCoprocessError('{} exited unexpectedly'.format(self.cmd))
+    self.bytes_read += size
+    return data
+
+  def request(self, handler, *args, forks=1):
+    with self.lock:
+      if not self.git_stats:
+        return self.__request(handler, *args, forks=forks)
+
+      start = time.monotonic()
+      self.bytes_read = 0
+      exit_code = 1
+      try:
+        ret = self.__request(handler, *args, forks=forks)
+        exit_code = 0
+        return ret
+      finally:
+        self.git_stats.record(self.args, time.monotonic() - start, exit_code,
+                              self.bytes_read)
+
+  def __request(self, handler, *args, forks=1):
+    self.requests += forks
+    for i in range(0, self.MAX_RESTARTS):
+      if not self.is_alive():
+        if self.proc:
+          logger.warning('Restarting dead coprocess {}'.format(self.cmd))
+        self.stop()
+        self.start()
+      try:
+        return handler(*args)
+      except (OSError, GitCoprocessError) as e:
+        logger.warning('Coprocess {} failed: {}'.format(self.cmd, e))
+        self.proc.kill()
+        self.stop()
+    raise GitCoprocessError('Giving up on {}'.format(self.cmd))
+
+
+def parse_cat_file_header(line):
+  # <sha> <type> <size> for an object, <rev> missing (or ambiguous) otherwise.
+  # The rev is echoed as given and may have spaces in it (ie: HEAD:a b), so a 3
+  # word header is only an object if it looks like one
+  header = line.decode('UTF-8', errors='replace').split()
+  if header and header[-1] in ('missing', 'ambiguous'):
+    return None
+  if (len(header) != 3 or header[1] not in ('blob', 'tree', 'commit', 'tag')
+      or not header[2].isdigit()):
+    return None
+  return (header[0], header[1], int(header[2]))
+
+
+class GitCatFile(GitCoprocess):
+  def __init__(self, git_dir):
+    super().__init__(git_dir, ['cat-file', '--batch'])
+
+  def __read_object(self, rev):
+    self.write_line(rev)
+    header = parse_cat_file_header(self.read_line())
+    # Missing and ambiguous objects have no contents
+    if not header:
+      return None
+    data = self.read_exact(header[2])
+    self.read_exact(1) # newline terminating the contents
+    return (header[0], header[1], data)
+
+  def read_object(self, rev):
+    return self.request(self.__read_object, rev)
+
+
+class GitCatFileCheck(GitCoprocess):
+  def __init__(self, git_dir):
+    super().__init__(git_dir, ['cat-file', '--batch-check'])
+
+  def __check_object(self, rev):
+    self.write_line(rev)
+    return parse_cat_file_header(self.read_line())
+
+  def check_object(self, rev):
+    return self.request(self.__check_object, rev)
+
+
+class GitDiffTree(GitCoprocess):
+  def __init__(self, git_dir, context):
+    # diff-tree echoes (and flushes) any line that isn't an object id, so use
+    # that to mark the end of each commit's output
+    self.sentinel = 'rom-end-of-commit-{}'.format(uuid.uuid4().hex)
+    super().__init__(git_dir, ['diff-tree', '--stdin', '-p', '--cc', '--root',
+                               '--always', '--minimal',
+                               '-U{}'.format(context), r'--format=%B'])
+
+  def __write_shas(self, shas):
+    try:
+      for s in shas:
+        self.write_line(s)
+        self.write_line(self.sentinel)
+    except OSError:
+      pass # The reader will notice git went away
+
+  def __read_patches(self, shas):
+    # Feed git from another thread so a large series can't deadlock on a full
+    # pipe in either direction
+    writer = threading.Thread(target=self.__write_shas, args=(shas,),
+                              daemon=True)
+    writer.start()
+
+    sentinel = self.sentinel.encode('UTF-8')
+    ret = []
+    try:
+      for s in shas:
+        lines = []
+        while True:
+          l = self.read_line()
+          if l == sentinel:
+            break
+          lines.append(l)
+        ret.append(b'\n'.join(lines) + b'\n' if lines else None)
+    finally:
+      writer.join()
+    return ret
+
+  def get_patches(self, shas):
+    return self.request(self.__read_patches, shas, forks=len(shas))
+
+
+class GitObjectStore(object):
+  stores = {}
+  stores_lock = threading.Lock()
+
+  @classmethod
+  def for_git_dir(cls, git_dir):
+    # Reviewers come and go every cycle, keep the coprocesses around for the
+    # lifetime of the daemon instead
+    with cls.stores_lock:
+      store = cls.stores.get(git_dir)
+      if not store:
+        store = cls(git_dir)
+        cls.stores[git_dir] = store
+      return store
+
+  @classmethod
+  def close_all(cls):
+    with cls.stores_lock:
+      for s in cls.stores.values():
+        s.close()
+      cls.stores = {}
+
+  def __init__(self, git_dir):
+    self.git_dir = git_dir
+    self.git_stats = None
+    self.batch = GitCatFile(git_dir)
+    self.batch_check = GitCatFileCheck(git_dir)
+    self.diff_trees = {}
+
+  def coprocesses(self):
+    return [self.batch, self.batch_check] + list(self.diff_trees.values())
+
+  def set_git_stats(self, git_stats):
+    self.git_stats = git_stats
+    for c in self.coprocesses():
+      c.git_stats = git_stats
+
+  def close(self):
+    for c in self.coprocesses():
+      c.stop()
+
+  def forks_saved(self):
+    return sum([c.forks_saved() for c in self.coprocesses()])
+
+  def __valid_rev(self, rev):
+    return bool(rev) and '\n' not in rev
+
+  def resolve(self, rev, obj_type=None):
+    if not self.__valid_rev(rev):
+      return None
+    if obj_type:
+      rev = '{}^{{{}}}'.format(rev, obj_type)
+    obj = self.batch_check.check_object(rev)
+    if not obj:
+      return None
+    return obj[0]
+
+  def has_commit(self, rev):
+    return self.resolve(rev, 'commit') != None
+
+  def read_object(self, rev):
+    if not self.__valid_rev(rev):
+      return None
+    return self.batch.read_object(rev)
+
+  def get_commit_msg(self, rev):
+    obj = self.read_object('{}^{{commit}}'.format(rev))
+    if not obj:
+      return None
+
+    # Commit objects are a header, a blank line, and then the message
+    _,_,msg = obj[2].partition(b'\n\n')
+    return msg.decode('UTF-8', errors='replace')
+
+  def get_patches(self, revs, context):
+    # diff-tree only understands full object ids, so resolve everything first
+    shas = [self.resolve(r, 'commit') for r in revs]
+    to_fetch = [s for s in shas if s]
+    if not to_fetch:
+      return [None] * len(revs)
+
+    diff_tree = self.diff_trees.get(context)
+    if not diff_tree:
+      diff_tree = GitDiffTree(self.git_dir, context)
+      diff_tree.git_stats = self.git_stats
+      self.diff_trees[context] = diff_tree
+    patches = dict(zip(to_fetch, diff_tree.get_patches(to_fetch)))
+
+    # Left as bytes, patches aren't necessarily valid UTF-8
+    return [patches.get(s) or None for s in shas]
+
+atexit.register(GitObjectStore.close_all)
@@ -0,0 +1,111 @@
+import collections
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('rom.gitstats')
+
+class GitCommandStats(object):
+  def __init__(self):
+    self.count = 0
+    self.total_time = 0.0
+    self.max_time = 0.0
+    self.total_bytes = 0
+    # Power of two buckets, keyed by the bucket's upper bound
+    self.time_ms = collections.Counter()
+    self.output_bytes = collections.Counter()
+    self.exit_codes = collections.Counter()
+
+  @staticmethod
+  def bucket(value):
+    ret = 1
+    while ret < value:
+      ret <<= 1
+    return ret
+
+  def add(self, elapsed, exit_code, nbytes):
+    self.count += 1
+    self.total_time += elapsed
+    self.max_time = max(self.max_time, elapsed)
+    self.total_bytes += nbytes
+    self.time_ms[self.bucket(elapsed * 1000)] += 1
+    self.output_bytes[self.bucket(nbytes)] += 1
+    self.exit_codes[exit_code] += 1
+
+  def to_dict(self):
+    # JSON keys have to be strings
+    return {
+      'count': self.count,
+      'total_time': round(self.total_time, 6),
+      'max_time': round(self.max_time, 6),
+      'total_bytes': self.total_bytes,
+      'time_ms': {str(k): v for k,v in sorted(self.time_ms.items())},
+      'output_bytes': {str(k): v for k,v in sorted(self.output_bytes.items())},
+      'exit_codes': {str(k): v for k,v in sorted(self.exit_codes.items())},
+    }
+
+
+class GitStats(object):
+  # Where the time goes in a cycle, by the kind of git command run. Reviewers
+  # only touch this when they're given one, so leaving it out costs nothing.
+  # Requests to the long-lived cat-file and diff-tree coprocesses are counted
+  # one per request, under the command the coprocess runs.
+  CATEGORIES = {
+    'fetch': 'fetch',
+    'show': 'show',
+    'merge-base': 'merge-base',
+    'update-ref': 'update-ref',
+    'cat-file': 'cat-file',
+    'diff-tree': 'diff-tree',
+  }
+
+  def __init__(self, filepath=None):
+    self.filepath = filepath
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.started = time.time()
+      self.commands = collections.defaultdict(GitCommandStats)
+
+  @classmethod
+  def categorize(cls, cmd):
+    if not cmd:
+      return 'other'
+    if cmd[0] == 'log' and any(c.startswith('--grep') for c in cmd):
+      return 'log-grep'
+    return cls.CATEGORIES.get(cmd[0], 'other')
+
+  def record(self, cmd, elapsed, exit_code, nbytes):
+    category = self.categorize(cmd)
+    with self.lock:
+      self.commands[category].add(elapsed, exit_code, nbytes)
+
+  def to_dict(self):
+    with self.lock:
+      return {
+        'started': self.started,
+        'finished': time.time(),
+        'commands': {k: v.to_dict() for k,v in sorted(self.commands.items())},
+      }
+
+  def summarize(self, level):
+    logger.log(level, 'Git commands:')
+    with self.lock:
+      for category,s in sorted(self.commands.items()):
+        failed = s.count - s.exit_codes.get(0, 0)
+        logger.log(level, '   {}: count={} time={:.2f}s max={:.2f}s '
+                          'bytes={} failed={}'.format(category, s.count,
+                                                      s.total_time, s.max_time,
+                                                      s.total_bytes, failed))
+
+  def save(self):
+    # One JSON object per line, one line per cycle
+    if not self.filepath:
+      return
+    logger.debug('Saving git stats to {}'.format(self.filepath))
+    with open(self.filepath, 'at') as f:
+      f.write(json.dumps(self.to_dict(), sort_keys=True))
+      f.write('\n')
@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+import pathlib
+import threading
+import zlib
+
+logger = logging.getLogger('rom.patchcache')
+
+class PatchCache(object):
+  # When the cache overflows, evict down to this fraction of the cap so we
+  # aren't scanning the directory on every insert
+  LOW_WATER_MARK = 0.9
+
+  def __init__(self, path, max_size):
+    self.path = pathlib.Path(path)
+    self.path.mkdir(parents=True, exist_ok=True)
+    self.max_size = max_size
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.size = sum([e.stat().st_size for e in self.__entries()])
+
+  def __entries(self):
+    return self.path.glob('*/*.z')
+
+  def __entry_path(self, sha, kind, context):
+    # Entries are content addressed by the full commit sha, which can never
+    # change. Split on the first byte to keep directories a manageable size
+    return self.path.joinpath(sha[:2], '{}-{}-U{}.z'.format(sha, kind,
+                                                             context))
+
+  def __read(self, sha, kind, context, raw=False):
+    p = self.__entry_path(sha, kind, context)
+    try:
+      data = zlib.decompress(p.read_bytes())
+      if not raw:
+        data = data.decode('UTF-8')
+      os.utime(str(p)) # Bump the mtime, this is what we evict on
+    except FileNotFoundError:
+      self.misses += 1
+      return None
+    except (zlib.error, UnicodeDecodeError, OSError) as e:
+      logger.warning('Dropping bad cache entry {} ({})'.format(p, e))
+      self.__unlink(p)
+      self.misses += 1
+      return None
+
+    self.hits += 1
+    return data
+
+  def __write(self, sha, kind, context, value):
+    p = self.__entry_path(sha, kind, context)
+    if isinstance(value, str):
+      value = value.encode('UTF-8')
+    data = zlib.compress(value)
+    tmp = p.with_name('{}.{}.tmp'.format(p.name, os.getpid()))
+    try:
+      p.parent.mkdir(exist_ok=True)
+      tmp.write_bytes(data)
+      # Other scripts may share this cache, so make the entry appear atomically
+      os.replace(str(tmp), str(p))
+    except OSError as e:
+      logger.error('Could not write cache entry {} ({})'.format(p, e))
+      return
+
+    with self.lock:
+      self.size += len(data)
+      if self.size > self.max_size:
+        self.evict()
+
+  def __unlink(self, p):
+    try:
+      size = p.stat().st_size
+      p.unlink()
+      return size
+    except FileNotFoundError:
+      return 0
+
+  def evict(self):
+    entries = []
+    for e in self.__entries():
+      try:
+        st = e.stat()
+      except FileNotFoundError:
+        continue
+      entries.append((st.st_mtime, st.st_size, e))
+    entries.sort(key=lambda e: e[0])
+
+    self.size = sum([e[1] for e in entries])
+    target = self.max_size * self.LOW_WATER_MARK
+    for _,_,e in entries:
+      if self.size <= target:
+        break
+      self.size -= self.__unlink(e)
+    logger.debug('Evicted patch cache down to {} bytes'.format(self.size))
+
+  def get_patch(self, sha, context):
+    # Patches are kept as raw bytes, they aren't necessarily valid UTF-8
+    return self.__read(sha, 'patch', context, raw=True)
+
+  def put_patch(self, sha, context, patch):
+    self.__write(sha, 'patch', context, patch)
+
+  def get_ranked(self, sha, context):
+    data = self.__read(sha, 'ranked', context)
+    if data == None:
+      return None
+    return json.loads(data)
+
+  def put_ranked(self, sha, context, files):
+    self.__write(sha, 'ranked', context, json.dumps(files))
+
+  def get_fingerprint(self, sha, context):
+    return self.__read(sha, 'fingerprint', context)
+
+  def put_fingerprint(self, sha, context, fingerprint):
+    self.__write(sha, 'fingerprint', context, fingerprint)
+
+  def get_commit_msg(self, sha):
+    return self.__read(sha, 'msg', 0)
+
+  def put_commit_msg(self, sha, msg):
+    self.__write(sha, 'msg', 0, msg)
@@ -0,0 +1,436 @@
+from diffengine import FileDiff
+
+import array
+import bisect
+import email
+import email.header
+import enum
+import hashlib
+import logging
+import re
+
+logger = logging.getLogger('rom.patchmodel')
+
+class LineType(enum.Enum):
+  GITDIFF = 'diff --git '
+  INDEX = 'index '
+  DELETED = 'deleted '
+  ADDED = 'new file mode '
+  FILE_OLD = '--- (?:a/)?(.*)'
+  FILE_NEW = '\+\+\+ (?:b/)?(.*)'
+  CHUNK = '@@ -?([0-9]+),?([0-9]+)? \+?([0-9]+),?([0-9]+)? @@(.*)'
+  DIFF = '[+-]'
+  SIMILARITY = 'similarity index ([0-9]+)%'
+  RENAME = 'rename (from|to) (.*)'
+  CONTEXT = ' '
+  EMPTY = ''
+
+LINE_TYPES = list(LineType)
+LINE_TYPE_CODES = {t: i for i,t in enumerate(LINE_TYPES)}
+DIFF_CODE = LINE_TYPE_CODES[LineType.DIFF]
+CONTEXT_CODE = LINE_TYPE_CODES[LineType.CONTEXT]
+EMPTY_CODE = LINE_TYPE_CODES[LineType.EMPTY]
+LINE_TYPE_REGEX = {t: re.compile(t.value) for t in LineType}
+
+# The first character of a line narrows down which types it could possibly be,
+# in the same order as LineType. Anything not in here is EMPTY.
+LINE_TYPE_DISPATCH = {
+  'd': (LineType.GITDIFF, LineType.DELETED),
+  'i': (LineType.INDEX,),
+  'n': (LineType.ADDED,),
+  '-': (LineType.FILE_OLD, LineType.DIFF),
+  '+': (LineType.FILE_NEW, LineType.DIFF),
+  '@': (LineType.CHUNK,),
+  's': (LineType.SIMILARITY,),
+  'r': (LineType.RENAME,),
+  ' ': (LineType.CONTEXT,),
+}
+
+SPACE = ord(' ')
+MINUS = ord('-')
+PLUS = ord('+')
+HUNK_CHARS = (SPACE, MINUS, PLUS)
+
+def classify_line(line):
+  for t in LINE_TYPE_DISPATCH.get(line[:1], ()):
+    m = LINE_TYPE_REGEX[t].match(line)
+    if m:
+      return (t, m)
+  return (LineType.EMPTY, LINE_TYPE_REGEX[LineType.EMPTY].match(line))
+
+
+def decode_line(line):
+  # Patches aren't always valid UTF-8, don't let that stop a review
+  return str(line, 'UTF-8', errors='replace')
+
+
+FORMAT_PATCH_SUBJECT_RE = re.compile('^\[PATCH[^\]]*\]\s*')
+FORMAT_PATCH_SIGNATURE_RE = re.compile(b'\n-- \n[0-9][^\n]*\n*\Z')
+
+def from_format_patch(data):
+  # Reshapes 'git format-patch' output (ie: gerrit's /patch) into what
+  # 'git show --format=%B' gives, so patches from either source parse the same.
+  # Only the number of context lines can differ.
+  mail = email.message_from_bytes(data)
+  subject = re.sub('\r?\n(?=[ \t])', '', mail.get('Subject', ''))
+  subject = str(email.header.make_header(email.header.decode_header(subject)))
+  subject = FORMAT_PATCH_SUBJECT_RE.sub('', subject)
+  body = mail.get_payload(decode=True) or b''
+
+  if body.startswith(b'diff --git '):
+    diff_start = 0
+  else:
+    diff_start = body.find(b'\ndiff --git ') + 1 or len(body)
+  msg = body[:diff_start]
+  diff = FORMAT_PATCH_SIGNATURE_RE.sub(b'\n', body[diff_start:])
+
+  # The message is followed by '---' and a diffstat
+  if msg.startswith(b'---\n'):
+    msg = b''
+  else:
+    stat_start = msg.rfind(b'\n---\n')
+    if stat_start >= 0:
+      msg = msg[:stat_start + 1]
+
+  ret = subject.encode('UTF-8') + b'\n'
+  if msg.strip():
+    ret += b'\n' + msg.strip(b'\n') + b'\n'
+  return ret + b'\n\n' + diff
+
+
+class PatchBuffer(object):
+  # A patch held as one immutable bytes buffer, along with where each line
+  # starts. Lines are handed out as memoryview slices and are only decoded
+  # when asked.
+  def __init__(self, data):
+    if isinstance(data, str):
+      data = data.encode('UTF-8', errors='replace')
+    self.data = data
+    self.view = memoryview(data)
+    self.offsets = array.array('q', [0])
+    pos = data.find(b'\n')
+    while pos >= 0:
+      self.offsets.append(pos + 1)
+      pos = data.find(b'\n', pos + 1)
+    self.decoded = None
+
+  def num_lines(self):
+    return len(self.offsets)
+
+  def line(self, i):
+    start = self.offsets[i]
+    if i + 1 < len(self.offsets):
+      return self.view[start:self.offsets[i + 1] - 1]
+    return self.view[start:]
+
+  def text(self, i):
+    return decode_line(self.line(i))
+
+  def iter_lines(self, first=0):
+    view = self.view
+    offsets = self.offsets
+    for i in range(first + 1, len(offsets)):
+      yield view[offsets[i - 1]:offsets[i] - 1]
+    if first < len(offsets):
+      yield view[offsets[-1]:]
+
+  def find_line(self, prefix):
+    # Index of the first line starting with prefix, or None
+    if self.data.startswith(prefix):
+      return 0
+    pos = self.data.find(b'\n' + prefix)
+    if pos < 0:
+      return None
+    return bisect.bisect_left(self.offsets, pos + 1)
+
+  def __bool__(self):
+    return bool(self.data)
+
+  def __bytes__(self):
+    return self.data
+
+  def __str__(self):
+    if self.decoded == None:
+      self.decoded = decode_line(self.data)
+    return self.decoded
+
+
+class PatchFile(object):
+  def __init__(self, start):
+    self.start = start
+    self.end = start
+    self.old_name = None
+    self.new_name = None
+    self.hunks = []
+
+  def __str__(self):
+    return '{} -> {} ({} hunks)'.format(self.old_name, self.new_name,
+                                        len(self.hunks))
+
+  def __repr__(self):
+    return self.__str__()
+
+
+class PatchHunk(object):
+  def __init__(self, start, old_start, old_count, new_start, new_count):
+    self.start = start
+    self.old_start = old_start
+    self.old_count = old_count
+    self.new_start = new_start
+    self.new_count = new_count
+
+
+class Patch(object):
+  # Gerrit's /COMMIT_MSG "file" starts with a 6 line header
+  COMMIT_MSG_FILE = '/COMMIT_MSG'
+  COMMIT_MSG_HEADER = 6
+
+  def __init__(self, patch):
+    # patch may be a PatchBuffer, bytes or str, and is never split into copies
+    if not isinstance(patch, PatchBuffer):
+      patch = PatchBuffer(patch)
+    self.buffer = patch
+
+    diff_start = patch.find_line(b'diff --git ')
+    if diff_start == None:
+      diff_start = patch.num_lines()
+    self.first_line = diff_start
+    self.num_lines = patch.num_lines() - diff_start
+
+    # The commit message is small, so it's decoded up front
+    if diff_start:
+      end = patch.offsets[diff_start] - 1 if self.num_lines else None
+      self.commit_msg = decode_line(patch.view[:end])
+      self.commit_msg_lines = self.commit_msg.split('\n')
+    else:
+      self.commit_msg = ''
+      self.commit_msg_lines = []
+    self.types = array.array('B')
+    self.line_nums = array.array('l')
+    self.line_files = array.array('l')
+    self.files = []
+    self.ranked_files = {}
+    self.fingerprints = {}
+    self.__parse()
+
+  def __parse(self):
+    cur_file = None
+    # Index of the file whose '+++ ' line was seen last, line numbers count in
+    # that file until the next one starts
+    name_idx = -1
+    hunk_old = 0
+    hunk_new = 0
+    line_num = self.COMMIT_MSG_HEADER + len(self.commit_msg_lines)
+    types_append = self.types.append
+    nums_append = self.line_nums.append
+    files_append = self.line_files.append
+    for i,l in enumerate(self.lines()):
+      c = l[0] if l else None
+      # Inside a hunk the counts in the chunk header tell us what the line is,
+      # which keeps lines like '--- foo' from being mistaken for file headers
+      if (hunk_old > 0 or hunk_new > 0) and (c in HUNK_CHARS or c == None):
+        # Hunk bodies are nearly every line, so keep this path short
+        if c == MINUS:
+          code = DIFF_CODE
+          hunk_old -= 1
+          if name_idx < 0:
+            line_num += 1
+        elif c == PLUS:
+          code = DIFF_CODE
+          hunk_new -= 1
+          line_num += 1
+        else:
+          # Empty lines in a hunk are context lines mangled by a mailer
+          code = CONTEXT_CODE if l else EMPTY_CODE
+          hunk_old -= 1
+          hunk_new -= 1
+          if l:
+            line_num += 1
+          elif name_idx < 0:
+            line_num += 1
+        if cur_file:
+          cur_file.end = i + 1
+        types_append(code)
+        nums_append(line_num)
+        files_append(name_idx)
+        continue
+
+      hunk_old = hunk_new = 0
+      t,m = self.__classify(l, c)
+
+      if t == LineType.GITDIFF or (t == LineType.FILE_OLD and
+                                   (not cur_file or cur_file.old_name != None)):
+        cur_file = PatchFile(i)
+        self.files.append(cur_file)
+
+      if t == LineType.FILE_OLD:
+        cur_file.old_name = m.group(1)
+
+      if t == LineType.FILE_NEW:
+        if not cur_file or cur_file.new_name != None:
+          cur_file = PatchFile(i)
+          self.files.append(cur_file)
+        cur_file.new_name = m.group(1)
+        name_idx = len(self.files) - 1
+        line_num = 0
+      elif t == LineType.CHUNK:
+        old_count = int(m.group(2)) if m.group(2) != None else 1
+        new_count = int(m.group(4)) if m.group(4) != None else 1
+        if cur_file:
+          cur_file.hunks.append(PatchHunk(i, int(m.group(1)), old_count,
+                                          int(m.group(3)), new_count))
+        hunk_old = old_count
+        hunk_new = new_count
+        # Take away one since we add it back on the first line
+        line_num = int(m.group(3)) - 1
+      # Count up from a chunk, or through the commit message
+      elif (t == LineType.CONTEXT or (t == LineType.DIFF and c == PLUS) or
+            name_idx < 0):
+        line_num += 1
+
+      if cur_file:
+        cur_file.end = i + 1
+      types_append(LINE_TYPE_CODES[t])
+      nums_append(line_num)
+      files_append(name_idx)
+
+  def __classify(self, l, c):
+    # Only lines which could be headers are decoded to find out
+    if c == SPACE:
+      return (LineType.CONTEXT, None)
+    elif c == MINUS and l[:4] != b'--- ':
+      return (LineType.DIFF, None)
+    elif c == PLUS and l[:4] != b'+++ ':
+      return (LineType.DIFF, None)
+    elif c == None or chr(c) not in LINE_TYPE_DISPATCH:
+      return (LineType.EMPTY, None)
+    return classify_line(decode_line(l))
+
+  def line(self, i):
+    return self.buffer.line(self.first_line + i)
+
+  def lines(self):
+    return self.buffer.iter_lines(self.first_line)
+
+  def text(self, i):
+    return self.buffer.text(self.first_line + i)
+
+  def line_type(self, i):
+    return LINE_TYPES[self.types[i]]
+
+  def new_names(self):
+    return [f.new_name for f in self.files if f.new_name]
+
+  def positions(self):
+    # Yields each line along with the gerrit file and line number it maps to,
+    # with the commit message mapped onto gerrit's /COMMIT_MSG
+    line_num = self.COMMIT_MSG_HEADER
+    for l in self.commit_msg_lines:
+      line_num += 1
+      yield (l, self.COMMIT_MSG_FILE, line_num)
+
+    for i in range(self.num_lines):
+      f = self.line_files[i]
+      if f < 0:
+        yield (self.text(i), self.COMMIT_MSG_FILE, self.line_nums[i])
+      else:
+        yield (self.text(i), self.files[f].new_name, self.line_nums[i])
+
+  def ranked(self, max_context):
+    # Strips everything but file names, changed lines, and the last
+    # <max_context> lines of each run of context. Returns a list of FileDiff
+    # where each context line is ranked by its distance from the end of its
+    # run, so the comparison for any smaller context can be had with
+    # diffengine.with_context() rather than stripping again.
+    if max_context in self.ranked_files:
+      return self.ranked_files[max_context]
+
+    ret = []
+    cur = None
+    ctx_buffer = []
+    types = self.types
+    for i,l in enumerate(self.lines()):
+      if not l:
+        continue
+
+      code = types[i]
+      if code == CONTEXT_CODE:
+        ctx_buffer.append(l)
+        continue
+      t = LINE_TYPES[code]
+
+      if ctx_buffer and max_context:
+        if not cur:
+          cur = FileDiff()
+          ret.append(cur)
+        tail = ctx_buffer[-max_context:]
+        cur.lines.extend(tail)
+        cur.ranks.extend(range(len(tail), 0, -1))
+      ctx_buffer = []
+
+      if t == LineType.FILE_OLD:
+        cur = FileDiff(old=self.text(i))
+        ret.append(cur)
+      elif t == LineType.FILE_NEW:
+        # Old always comes before new, anything else is a new file
+        if not cur or cur.new or cur.lines:
+          cur = FileDiff()
+          ret.append(cur)
+        cur.new = self.text(i)
+      elif t == LineType.DIFF:
+        if not cur:
+          cur = FileDiff()
+          ret.append(cur)
+        cur.lines.append(l)
+        cur.ranks.append(0)
+
+    if ctx_buffer and max_context:
+      if not cur:
+        cur = FileDiff()
+        ret.append(cur)
+      tail = ctx_buffer[-max_context:]
+      cur.lines.extend(tail)
+      cur.ranks.extend(range(len(tail), 0, -1))
+
+    self.ranked_files[max_context] = ret
+    return ret
+
+  def fingerprint(self, context):
+    # Like 'git patch-id', but over exactly what ranked() keeps for the given
+    # context (whitespace and all) with the context runs delimited. Two patches
+    # with the same fingerprint compare clean at any context up to <context>.
+    if context in self.fingerprints:
+      return self.fingerprints[context]
+
+    h = hashlib.sha1()
+    ctx_buffer = []
+    types = self.types
+    for i,l in enumerate(self.lines()):
+      if not l:
+        continue
+
+      code = types[i]
+      if code == CONTEXT_CODE:
+        ctx_buffer.append(l)
+        continue
+      t = LINE_TYPES[code]
+
+      if ctx_buffer and context:
+        for c in ctx_buffer[-context:]:
+          h.update(c)
+          h.update(b'\n')
+      h.update(b'\0')
+      ctx_buffer = []
+
+      if t in (LineType.FILE_OLD, LineType.FILE_NEW, LineType.DIFF):
+        h.update(l)
+        h.update(b'\n')
+
+    if ctx_buffer and context:
+      for c in ctx_buffer[-context:]:
+        h.update(c)
+        h.update(b'\n')
+
+    ret = h.hexdigest()
+    self.fingerprints[context] = ret
+    return ret
@@ -0,0 +1,74 @@
+import enum
+import logging
+import threading
+
+logger = logging.getLogger('rom.patchsource')
+
+class PatchSource(enum.Enum):
+  GIT = 'git'
+  REST = 'rest'
+  AUTO = 'auto'
+
+
+class DownstreamPatchSource(object):
+  # Where the gerrit side of a review comes from. GIT fetches the change ref
+  # into the local repo, REST asks gerrit for the formatted patch, and AUTO
+  # picks whichever has been cheaper lately.
+  sources = {}
+  sources_lock = threading.Lock()
+
+  # Weight given to the newest latency sample
+  LATENCY_WEIGHT = 0.3
+  # Every this many AUTO picks, try the other source so a source that was slow
+  # once gets another chance
+  PROBE_INTERVAL = 20
+
+  @classmethod
+  def for_project(cls, name, mode):
+    # Latencies have to survive across cycles to be of any use
+    with cls.sources_lock:
+      src = cls.sources.get(name)
+      if not src:
+        src = cls(name)
+        cls.sources[name] = src
+      src.mode = PatchSource(mode)
+      return src
+
+  def __init__(self, name):
+    self.name = name
+    self.mode = PatchSource.GIT
+    self.lock = threading.Lock()
+    self.latency = {PatchSource.GIT: None, PatchSource.REST: None}
+    self.picks = 0
+
+  def record(self, source, elapsed):
+    with self.lock:
+      last = self.latency[source]
+      if last == None:
+        self.latency[source] = elapsed
+      else:
+        self.latency[source] = (self.LATENCY_WEIGHT * elapsed +
+                                (1 - self.LATENCY_WEIGHT) * last)
+
+  def choose(self, is_local):
+    # is_local: the change ref has already been fetched, nothing beats that
+    if self.mode != PatchSource.AUTO:
+      return self.mode
+    if is_local:
+      return PatchSource.GIT
+
+    with self.lock:
+      self.picks += 1
+      git = self.latency[PatchSource.GIT]
+      rest = self.latency[PatchSource.REST]
+      if git == None:
+        return PatchSource.GIT
+      if rest == None:
+        return PatchSource.REST
+
+      ret = PatchSource.GIT if git <= rest else PatchSource.REST
+      if self.picks % self.PROBE_INTERVAL == 0:
+        ret = PatchSource.REST if ret == PatchSource.GIT else PatchSource.GIT
+      logger.debug('{} patch source {} (git={:.2f}s rest={:.2f}s)'.format(
+                      self.name, ret.value, git, rest))
+      return ret
@@ -1,12 +1,14 @@
 #!/usr/bin/python3
 
 from patchwork import PatchworkPatch
+from patchcache import PatchCache
 from reviewer import Reviewer
 from trollconfig import TrollConfigPatchwork
 
 import argparse
 import logging
 from logging import handlers
+import pathlib
 import re
 import sys
 import urllib
@@ -29,13 +31,22 @@ def main():
   parser.add_argument('--git-dir', default=None, help='Path to git directory')
   parser.add_argument('--verbose', help='print commits', action='store_true')
   parser.add_argument('--chatty', help='print diffs', action='store_true')
+  parser.add_argument('--cache-dir', default=None,
+                      help='Path to the upstream patch cache')
+  parser.add_argument('--cache-size', default=512, type=int,
+                      help='Maximum size of the patch cache in megabytes')
   parser.add_argument('--commit', help='commit hash to find related patches',
                       required=True)
   args = parser.parse_args()
 
   setup_logging(args)
 
-  reviewer = Reviewer(args.verbose, args.chatty, git_dir=args.git_dir)
+  patch_cache = None
+  if args.cache_dir:
+    patch_cache = PatchCache(pathlib.Path(args.cache_dir, 'patches'),
+                             args.cache_size * 1024 * 1024)
+  reviewer = Reviewer(args.verbose, args.chatty, git_dir=args.git_dir,
+                      patch_cache=patch_cache)
   links = reviewer.get_links_from_local_sha(args.commit)
 
   series = None
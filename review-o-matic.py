@@ -2,19 +2,25 @@
 
 import argparse
 import logging
+import pathlib
 import re
 import subprocess
 import sys
 
-from reviewer import Reviewer
+from patchcache import PatchCache
+from reviewer import CommitRef, Reviewer
 
-logger = logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logger = logging.getLogger('rom')
 
-def review_change(reviewer, local_sha):
-  upstream_sha = reviewer.get_cherry_pick_sha_from_local_sha(local_sha)
-  upstream_patch = reviewer.get_commit_from_sha(upstream_sha)
-  local_patch = reviewer.get_commit_from_sha(local_sha)
-  result = reviewer.compare_diffs(upstream_patch, local_patch)
+def review_change(reviewer, local_sha, upstream_sha, local_patch,
+                  upstream_patch):
+  if (reviewer.get_fingerprint(upstream_patch, sha=upstream_sha) ==
+      reviewer.get_fingerprint(local_patch, sha=local_sha)):
+    result = []
+  else:
+    result = reviewer.compare_diffs(upstream_patch, local_patch,
+                                    a_sha=upstream_sha, b_sha=local_sha)
 
   if reviewer.verbose or reviewer.chatty or len(result):
     logger.info('Reviewing %s (rmt=%s)' % (local_sha, upstream_sha[:11]))
@@ -35,6 +41,10 @@ def main():
   parser.add_argument('--prefix', default='UPSTREAM', help='subject prefix')
   parser.add_argument('--verbose', help='print commits', action='store_true')
   parser.add_argument('--chatty', help='print diffs', action='store_true')
+  parser.add_argument('--cache-dir', default=None,
+                      help='Path to the upstream patch cache')
+  parser.add_argument('--cache-size', default=512, type=int,
+                      help='Maximum size of the patch cache in megabytes')
   args = parser.parse_args()
 
   if args.verbose or args.chatty:
@@ -44,14 +54,30 @@ def main():
           ['git', 'log', '--oneline', '%s^..' % args.start])
 
   regex = re.compile('([0-9a-f]*) (%s): ' % (args.prefix), flags=re.I)
-  ret = 0
-  reviewer = Reviewer(args.verbose, args.chatty)
+  patch_cache = None
+  if args.cache_dir:
+    patch_cache = PatchCache(pathlib.Path(args.cache_dir, 'patches'),
+                             args.cache_size * 1024 * 1024)
+  reviewer = Reviewer(args.verbose, args.chatty, patch_cache=patch_cache)
+  local_shas = []
+  upstream_shas = []
   for l in reversed(proc.decode('UTF-8').split('\n')):
-    this_ret = 0
     m = regex.match(l)
     if m:
-      this_ret = review_change(reviewer, m.group(1))
-    ret += this_ret
+      local_shas.append(m.group(1))
+      upstream_shas.append(
+              reviewer.get_cherry_pick_sha_from_local_sha(m.group(1)))
+
+  # Stream every patch through one git process instead of forking per commit
+  refs = [CommitRef(sha=s) for s in local_shas + upstream_shas]
+  patches = reviewer.get_commits_from_shas(refs)
+  local_patches = patches[:len(local_shas)]
+  upstream_patches = patches[len(local_shas):]
+
+  ret = 0
+  for i,local_sha in enumerate(local_shas):
+    ret += review_change(reviewer, local_sha, upstream_shas[i],
+                         local_patches[i] or '', upstream_patches[i] or '')
 
   return ret
 
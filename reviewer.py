@@ -1,31 +1,22 @@
-import difflib
-import enum
+from asyncreviewer import AsyncReviewer, CallType, GitLoop
+import diffengine
+from diffengine import FileDiff
+from gitfetch import FetchManager
+from gitindex import FixesIndex, PatchIdIndex, ReachabilityIndex
+from gitprocess import GitCoprocessError, GitObjectStore
+import patchmodel
+from patchmodel import LineType, Patch, PatchBuffer
+from trailers import parse_trailers
+
+import collections
 import logging
 import re
 import subprocess
 import sys
+import time
 
 logger = logging.getLogger('rom.reviewer')
 
-class LineType(enum.Enum):
-  GITDIFF = 'diff --git '
-  INDEX = 'index '
-  DELETED = 'deleted '
-  ADDED = 'new file mode '
-  FILE_OLD = '--- (?:a/)?(.*)'
-  FILE_NEW = '\+\+\+ (?:b/)?(.*)'
-  CHUNK = '@@ -?([0-9]+),?([0-9]+)? \+?([0-9]+),?([0-9]+)? @@(.*)'
-  DIFF = '[+-]'
-  SIMILARITY = 'similarity index ([0-9]+)%'
-  RENAME = 'rename (from|to) (.*)'
-  CONTEXT = ' '
-  EMPTY = ''
-
-class CallType(enum.Enum):
-  CHECK_OUTPUT = 0
-  CHECK_CALL = 1
-  CALL = 2
-
 class CommitRef(object):
   def __init__(self, sha, remote=None, branch=None, tag=None):
     self.sha = sha
@@ -64,213 +55,212 @@ class CommitRef(object):
 
   @staticmethod
   def refs_from_patch(patch):
-    # Helper pattern to match any character that isn't whitespace or )
-    non_ws = '[^\)^\s]'
-
-    # This has pattern has gotten a bit hard to parse, so i'll do my best.
-
-    # Start with an opening paren and allow for whitespace
-    pattern = '\((?:\s*)'
-
-    # This is pretty easy, look the "cherry picked from commit" string taking
-    # into account space or dash between cherry and picked, and allowing for
-    # multiple spaces after commit.
-    pattern += 'cherry.picked from commit\s*'
-
-    # Then we grab the hexidecimal hash string. Everything after this is
-    # optional.
-    pattern += '([0-9a-f]*)'
-
-    # Wrap the optional group in parens
-    pattern += '('
-
-    # Optionally gobble up everything (including newlines) until we hit the next
-    # group. This allows for extra fluff in between the hash and URL (like an
-    # extra 'from' as seen in http://crosreview.com/1537900). Instead of just .*
-    # explicitly forbid matching ) since it could go looking through the source
-    # for a URL (like in http://crosreview.com/1544916). Finally, use a
-    # non-greedy algorithm to avoid gobbling the URL.
-    pattern += '[^\)]*?'
-
-    # This will match the remote url. It's pretty simple, just matches any
-    # protocol (git://, http://, https://, madeup://) and then match all
-    # non-whitespace characters, this is our remote.
-    pattern += '([a-z]*\://{nws}*)'.format(nws=non_ws)
-
-    # Now that we have the URL, eat any whitespace again
-    pattern += '\s*'
-
-    # The next run of non-whitespace characters could either be 'tag' or the
-    # remote branch. Make it optional in case they want to use the default
-    # remote branch
-    pattern += '({nws}*)?'.format(nws=non_ws)
-
-    # Eat more whitespace, yum!
-    pattern += '\s*'
-
-    # Finally, if this is a tag, parse the tag name
-    pattern += '({nws}*)?'.format(nws=non_ws)
-
-    # Close the optional paren around remote/branch
-    pattern += ')?'
-
-    # Finally, account for any trailing whitespace
-    pattern += '\s*'
-
-    # Close the paren
-    pattern += '\)'
-
-    regex = re.compile(pattern, flags=(re.I | re.MULTILINE | re.DOTALL))
-    m = regex.findall(patch)
-    if not m or not len(m):
+    trailers = parse_trailers(patch)
+    if not trailers.cherry_picks:
       return None
 
     ret = []
-    for s in m:
-      if s[3] == 'tag' and s[4]:
-        ret.append(CommitRef(sha=s[0], remote=s[2], tag=s[4]))
+    for c in trailers.cherry_picks:
+      if c.tag:
+        ret.append(CommitRef(sha=c.sha, remote=c.remote, tag=c.tag))
       else:
-        ret.append(CommitRef(sha=s[0], remote=s[2], branch=s[3]))
-
+        ret.append(CommitRef(sha=c.sha, remote=c.remote, branch=c.branch))
     return ret
 
   @staticmethod
   def links_from_patch(patch):
-    pattern = '\s*Link:\s+(\S+)'
-    regex = re.compile(pattern)
-    m = regex.findall(patch)
-    if not m or not len(m):
+    trailers = parse_trailers(patch)
+    if not trailers.links:
       return None
-
-    ret = []
-    for s in m:
-      ret.append(s)
-    return ret
+    return list(trailers.links)
 
 class Reviewer(object):
   MAX_CONTEXT = 5
-
-  def __init__(self, verbose=False, chatty=False, git_dir=None):
+  # Gerrit refs fetched ahead of review live under here, by remote
+  GERRIT_REF_AREA = 'refs/rom'
+  # Keeps the fetch command line a sane length
+  MAX_GERRIT_REFSPECS = 256
+  # Parsed patches are kept around so each consumer of a patch shares one parse
+  MAX_PARSED_PATCHES = 16
+
+  def __init__(self, verbose=False, chatty=False, git_dir=None,
+               patch_cache=None, fetch_ttl=0, index_dir=None,
+               compare_time_limit=0, compare_size_limit=0, compare_workers=0,
+               compare_parallel_lines=0, diff_memo_size=0, git_stats=None,
+               max_git_procs=None):
     self.verbose = verbose
     self.chatty = chatty
     self.git_dir = git_dir
-    if git_dir:
-      self.git_cmd = ['git', '-C', git_dir ]
-    else:
-      self.git_cmd = ['git']
-
-  def __strip_commit_msg(self, patch):
-    regex = re.compile('diff --git ')
-    for i, l in enumerate(patch):
-      if regex.match(l):
-        return patch[i:]
+    self.patch_cache = patch_cache
+    self.index_dir = index_dir
+    # Budget for comparing a single change, in seconds and stripped lines. Past
+    # either one, only a per-file summary is produced. 0 means no limit
+    self.compare_time_limit = compare_time_limit
+    self.compare_size_limit = compare_size_limit
+    # Patches with more stripped lines than this are compared across a pool of
+    # compare_workers processes
+    self.compare_workers = compare_workers
+    self.compare_parallel_lines = compare_parallel_lines
+    # Optional GitStats to record every git command run
+    self.git_stats = git_stats
+    self.diff_memo = None
+    if diff_memo_size:
+      self.diff_memo = diffengine.DiffMemo.get_shared(diff_memo_size)
+    self.objects = GitObjectStore.for_git_dir(git_dir)
+    if git_stats:
+      self.objects.set_git_stats(git_stats)
+    self.fetches = FetchManager.for_git_dir(git_dir, fetch_ttl)
+    self.parsed_patches = collections.OrderedDict()
+    # Everything that forks git runs on the async core, the methods here only
+    # wait for it
+    self.core = AsyncReviewer(git_dir=git_dir, fetches=self.fetches,
+                              git_stats=git_stats,
+                              commit_lookup=self.get_commits_from_shas,
+                              max_git_procs=max_git_procs)
+    self.git_cmd = self.core.git_cmd
+
+  def forks_saved(self):
+    return self.objects.forks_saved()
+
+  def cacheable_sha(self, sha):
+    # Only commits named by hash are immutable, refs can move under us
+    if not self.patch_cache or not sha or not re.fullmatch('[0-9a-f]{7,40}',
+                                                           sha, flags=re.I):
+      return None
+    try:
+      return self.objects.resolve(sha, 'commit')
+    except GitCoprocessError as e:
+      logger.error('Could not resolve {}: ({})'.format(sha, e))
+      return None
 
   def classify_line(self, line):
-    for t in LineType:
-      m = re.match(t.value, line)
-      if m:
-        return (t,m)
-    return None
-
-  def __strip_kruft(self, diff, context):
-    ret = []
-    ignore = [LineType.CHUNK, LineType.GITDIFF, LineType.INDEX,
-              LineType.DELETED, LineType.ADDED, LineType.SIMILARITY,
-              LineType.RENAME, LineType.EMPTY]
-    include = [LineType.FILE_NEW, LineType.FILE_OLD, LineType.DIFF]
-    ctx_buffer = []
-    for l in diff:
-      if not l:
-        continue
+    return patchmodel.classify_line(line)
 
-      l_type,_ = self.classify_line(l)
-
-      if self.chatty:
-        logger.debug('%s- "%s"' % (l_type, l))
-
-      if not l_type:
-        logger.error('Could not classify line "{}"'.format(l))
-        ctx_buffer = []
-        continue
+  def parse_patch(self, patch):
+    if isinstance(patch, Patch):
+      return patch
 
-      if l_type == LineType.CONTEXT:
-        ctx_buffer.append(l)
-        continue
-
-      # If we want to include context in the diffs, include the last N lines of
-      # context we've collected
-      if ctx_buffer and context:
-        ret.extend(ctx_buffer[-context:])
-
-      ctx_buffer = []
-
-      if l_type in ignore:
-        continue
-      elif l_type in include:
-        ret.append(l)
-      else:
-        logger.error('line_type not handled {}: {}'.format(l_type, l))
+    ret = self.parsed_patches.get(patch)
+    if ret:
+      self.parsed_patches.move_to_end(patch)
+      return ret
 
-    if ctx_buffer and context:
-      ret.extend(ctx_buffer[-context:])
+    ret = Patch(patch)
+    if self.chatty:
+      for i in range(ret.num_lines):
+        logger.debug('%s- "%s"' % (ret.line_type(i), ret.text(i)))
 
+    self.parsed_patches[patch] = ret
+    while len(self.parsed_patches) > self.MAX_PARSED_PATCHES:
+      self.parsed_patches.popitem(last=False)
     return ret
 
   def git(self, cmd, call_type, stdout=subprocess.DEVNULL,
-          stderr=subprocess.DEVNULL, skip_err=False):
-    run_cmd = self.git_cmd + cmd
-    logger.debug('GIT: {}'.format(' '.join(run_cmd)))
-    if call_type == CallType.CHECK_OUTPUT:
-      return subprocess.check_output(run_cmd, stderr=stderr).decode('UTF-8')
-    elif call_type == CallType.CHECK_CALL:
-      try:
-        subprocess.check_call(run_cmd, stdout=stdout, stderr=stderr)
-        return 0
-      except subprocess.CalledProcessError as e:
-        if not skip_err:
-          logger.exception('Exception running git: {}'.format(e))
-          logger.error('FAIL: {}'.format(' '.join(run_cmd)))
-          raise
-        return e.returncode
-    elif call_type == CallType.CALL:
-      subprocess.call(run_cmd, stdout=stdout, stderr=stderr)
-    else:
-      raise ValueError('Invalid call type {}'.format(call_type))
-    return None
+          stderr=subprocess.DEVNULL, skip_err=False, input=None, raw=False):
+    return GitLoop.run(self.core.git(cmd, call_type, stdout=stdout,
+                                     stderr=stderr, skip_err=skip_err,
+                                     input=input, raw=raw))
+
+  def log_fixes(self, revs):
+    cmd = ['log', '-i', '--grep', 'Fixes:', r'--format=%x01%H%x00%h %s%x00%B']
+    cmd += revs
+    # This is the whole history, a single body that isn't UTF-8 can't be allowed
+    # to sink every lookup
+    return self.git(cmd, CallType.CHECK_OUTPUT, raw=True).decode('UTF-8',
+                                                                errors='replace')
 
   def find_fixes_reference(self, ref):
+    index = FixesIndex.lookup(self.git_dir, ref.refs(True))
+    if index:
+      try:
+        return index.find(self, ref.sha)
+      except (GitCoprocessError, subprocess.CalledProcessError) as e:
+        logger.error('Fixes index lookup failed {}: ({})'.format(str(ref), e))
+
     cmd = ['log', '--format=oneline', '--abbrev-commit', '-i', '--grep',
            'Fixes:.*{}'.format(ref.sha[:8]), '{}..{}'.format(ref.sha,
                                                              ref.refs(True))]
     return self.git(cmd, CallType.CHECK_OUTPUT)
 
-  def get_am_from_from_patch(self, patch):
-    regex = re.compile('\(am from (http.*)\)', flags=re.I)
-    m = regex.findall(patch)
-    if not m or not len(m):
+  def patch_ids(self, revs, max_count=None):
+    # Generate the patches the same way as get_commit_from_sha, otherwise the
+    # context lines won't hash the same
+    cmd = self.git_cmd + ['log', '-p', '--no-merges', '--minimal',
+                          '-U{}'.format(self.MAX_CONTEXT), r'--format=commit %H']
+    if max_count:
+      cmd.append('--max-count={}'.format(max_count))
+    cmd += revs
+    id_cmd = self.git_cmd + ['patch-id', '--stable']
+    logger.debug('GIT: {} | {}'.format(' '.join(cmd), ' '.join(id_cmd)))
+
+    start = time.monotonic()
+    log = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL)
+    patch_id = subprocess.Popen(id_cmd, stdin=log.stdout,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+    log.stdout.close()
+    out = patch_id.communicate()[0].decode('UTF-8')
+    log.wait()
+    if self.git_stats:
+      self.git_stats.record(cmd[len(self.git_cmd):], time.monotonic() - start,
+                            log.returncode, len(out))
+    if log.returncode != 0:
+      raise subprocess.CalledProcessError(log.returncode, cmd)
+
+    ret = []
+    for l in out.splitlines():
+      ids = l.split()
+      if len(ids) == 2:
+        ret.append((ids[0], ids[1]))
+    return ret
+
+  def get_patch_id(self, patch):
+    cmd = ['patch-id', '--stable']
+    if not isinstance(patch, PatchBuffer):
+      patch = PatchBuffer(patch)
+    out = self.git(cmd, CallType.CHECK_OUTPUT, input=bytes(patch))
+    if not out:
       return None
-    return m
+    return out.split()[0]
 
-  def add_or_update_remote(self, ref):
-    cmd = ['remote', 'set-url', ref.remote_name, ref.remote]
-    ret = self.git(cmd, CallType.CHECK_CALL, skip_err=True)
-    if ret == 0:
-      return
+  def find_upstream_by_patch(self, patch):
+    indexes = PatchIdIndex.for_git_dir(self.git_dir)
+    if not indexes:
+      return None
 
-    cmd = ['remote', 'add', ref.remote_name, ref.remote]
-    ret = self.git(cmd, CallType.CHECK_CALL)
-    if ret != 0:
-      logger.error('Failed to add remote {} ({})', str(ref), ret)
+    patch_id = self.get_patch_id(patch)
+    if not patch_id:
+      return None
 
-  def fetch_remote(self, ref):
-    logger.debug('Fetching {}'.format(str(ref)))
+    self.fetch_remotes([i.ref for i in indexes])
+    for i in indexes:
+      sha = i.find(self, patch_id)
+      if sha:
+        return CommitRef(sha=sha, remote=i.ref.remote, branch=i.ref.branch)
+    return None
 
-    self.add_or_update_remote(ref)
+  def find_fixes_references(self, refs):
+    ret = {}
+    for r in refs:
+      ret[r.sha] = self.find_fixes_reference(r)
+    return ret
 
-    cmd = ['fetch', '--prune', '--tags', ref.remote_name, ref.refs()]
-    ret = self.git(cmd, CallType.CHECK_CALL, skip_err=True)
-    if ret != 0:
-      logger.error('Fetch remote ({}) failed: ({})'.format(str(ref), ret))
+  def get_am_from_from_patch(self, patch):
+    ret = [a for a in parse_trailers(patch).am_from
+           if a.lower().startswith('http')]
+    if not ret:
+      return None
+    return ret
+
+  def add_or_update_remote(self, ref):
+    return GitLoop.run(self.core.add_or_update_remote(ref))
+
+  def fetch_remotes(self, refs, force=False):
+    return GitLoop.run(self.core.fetch_remotes(refs, force=force))
+
+  def fetch_remote(self, ref, force=False):
+    return self.fetch_remotes([ref], force=force)
 
   def checkout(self, ref):
     cmd = ['checkout', ref]
@@ -285,7 +275,26 @@ class Reviewer(object):
     self.git(cmd, CallType.CALL)
 
   def get_commit_msg_from_sha(self, sha):
-    cmd = ['log', '-1', sha]
+    # Returns the bare message, like 'git log -1 --format=%B'. Plain 'git log
+    # -1' used to add a commit/Author/Date header and indent the message, none
+    # of which the callers' cherry-pick and Link: patterns ever depended on.
+    full_sha = self.cacheable_sha(sha)
+    if full_sha:
+      msg = self.patch_cache.get_commit_msg(full_sha)
+      if msg != None:
+        return msg
+
+    try:
+      msg = self.objects.get_commit_msg(sha)
+      if msg != None:
+        if full_sha:
+          self.patch_cache.put_commit_msg(full_sha, msg)
+        return msg
+    except GitCoprocessError as e:
+      logger.error('Could not read commit {}: ({})'.format(sha, e))
+
+    # Fall back to forking git so we get its error handling for free
+    cmd = ['log', '-1', '--format=%B', sha]
     return self.git(cmd, CallType.CHECK_OUTPUT, stderr=None)
 
   def get_cherry_pick_sha_from_local_sha(self, local_sha):
@@ -293,7 +302,7 @@ class Reviewer(object):
 
     # Use the last SHA found in the patch, since it's (probably) most recent,
     # and only return the SHA, not the remote/branch
-    return CommitRef.refs_from_patch(commit_message)[-1]['sha']
+    return CommitRef.refs_from_patch(commit_message)[-1].sha
 
   def get_links_from_local_sha(self, local_sha):
     commit_message = self.get_commit_msg_from_sha(local_sha)
@@ -309,7 +318,44 @@ class Reviewer(object):
     ret = self.git(cmd, CallType.CHECK_OUTPUT, stderr=None).strip()
     return ret.splitlines()
 
+  def track_branch(self, remote, branch, monotonic=False):
+    ref = CommitRef(sha='', remote=remote, branch=branch)
+    return ReachabilityIndex.track(self.git_dir, ref.refs(True), monotonic)
+
+  def track_patch_ids(self, remote, branch, depth=None):
+    ref = CommitRef(sha='', remote=remote, branch=branch)
+    return PatchIdIndex.track(self.git_dir, ref, self.index_dir, depth)
+
+  def track_fixes(self, remote, branch):
+    ref = CommitRef(sha='', remote=remote, branch=branch)
+    return FixesIndex.track(self.git_dir, ref.refs(True), self.index_dir)
+
+  def rev_list(self, revs):
+    cmd = ['rev-list'] + revs
+    return self.git(cmd, CallType.CHECK_OUTPUT)
+
+  def is_ancestor(self, ancestor, descendant):
+    cmd = ['merge-base', '--is-ancestor', ancestor, descendant]
+    return self.git(cmd, CallType.CHECK_CALL, skip_err=True) == 0
+
   def is_sha_in_branch(self, ref, skip_err=False):
+    # Tracked branches answer from their reachability index without a walk
+    index = ReachabilityIndex.lookup(self.git_dir, ref.refs(True))
+    if index:
+      try:
+        return index.contains(self, ref.sha)
+      except (GitCoprocessError, subprocess.CalledProcessError) as e:
+        logger.error('Index lookup failed {}: ({})'.format(str(ref), e))
+
+    # merge-base will fail on unknown objects, skip the fork if we already
+    # know the answer
+    try:
+      if (not self.objects.has_commit(ref.sha) or
+          not self.objects.has_commit(ref.refs(True))):
+        return False
+    except GitCoprocessError as e:
+      logger.error('Could not look up {}: ({})'.format(str(ref), e))
+
     cmd = ['merge-base', '--is-ancestor', ref.sha, ref.refs(True)]
     try:
       ret = self.git(cmd, CallType.CHECK_CALL, skip_err=True)
@@ -320,12 +366,39 @@ class Reviewer(object):
         logger.exception('Exception checking sha: {}'.format(e))
         raise
 
-  def get_commit_from_sha(self, ref):
-    cmd = ['show', '--minimal', '-U{}'.format(self.MAX_CONTEXT), r'--format=%B',
-           ref.sha]
-    ret = self.git(cmd, CallType.CHECK_OUTPUT, stderr=None)
+  def get_commits_from_shas(self, refs):
+    ret = [None] * len(refs)
+    full_shas = [self.cacheable_sha(r.sha) for r in refs]
+    to_fetch = []
+    for i,s in enumerate(full_shas):
+      if s:
+        p = self.patch_cache.get_patch(s, self.MAX_CONTEXT)
+        if p != None:
+          ret[i] = PatchBuffer(p)
+      if ret[i] == None:
+        to_fetch.append(i)
+
+    if not to_fetch:
+      return ret
+
+    try:
+      patches = self.objects.get_patches([refs[i].sha for i in to_fetch],
+                                         self.MAX_CONTEXT)
+    except GitCoprocessError as e:
+      logger.error('Could not stream commits {}: ({})'.format(refs, e))
+      return ret
+
+    for i,p in zip(to_fetch, patches):
+      if p == None:
+        continue
+      ret[i] = PatchBuffer(p)
+      if full_shas[i]:
+        self.patch_cache.put_patch(full_shas[i], self.MAX_CONTEXT, p)
     return ret
 
+  def get_commit_from_sha(self, ref):
+    return GitLoop.run(self.core.get_commit_from_sha(ref, self.MAX_CONTEXT))
+
   def strip_special(self, string):
     return re.sub('([a-z]*\://)|\W', '', string, flags=re.I)
 
@@ -341,7 +414,67 @@ class Reviewer(object):
     cmd = ['update-ref', '-d', ref]
     self.git(cmd, CallType.CHECK_CALL)
 
+  def gerrit_local_ref(self, remote, ref):
+    # Where fetch_gerrit_refs() keeps a gerrit ref (ie: refs/changes/..)
+    if ref.startswith('refs/'):
+      ref = ref[len('refs/'):]
+    return '{}/{}/{}'.format(self.GERRIT_REF_AREA, self.strip_special(remote),
+                             ref)
+
+  def fetch_gerrit_refs(self, remote, refs):
+    # Fetches a batch of gerrit refs up front, a few fetches with many refspecs
+    # rather than one fetch per change. Patchset refs never move, so anything
+    # already here is skipped.
+    missing = collections.OrderedDict()
+    for r in refs:
+      if not self.has_gerrit_ref(remote, r):
+        missing[r] = self.gerrit_local_ref(remote, r)
+    missing = list(missing.items())
+
+    ret = True
+    for i in range(0, len(missing), self.MAX_GERRIT_REFSPECS):
+      batch = missing[i:i + self.MAX_GERRIT_REFSPECS]
+      logger.debug('Fetching {} gerrit refs from {}'.format(len(batch),
+                                                            remote))
+      cmd = ['fetch', '--no-tags', remote]
+      cmd += ['+{}:{}'.format(r, local) for r,local in batch]
+      if self.git(cmd, CallType.CHECK_CALL, skip_err=True) != 0:
+        # Most likely a ref went away, whatever didn't make it will be fetched
+        # on its own when it's reviewed
+        logger.error('Batch fetch of gerrit refs from {} failed'.format(remote))
+        ret = False
+    return ret
+
+  def prune_gerrit_refs(self, remote, keep):
+    # Drops fetched gerrit refs not in <keep> so the ref area doesn't grow
+    # forever
+    area = '{}/{}/'.format(self.GERRIT_REF_AREA, self.strip_special(remote))
+    cmd = ['for-each-ref', '--format=%(refname)', area]
+    existing = set(self.git(cmd, CallType.CHECK_OUTPUT).split())
+    stale = existing - set([self.gerrit_local_ref(remote, r) for r in keep])
+    if not stale:
+      return
+
+    logger.debug('Dropping {} stale gerrit refs'.format(len(stale)))
+    input = ''.join(['delete {}\n'.format(r) for r in sorted(stale)])
+    self.git(['update-ref', '--stdin'], CallType.CHECK_OUTPUT,
+             input=input.encode('UTF-8'))
+
+  def has_gerrit_ref(self, remote, ref):
+    try:
+      return self.objects.has_commit(self.gerrit_local_ref(remote, ref))
+    except GitCoprocessError as e:
+      logger.error('Could not resolve {}: ({})'.format(ref, e))
+      return False
+
   def get_commit_from_remote(self, remote, ref):
+    try:
+      sha = self.objects.resolve(self.gerrit_local_ref(remote, ref), 'commit')
+      if sha:
+        return self.get_commit_from_sha(CommitRef(sha=sha))
+    except GitCoprocessError as e:
+      logger.error('Could not resolve {}: ({})'.format(ref, e))
+
     tmp_ref = self.fetch_to_tmp_ref(remote, ref)
 
     ret = self.get_commit_from_sha(CommitRef(sha=tmp_ref))
@@ -349,51 +482,70 @@ class Reviewer(object):
     self.delete_ref(tmp_ref)
     return ret
 
-  def compare_diffs(self, a, b, context=0):
+  def rank_patch(self, patch, sha=None):
+    # Every context we compare with comes from this one stripped form
+    full_sha = self.cacheable_sha(sha)
+    if full_sha:
+      files = self.patch_cache.get_ranked(full_sha, self.MAX_CONTEXT)
+      if files != None:
+        ret = []
+        for old,new,lines,ranks in files:
+          f = FileDiff(old=old, new=new)
+          f.lines = [l.encode('UTF-8', errors='surrogateescape') for l in lines]
+          f.ranks = ranks
+          ret.append(f)
+        return ret
+
+    ret = self.parse_patch(patch).ranked(self.MAX_CONTEXT)
+
+    if full_sha:
+      # Lines are bytes, escape whatever isn't UTF-8 so it survives JSON
+      files = []
+      for f in ret:
+        lines = [str(l, 'UTF-8', errors='surrogateescape') for l in f.lines]
+        files.append([f.old, f.new, lines, list(f.ranks)])
+      self.patch_cache.put_ranked(full_sha, self.MAX_CONTEXT, files)
+    return ret
+
+  def strip_patch(self, patch, context, sha=None):
     if context > self.MAX_CONTEXT:
       raise ValueError('Invalid context given')
+    return diffengine.with_context(self.rank_patch(patch, sha=sha), context)
 
-    a = a.split('\n')
-    b = b.split('\n')
-
-    # strip the commit messages
-    a = self.__strip_commit_msg(a) or []
-    b = self.__strip_commit_msg(b) or []
-    a = self.__strip_kruft(a, context)
-    b = self.__strip_kruft(b, context)
-
-    files = {'new': '', 'old': ''}
-    printed_files = False
-
-    ret = []
-    differ = difflib.Differ()
-    for l in differ.compare(a, b):
-      # strip the differ margin for analyzing the line
-      line = l[2:]
-
-      # if this is a file line, save the file for later printing
-      l_type,_ = self.classify_line(line)
-      if l_type == LineType.FILE_OLD:
-        files['old'] = line
-        continue # old always comes before new, so loop around to pick up new
-      elif l_type == LineType.FILE_NEW:
-        files['new'] = line
-        printed_files = False
-
-      # discard the differ '?' helper and unchanged lines
-      if l[0] == '?' or not l[:2].strip():
-        continue
+  def get_fingerprint(self, patch, sha=None):
+    full_sha = self.cacheable_sha(sha)
+    if full_sha:
+      ret = self.patch_cache.get_fingerprint(full_sha, self.MAX_CONTEXT)
+      if ret != None:
+        return ret
 
-      if not printed_files:
-        ret.append(files['old'])
-        ret.append(files['new'])
-        printed_files = True
+    ret = self.parse_patch(patch).fingerprint(self.MAX_CONTEXT)
 
-      # don't double print files
-      if l_type == LineType.FILE_NEW or l_type == LineType.FILE_OLD:
-        continue
+    if full_sha:
+      self.patch_cache.put_fingerprint(full_sha, self.MAX_CONTEXT, ret)
+    return ret
 
-      # add the change to the diff
-      ret.append(l)
+  def iter_diffs(self, a, b, context=0, a_sha=None, b_sha=None, deadline=None):
+    # Returns a DiffStream, which only does as much diffing as is read from it
+    if context > self.MAX_CONTEXT:
+      raise ValueError('Invalid context given')
 
-    return ret
+    a = self.strip_patch(a, context, sha=a_sha)
+    b = self.strip_patch(b, context, sha=b_sha)
+
+    size = sum([len(f.lines) for f in a]) + sum([len(f.lines) for f in b])
+    summarize = False
+    if self.compare_size_limit and size > self.compare_size_limit:
+      logger.info('Diff too large ({} lines), summarizing'.format(size))
+      summarize = True
+
+    pool = None
+    if (self.compare_workers > 1 and size > self.compare_parallel_lines and
+        max(len(a), len(b)) > 1):
+      pool = diffengine.ComparePool.get(self.compare_workers)
+    return diffengine.DiffStream(a, b, deadline=deadline, summarize=summarize,
+                                 pool=pool)
+
+  def compare_diffs(self, a, b, context=0, a_sha=None, b_sha=None):
+    return list(self.iter_diffs(a, b, context=context, a_sha=a_sha,
+                                b_sha=b_sha))
@@ -0,0 +1,64 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+HAVE_GIT = shutil.which('git') != None
+
+class ScratchRepo(object):
+  # A throwaway git repository for tests which need a real one
+  ENV = dict(os.environ, GIT_AUTHOR_NAME='A Person',
+             GIT_AUTHOR_EMAIL='a@example.com', GIT_COMMITTER_NAME='A Person',
+             GIT_COMMITTER_EMAIL='a@example.com', GIT_CONFIG_NOSYSTEM='1',
+             HOME=tempfile.gettempdir())
+
+  def __init__(self, path):
+    self.path = path
+    subprocess.check_call(['git', 'init', '-q', '-b', 'master', path],
+                          env=self.ENV)
+    self.counter = 0
+
+  def git(self, *args, raw=False, input=None):
+    out = subprocess.check_output(['git', '-C', self.path] + list(args),
+                                  env=self.ENV, stderr=subprocess.DEVNULL,
+                                  input=input)
+    if raw:
+      return out
+    return out.decode('UTF-8').strip()
+
+  def commit(self, msg, name='f.c', text=None):
+    # Each commit changes a file, so every one has a patch of its own
+    self.counter += 1
+    if text == None:
+      text = 'change {}\n'.format(self.counter)
+    path = os.path.join(self.path, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    mode = 'wb' if isinstance(text, bytes) else 'wt'
+    with open(path, mode) as f:
+      f.write(text)
+    self.git('add', name)
+    if isinstance(msg, bytes):
+      subprocess.run(['git', '-C', self.path, 'commit', '-q', '-F', '-'],
+                     input=msg, env=self.ENV, check=True)
+    else:
+      self.git('commit', '-q', '-m', msg)
+    return self.git('rev-parse', 'HEAD')
+
+  def commit_raw(self, msg):
+    # git commit re-encodes messages to UTF-8, this stores msg (bytes) as is,
+    # like history imported from elsewhere
+    self.counter += 1
+    tree = self.git('write-tree')
+    obj = 'tree {}\nparent {}\nauthor {} <{}> {} +0000\n'.format(
+            tree, self.rev_parse('HEAD'), self.ENV['GIT_AUTHOR_NAME'],
+            self.ENV['GIT_AUTHOR_EMAIL'], 1500000000 + self.counter)
+    obj += 'committer {} <{}> {} +0000\n\n'.format(
+             self.ENV['GIT_COMMITTER_NAME'], self.ENV['GIT_COMMITTER_EMAIL'],
+             1500000000 + self.counter)
+    sha = self.git('hash-object', '-t', 'commit', '-w', '--stdin',
+                   input=obj.encode('UTF-8') + msg)
+    self.git('update-ref', 'HEAD', sha)
+    return sha
+
+  def rev_parse(self, rev):
+    return self.git('rev-parse', rev)
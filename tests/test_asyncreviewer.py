@@ -0,0 +1,159 @@
+from asyncreviewer import AsyncReviewer, CallType, GitLoop
+from gitstats import GitStats
+from reviewer import CommitRef, Reviewer
+from tests.scratch import HAVE_GIT, ScratchRepo
+import asyncreviewer
+
+import asyncio
+import hashlib
+import os
+import subprocess
+import tempfile
+import unittest
+import unittest.mock
+
+@unittest.skipUnless(HAVE_GIT, 'needs git')
+class AsyncReviewerTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.repo = ScratchRepo(os.path.join(self.tmp.name, 'repo'))
+    self.shas = [self.repo.commit('commit {}'.format(i)) for i in range(3)]
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_git(self):
+    core = AsyncReviewer(git_dir=self.repo.path)
+    out = GitLoop.run(core.git(['rev-parse', 'HEAD'], CallType.CHECK_OUTPUT))
+    self.assertEqual(out.strip(), self.shas[-1])
+    raw = GitLoop.run(core.git(['rev-parse', 'HEAD'], CallType.CHECK_OUTPUT,
+                               raw=True))
+    self.assertEqual(raw, (self.shas[-1] + '\n').encode('UTF-8'))
+    out = GitLoop.run(core.git(['hash-object', '--stdin'],
+                               CallType.CHECK_OUTPUT, input=b'x\n'))
+    self.assertEqual(out.strip(),
+                     hashlib.sha1(b'blob 2\0x\n').hexdigest())
+
+  def test_exit_codes(self):
+    core = AsyncReviewer(git_dir=self.repo.path)
+    bad = ['rev-parse', '--verify', '-q', 'nope']
+    self.assertEqual(GitLoop.run(core.git(bad, CallType.CALL)), 1)
+    self.assertEqual(GitLoop.run(core.git(bad, CallType.CHECK_CALL,
+                                          skip_err=True)), 1)
+    with self.assertLogs('rom.asyncreviewer', level='ERROR'):
+      with self.assertRaises(subprocess.CalledProcessError):
+        GitLoop.run(core.git(bad, CallType.CHECK_CALL))
+    with self.assertRaises(subprocess.CalledProcessError):
+      GitLoop.run(core.git(bad, CallType.CHECK_OUTPUT))
+    with self.assertRaises(ValueError):
+      GitLoop.run(core.git(bad, 'bogus'))
+
+  def test_bounded_concurrency(self):
+    # Many requests at once, never more than max_git_procs running git
+    core = AsyncReviewer(git_dir=self.repo.path, max_git_procs=2)
+    running = [0, 0]
+    real_exec = asyncio.create_subprocess_exec
+
+    async def counting_exec(*args, **kwargs):
+      running[0] += 1
+      running[1] = max(running)
+      try:
+        await asyncio.sleep(0.01)
+        return await real_exec(*args, **kwargs)
+      finally:
+        running[0] -= 1
+
+    async def many():
+      return await asyncio.gather(*[core.git(['rev-parse', s],
+                                             CallType.CHECK_OUTPUT)
+                                    for s in self.shas * 4])
+
+    with unittest.mock.patch.object(asyncreviewer.asyncio,
+                                    'create_subprocess_exec', counting_exec):
+      out = GitLoop.run(many())
+    self.assertEqual([o.strip() for o in out], self.shas * 4)
+    self.assertEqual(running[1], 2)
+
+  def test_no_blocking_on_the_loop(self):
+    core = AsyncReviewer(git_dir=self.repo.path)
+    async def nested():
+      return GitLoop.run(core.git(['rev-parse', 'HEAD'], CallType.CALL))
+    with self.assertRaises(RuntimeError):
+      GitLoop.run(nested())
+
+  def test_git_stats(self):
+    stats = GitStats()
+    rev = Reviewer(git_dir=self.repo.path, git_stats=stats)
+    rev.git(['show', 'HEAD'], CallType.CHECK_OUTPUT)
+    rev.git(['merge-base', '--is-ancestor', 'HEAD', 'HEAD~1'],
+            CallType.CHECK_CALL, skip_err=True)
+    commands = stats.to_dict()['commands']
+    self.assertEqual(commands['show']['count'], 1)
+    self.assertEqual(commands['merge-base']['exit_codes'], {'1': 1})
+
+
+@unittest.skipUnless(HAVE_GIT, 'needs git')
+class SyncWrapperTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.upstream = ScratchRepo(os.path.join(self.tmp.name, 'upstream'))
+    self.local = ScratchRepo(os.path.join(self.tmp.name, 'local'))
+    self.shas = [self.upstream.commit('upstream {}'.format(i))
+                 for i in range(3)]
+    self.ref = CommitRef(sha=self.shas[1], remote=self.upstream.path,
+                         branch='master')
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_fetch_and_show(self):
+    rev = Reviewer(git_dir=self.local.path)
+    self.assertTrue(rev.fetch_remote(self.ref))
+    self.assertEqual(self.local.rev_parse(self.ref.refs(True)), self.shas[-1])
+    self.assertTrue(rev.is_sha_in_branch(self.ref))
+
+    patch = rev.get_commit_from_sha(self.ref)
+    expected = self.upstream.git('show', '--minimal', '-U5', '--format=%B',
+                                 self.shas[1], raw=True)
+    self.assertEqual(bytes(patch), expected)
+
+  def test_fetch_bad_ref(self):
+    # A bad ref in the batch doesn't stop the others from being fetched
+    self.upstream.git('branch', 'other', self.shas[0])
+    rev = Reviewer(git_dir=self.local.path, fetch_ttl=600)
+    refs = [CommitRef(sha=self.shas[1], remote=self.upstream.path, branch=b)
+            for b in ('master', 'gone', 'other')]
+    with self.assertLogs('rom.asyncreviewer', level='ERROR'):
+      self.assertFalse(rev.fetch_remotes(refs))
+    self.assertEqual(self.local.rev_parse(refs[0].refs(True)), self.shas[-1])
+    self.assertEqual(self.local.rev_parse(refs[2].refs(True)), self.shas[0])
+    self.assertTrue(rev.is_sha_in_branch(refs[0]))
+
+    # Only the bad one is stale
+    skipped = rev.fetches.skipped
+    self.assertTrue(rev.fetch_remotes([refs[0], refs[2]]))
+    self.assertEqual(rev.fetches.skipped, skipped + 1)
+    with self.assertLogs('rom.asyncreviewer', level='ERROR'):
+      self.assertFalse(rev.fetch_remote(refs[1]))
+
+  def test_async_matches_sync(self):
+    rev = Reviewer(git_dir=self.local.path)
+    async def both():
+      await rev.core.fetch_remote(self.ref)
+      return await asyncio.gather(
+                  *[rev.core.get_commit_from_sha(CommitRef(sha=s), 5)
+                    for s in self.shas])
+    patches = GitLoop.run(both())
+    self.assertEqual([bytes(p) for p in patches],
+                     [bytes(rev.get_commit_from_sha(CommitRef(sha=s)))
+                      for s in self.shas])
+
+  def test_fallback_show(self):
+    # Nothing the object store can stream, so git show's error comes through
+    rev = Reviewer(git_dir=self.local.path)
+    with self.assertRaises(subprocess.CalledProcessError):
+      rev.get_commit_from_sha(CommitRef(sha='0' * 40))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,333 @@
+from diffengine import ComparePool, DiffMemo, DiffStream, FileDiff
+from diffengine import compare_files, opcodes, with_context
+import diffengine
+
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import difflib
+import os
+import random
+import time
+import unittest
+
+def make_file(name, lines, old=None):
+  f = FileDiff(old='--- a/{}'.format(old or name), new='+++ b/{}'.format(name))
+  f.lines = list(lines)
+  f.ranks = [0] * len(f.lines)
+  return f
+
+
+# How compare_diffs worked before the diff engine, over the stripped lines of
+# both patches with the file names inline
+def baseline_compare(a_files, b_files):
+  def flatten(files):
+    ret = []
+    for f in files:
+      ret += [f.old, f.new] + f.lines
+    return ret
+
+  files = {'new': '', 'old': ''}
+  printed_files = False
+  ret = []
+  for l in difflib.Differ().compare(flatten(a_files), flatten(b_files)):
+    line = l[2:]
+    if line.startswith('--- '):
+      files['old'] = line
+      continue
+    elif line.startswith('+++ '):
+      files['new'] = line
+      printed_files = False
+    if l[0] == '?' or not l[:2].strip():
+      continue
+    if not printed_files:
+      ret.append(files['old'])
+      ret.append(files['new'])
+      printed_files = True
+    if line.startswith('+++ '):
+      continue
+    ret.append(l)
+  return ret
+
+
+def lcs_len(a, b):
+  prev = [0] * (len(b) + 1)
+  for x in a:
+    cur = [0]
+    for j,y in enumerate(b):
+      cur.append(prev[j] + 1 if x == y else max(prev[j + 1], cur[j]))
+    prev = cur
+  return prev[-1]
+
+
+def apply_opcodes(a, b, ops):
+  ret = []
+  i = 0
+  j = 0
+  for tag,i1,i2,j1,j2 in ops:
+    assert (i1, j1) == (i, j), 'opcodes must be contiguous'
+    if tag == 'equal':
+      assert a[i1:i2] == b[j1:j2]
+      ret += a[i1:i2]
+    else:
+      ret += b[j1:j2]
+    i = i2
+    j = j2
+  assert (i, j) == (len(a), len(b))
+  return ret
+
+
+def random_lines(rand, n, alphabet=6):
+  return ['line {}'.format(rand.randrange(alphabet)) for i in range(n)]
+
+
+def edit(rand, lines):
+  # One localized change, the kind a backport picks up
+  ret = list(lines)
+  pos = rand.randint(0, len(ret))
+  kind = rand.choice(['insert', 'delete', 'replace'])
+  if kind != 'insert' and pos < len(ret):
+    del ret[pos:pos + rand.randint(1, 3)]
+  if kind != 'delete':
+    ret[pos:pos] = ['new {}'.format(rand.random()) for i in range(2)]
+  return ret
+
+
+class OpcodesTest(unittest.TestCase):
+  def test_reconstructs(self):
+    rand = random.Random(8)
+    for i in range(200):
+      a = random_lines(rand, rand.randint(0, 30))
+      b = random_lines(rand, rand.randint(0, 30))
+      self.assertEqual(apply_opcodes(a, b, list(opcodes(a, b))), b)
+
+  def test_myers_is_minimal(self):
+    rand = random.Random(9)
+    for i in range(200):
+      a = random_lines(rand, rand.randint(0, 20), alphabet=3)
+      b = random_lines(rand, rand.randint(0, 20), alphabet=3)
+      matches = diffengine._myers_matches(a, 0, len(a), b, 0, len(b))
+      self.assertEqual(len(matches), lcs_len(a, b))
+      for x,y in matches:
+        self.assertEqual(a[x], b[y])
+
+  def test_swapped_blocks(self):
+    # Unique lines anchor the match, so only those are reported rather than
+    # a whole block moving past the other
+    a = ['{', 'foo', '}', '{', 'bar', '}']
+    b = ['{', 'bar', '}', '{', 'foo', '}']
+    ops = list(opcodes(a, b))
+    changed = [op for op in ops if op[0] != 'equal']
+    self.assertEqual(sum(i2 - i1 for _,i1,i2,_,_ in changed), 2)
+    self.assertEqual(sum(j2 - j1 for _,_,_,j1,j2 in changed), 2)
+    self.assertEqual(apply_opcodes(a, b, ops), b)
+
+  def test_deadline(self):
+    a = ['a'] * 10
+    b = ['b'] * 10
+    with self.assertRaises(diffengine.DiffTimeout):
+      list(opcodes(a, b, deadline=time.monotonic() - 1))
+
+
+class CompareTest(unittest.TestCase):
+  def test_clean(self):
+    files = [make_file('a.c', ['+x', '-y']), make_file('b.c', ['+z'])]
+    self.assertEqual(compare_files(files, files), [])
+    self.assertEqual(baseline_compare(files, files), [])
+
+  def test_matches_baseline(self):
+    rand = random.Random(10)
+    for i in range(200):
+      a = [make_file('f{}.c'.format(n), random_lines(rand, 20, alphabet=50))
+           for n in range(3)]
+      b = [make_file(f.new[6:], f.lines) for f in a]
+      which = rand.randrange(len(b))
+      b[which].lines = edit(rand, b[which].lines)
+      self.assertEqual(sorted(compare_files(a, b)),
+                       sorted(baseline_compare(a, b)))
+
+  def test_renamed_file(self):
+    a = [make_file('old.c', ['+x'])]
+    b = [make_file('new.c', ['+x'], old='old.c')]
+    self.assertEqual(compare_files(a, b),
+                     ['--- a/old.c', '+++ b/old.c', '--- a/old.c',
+                      '+++ b/new.c'])
+    # The old comparison flagged these too
+    self.assertTrue(baseline_compare(a, b))
+    b[0].lines = ['+y']
+    self.assertEqual(compare_files(a, b),
+                     ['--- a/old.c', '+++ b/old.c', '--- a/old.c',
+                      '+++ b/new.c', '- +x', '+ +y'])
+
+  def test_different_path(self):
+    # Upstream's hunks applied to another file aren't a clean backport
+    a = [make_file('x/foo.c', ['+x', '-y'])]
+    b = [make_file('y/foo.c', ['+x', '-y'])]
+    self.assertEqual(compare_files(a, b),
+                     ['--- a/x/foo.c', '+++ b/x/foo.c', '--- a/y/foo.c',
+                      '+++ b/y/foo.c'])
+    # The old comparison flagged these too
+    self.assertTrue(baseline_compare(a, b))
+    self.assertTrue(DiffStream(a, b))
+    summary = DiffStream(a, b, summarize=True)
+    self.assertEqual(list(summary), compare_files(a, b))
+
+  def test_missing_file(self):
+    a = [make_file('a.c', ['+x']), make_file('b.c', ['+y'])]
+    b = [make_file('a.c', ['+x'])]
+    self.assertEqual(compare_files(a, b), ['--- a/b.c', '+++ b/b.c', '- +y'])
+
+  def test_bytes_lines(self):
+    a = [make_file('a.c', [b'+x', memoryview(b'+\xff')])]
+    b = [make_file('a.c', [b'+x'])]
+    self.assertEqual(compare_files(a, b), ['--- a/a.c', '+++ b/a.c', '- +�'])
+
+
+class WithContextTest(unittest.TestCase):
+  def test_with_context(self):
+    f = make_file('a.c', [' c3', ' c2', ' c1', '+x'])
+    f.ranks = [3, 2, 1, 0]
+    self.assertEqual(with_context([f], 0)[0].lines, ['+x'])
+    self.assertEqual(with_context([f], 2)[0].lines, [' c2', ' c1', '+x'])
+    self.assertEqual(with_context([f], 5)[0].lines, f.lines)
+
+
+class DiffStreamTest(unittest.TestCase):
+  def setUp(self):
+    rand = random.Random(11)
+    self.a = [make_file('f{}.c'.format(n), random_lines(rand, 30, 40))
+              for n in range(5)]
+    self.b = [make_file(f.new[6:], edit(rand, f.lines)) for f in self.a]
+    self.full = compare_files(self.a, self.b)
+
+  def test_rewalk(self):
+    d = DiffStream(self.a, self.b)
+    self.assertTrue(d)
+    self.assertEqual(list(d), self.full)
+    self.assertEqual(list(d), self.full)
+    self.assertTrue(d.is_complete())
+
+  def test_lazy(self):
+    d = DiffStream(self.a, self.b)
+    next(iter(d))
+    self.assertFalse(d.done)
+    self.assertLess(len(d.lines), len(self.full))
+
+  def test_omitted(self):
+    # Lines left in the file being read are counted, later files aren't diffed
+    ends = [i for i,l in enumerate(self.full) if l.startswith('--- a/')][1:]
+    ends.append(len(self.full))
+    for shown in range(0, len(self.full) + 1):
+      d = DiffStream(self.a, self.b)
+      lines = [l for _,l in zip(range(shown), d)]
+      self.assertEqual(lines, self.full[:shown])
+      cur = len([e for e in ends if e < shown])
+      if shown == 0:
+        cur = -1
+      left,files = d.omitted(shown)
+      end = ends[cur] if cur >= 0 else 0
+      self.assertEqual((left, files), (end - shown, len(ends) - cur - 1))
+      self.assertFalse(d.is_complete())
+
+  def test_summarize(self):
+    d = DiffStream(self.a, self.b, summarize=True)
+    lines = list(d)
+    self.assertTrue(d.degraded)
+    self.assertFalse(d.timed_out)
+    changed = [f for f,g in zip(self.a, self.b) if f.lines != g.lines]
+    self.assertEqual(len(lines), 3 * len(changed))
+
+  def test_deadline(self):
+    d = DiffStream(self.a, self.b, deadline=time.monotonic() - 1)
+    list(d)
+    self.assertTrue(d.degraded)
+    self.assertTrue(d.timed_out)
+    self.assertFalse(d.is_complete())
+
+  def test_pool(self):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as pool:
+      self.assertEqual(list(DiffStream(self.a, self.b, pool=pool)), self.full)
+
+
+class ComparePoolTest(unittest.TestCase):
+  # The real thing, lines go through pickling to worker processes and back
+  def setUp(self):
+    rand = random.Random(12)
+    # memoryview lines, as they come out of a parsed patch
+    def view(lines):
+      return [memoryview(l.encode('UTF-8')) for l in lines]
+    self.a = [make_file('f{}.c'.format(n), view(random_lines(rand, 30, 40)))
+              for n in range(4)]
+    self.b = [make_file(f.new[6:], view(edit(rand, [bytes(l).decode()
+                                                    for l in f.lines])))
+              for f in self.a]
+    self.full = compare_files(self.a, self.b)
+
+  def tearDown(self):
+    ComparePool.shutdown()
+
+  def break_pool(self, pool):
+    with self.assertRaises(BrokenProcessPool):
+      pool.submit(os._exit, 1).result()
+
+  def test_process_pool(self):
+    pool = ComparePool.get(2)
+    d = DiffStream(self.a, self.b, pool=pool)
+    self.assertEqual(list(d), self.full)
+    self.assertTrue(d.is_complete())
+    self.assertIs(ComparePool.get(2), pool)
+
+  def test_broken_before_submit(self):
+    pool = ComparePool.get(2)
+    self.break_pool(pool)
+    with self.assertLogs('rom.diffengine', level='WARNING'):
+      self.assertEqual(list(DiffStream(self.a, self.b, pool=pool)), self.full)
+    new_pool = ComparePool.get(2)
+    self.assertIsNot(new_pool, pool)
+    self.assertEqual(list(DiffStream(self.a, self.b, pool=new_pool)),
+                     self.full)
+
+  def test_broken_while_diffing(self):
+    # The one worker dies once the files are queued up behind it
+    pool = ComparePool.get(1)
+    pool.submit(time.sleep, 0.3)
+    dying = pool.submit(os._exit, 1)
+    d = DiffStream(self.a, self.b, pool=pool)
+    with self.assertRaises(BrokenProcessPool):
+      dying.result()
+    with self.assertLogs('rom.diffengine', level='WARNING'):
+      self.assertEqual(list(d), self.full)
+    self.assertIsNot(ComparePool.get(1), pool)
+
+
+class DiffMemoTest(unittest.TestCase):
+  def test_round_trip(self):
+    a = [make_file('a.c', ['+x'])]
+    b = [make_file('a.c', ['+y'])]
+    memo = DiffMemo(2)
+    d = DiffStream(a, b)
+    self.assertFalse(memo.put('k', d))
+    list(d)
+    self.assertTrue(memo.put('k', d))
+    got = memo.get('k')
+    self.assertEqual(list(got), list(d))
+    self.assertIsNot(memo.get('k'), got)
+    self.assertEqual(memo.get('missing'), None)
+
+  def test_rejects_degraded(self):
+    a = [make_file('a.c', ['+x'])]
+    b = [make_file('a.c', ['+y'])]
+    memo = DiffMemo(2)
+    d = DiffStream(a, b, summarize=True)
+    list(d)
+    self.assertFalse(memo.put('k', d))
+
+  def test_evicts(self):
+    memo = DiffMemo(2)
+    for k in range(3):
+      memo.put(k, DiffStream.from_lines([str(k)]))
+    self.assertEqual(memo.get(0), None)
+    self.assertEqual(list(memo.get(2)), ['2'])
+
+
+if __name__ == '__main__':
+  unittest.main()
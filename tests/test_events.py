@@ -0,0 +1,191 @@
+from events import EventListener, FileEventSource, SshEventSource
+from events import parse_event, source_for
+import events
+
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+# Trimmed down from what gerrit stream-events sends
+PATCHSET_CREATED = {
+  'type': 'patchset-created',
+  'change': {'project': 'chromiumos/third_party/kernel',
+             'branch': 'chromeos-5.4', 'id': 'I0123',
+             'number': 1234567, 'subject': 'UPSTREAM: foo: Fix bar',
+             'url': 'https://chromium-review.googlesource.com/1234567',
+             'status': 'NEW'},
+  'patchSet': {'number': 3, 'revision': 'abcdef',
+               'ref': 'refs/changes/67/1234567/3'},
+  'uploader': {'name': 'A Person'},
+  'eventCreatedOn': 1600000000,
+}
+
+COMMENT_ADDED = dict(PATCHSET_CREATED, type='comment-added',
+                     comment='Patch Set 3:\n\nrecheck')
+CHANGE_MERGED = dict(PATCHSET_CREATED, type='change-merged')
+
+def line(event):
+  return json.dumps(event) + '\n'
+
+
+class ParseEventTest(unittest.TestCase):
+  def test_patchset_created(self):
+    e = parse_event(line(PATCHSET_CREATED))
+    self.assertEqual(e, events.GerritEvent(
+                            type=events.PATCHSET_CREATED,
+                            project='chromiumos/third_party/kernel',
+                            branch='chromeos-5.4', number=1234567,
+                            subject='UPSTREAM: foo: Fix bar', revision=3,
+                            comment=''))
+
+  def test_bytes(self):
+    self.assertEqual(parse_event(line(COMMENT_ADDED).encode('UTF-8')),
+                     parse_event(line(COMMENT_ADDED)))
+    self.assertEqual(parse_event(line(COMMENT_ADDED)).comment,
+                     'Patch Set 3:\n\nrecheck')
+
+  def test_closed(self):
+    e = parse_event(line(CHANGE_MERGED))
+    self.assertIn(e.type, events.CLOSED_TYPES)
+    self.assertEqual(e.number, 1234567)
+
+  def test_string_number(self):
+    e = dict(PATCHSET_CREATED)
+    e['change'] = dict(e['change'], number='1234567')
+    e['patchSet'] = {'number': '3'}
+    self.assertEqual(parse_event(line(e)), parse_event(line(PATCHSET_CREATED)))
+
+  def test_ignored(self):
+    for l in ['', '\n', '  ', line(dict(PATCHSET_CREATED, type='ref-updated')),
+              line({'no': 'type'})]:
+      self.assertEqual(parse_event(l), None, l)
+
+  def test_malformed(self):
+    no_change = dict(PATCHSET_CREATED)
+    del no_change['change']
+    bad_number = dict(PATCHSET_CREATED)
+    bad_number['change'] = dict(bad_number['change'], number='abc')
+    for l in ['{not json', '[1, 2]', '"a string"', line(no_change),
+              line(bad_number), b'\xff\xfe\n',
+              line(dict(PATCHSET_CREATED, patchSet='3'))]:
+      with self.assertLogs('rom.events', level='WARNING'):
+        self.assertEqual(parse_event(l), None, l)
+
+
+class SourceTest(unittest.TestCase):
+  def test_source_for(self):
+    self.assertIsInstance(source_for('ssh://u@host:1234'), SshEventSource)
+    self.assertIsInstance(source_for('file:/tmp/x'), FileEventSource)
+    self.assertEqual(source_for('file:/tmp/x').path, '/tmp/x')
+    self.assertEqual(source_for('fifo:/tmp/y').path, '/tmp/y')
+    with self.assertRaises(ValueError):
+      source_for('http://host')
+
+  def test_ssh_cmd(self):
+    cmd = SshEventSource('ssh://bot@review.example.com').cmd()
+    self.assertEqual(cmd[:8], ['ssh', '-o', 'BatchMode=yes', '-o',
+                               'ServerAliveInterval=30', '-p', '29418',
+                               'bot@review.example.com'])
+    self.assertEqual(cmd[8:10], ['gerrit', 'stream-events'])
+    for t in events.EVENT_TYPES:
+      self.assertIn(t, cmd)
+    self.assertEqual(str(SshEventSource('ssh://h:1')), 'ssh://h:1')
+
+
+class FileEventSourceTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.tmp.name, 'events.log')
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def write(self, data, mode='ab'):
+    with open(self.path, mode) as f:
+      f.write(data)
+
+  def source(self, from_start=False):
+    s = FileEventSource(self.path, from_start=from_start)
+    s.POLL_INTERVAL = 0.01
+    return s
+
+  def test_from_start(self):
+    self.write(b'one\ntwo\n')
+    lines = self.source(from_start=True).lines()
+    self.assertEqual([next(lines), next(lines)], [b'one\n', b'two\n'])
+
+  def test_follows_from_end(self):
+    self.write(b'old\n')
+    lines = self.source().lines()
+    # Nothing is read until the generator runs, so start it on an empty tail
+    t = threading.Timer(0.2, self.write, args=(b'new\n',))
+    t.start()
+    self.assertEqual(next(lines), b'new\n')
+    t.join()
+
+  def test_partial_line(self):
+    self.write(b'{"type": ')
+    lines = self.source(from_start=True).lines()
+    t = threading.Timer(0.2, self.write, args=(b'"x"}\n',))
+    t.start()
+    self.assertEqual(next(lines), b'{"type": "x"}\n')
+    t.join()
+
+  def test_rotation(self):
+    self.write(b'a\n')
+    lines = self.source(from_start=True).lines()
+    self.assertEqual(next(lines), b'a\n')
+
+    def rotate():
+      os.rename(self.path, self.path + '.1')
+      self.write(b'b\n')
+    t = threading.Timer(0.2, rotate)
+    t.start()
+    self.assertEqual(next(lines), b'b\n')
+    t.join()
+
+  def test_truncation(self):
+    self.write(b'aaaa\n')
+    lines = self.source(from_start=True).lines()
+    self.assertEqual(next(lines), b'aaaa\n')
+    t = threading.Timer(0.2, self.write, args=(b'b\n', 'wb'))
+    t.start()
+    self.assertEqual(next(lines), b'b\n')
+    t.join()
+
+  def test_missing_file(self):
+    lines = self.source().lines()
+    # Anything in a file that shows up later is new
+    t = threading.Timer(0.2, self.write, args=(b'c\n',))
+    t.start()
+    self.assertEqual(next(lines), b'c\n')
+    t.join()
+
+
+class ListSource(events.EventSource):
+  def __init__(self, lines):
+    super().__init__()
+    self.data = lines
+
+  def lines(self):
+    for l in self.data:
+      yield l
+    threading.Event().wait()
+
+
+class EventListenerTest(unittest.TestCase):
+  def test_wait(self):
+    listener = EventListener(ListSource([line(PATCHSET_CREATED), 'junk',
+                                         line(CHANGE_MERGED)]))
+    listener.SETTLE_TIME = 0.05
+    listener.start()
+    batch = listener.wait(5)
+    self.assertEqual([e.type for e in batch],
+                     [events.PATCHSET_CREATED, events.CHANGE_MERGED])
+    self.assertEqual(listener.wait(0.01), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,401 @@
+from gitindex import FixesIndex, PatchIdIndex, ReachabilityIndex, ShaTable
+from reviewer import CommitRef, Reviewer
+from tests.scratch import HAVE_GIT, ScratchRepo
+
+import os
+import pathlib
+import shutil
+import json
+import subprocess
+import tempfile
+import unittest
+import unittest.mock
+
+class FakeObjects(object):
+  def __init__(self, history):
+    self.history = history
+
+  def resolve(self, rev, obj_type=None):
+    return self.history[-1][0] if self.history else None
+
+
+class FakeReviewer(object):
+  # A linear history of (sha, patch_id), oldest first
+  def __init__(self, history):
+    self.history = history
+    self.objects = FakeObjects(history)
+    self.calls = []
+
+  def is_ancestor(self, ancestor, descendant):
+    shas = [s for s,_ in self.history]
+    return (ancestor in shas and descendant in shas and
+            shas.index(ancestor) <= shas.index(descendant))
+
+  def patch_ids(self, revs, max_count=None):
+    self.calls.append((revs, max_count))
+    shas = [s for s,_ in self.history]
+    if '..' in revs[0]:
+      old,new = revs[0].split('..')
+      commits = self.history[shas.index(old) + 1:shas.index(new) + 1]
+    else:
+      commits = self.history[:shas.index(revs[0]) + 1]
+    commits = list(reversed(commits))[:max_count]
+    return [(p, s) for s,p in commits]
+
+
+class PatchIdIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.ref = CommitRef(sha='', remote='git://example.com/linux.git',
+                         branch='master')
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def index(self, depth=None, path=None):
+    return PatchIdIndex(self.ref, path, depth)
+
+  def test_find(self):
+    rev = FakeReviewer([('a', '1'), ('b', '2'), ('c', '3')])
+    index = self.index()
+    self.assertEqual(index.find(rev, '2'), 'b')
+    self.assertEqual(index.find(rev, '4'), None)
+
+  def test_newest_wins(self):
+    # The same patch applied twice, the newest commit is suggested
+    rev = FakeReviewer([('a', '1'), ('b', '2'), ('c', '1')])
+    self.assertEqual(self.index().find(rev, '1'), 'c')
+
+  def test_extends(self):
+    rev = FakeReviewer([('a', '1'), ('b', '2')])
+    index = self.index()
+    self.assertEqual(index.find(rev, '2'), 'b')
+    rev.history.append(('c', '3'))
+    rev.history.append(('d', '2'))
+    self.assertEqual(index.find(rev, '3'), 'c')
+    self.assertEqual(index.find(rev, '2'), 'd')
+    self.assertEqual(index.find(rev, '1'), 'a')
+    self.assertEqual(rev.calls, [(['b'], None), (['b..d'], None)])
+
+  def test_rebuilds_on_rewind(self):
+    rev = FakeReviewer([('a', '1'), ('b', '2')])
+    index = self.index()
+    index.find(rev, '1')
+    rev.history[:] = [('a', '1'), ('x', '9')]
+    self.assertEqual(index.find(rev, '2'), None)
+    self.assertEqual(index.find(rev, '9'), 'x')
+
+  def test_depth(self):
+    rev = FakeReviewer([('a', '1'), ('b', '2'), ('c', '3')])
+    index = self.index(depth=2)
+    self.assertEqual(index.find(rev, '1'), None)
+    self.assertEqual(index.find(rev, '2'), 'b')
+
+  def test_round_trip(self):
+    path = pathlib.Path(self.tmp.name, 'patchid.json')
+    rev = FakeReviewer([('a', '1'), ('b', '2')])
+    index = self.index(path=path)
+    index.find(rev, '1')
+    loaded = self.index(path=path)
+    self.assertEqual((loaded.tip, loaded.patch_ids),
+                     (index.tip, index.patch_ids))
+    # Nothing new since it was saved, so no git at all
+    rev.calls = []
+    self.assertEqual(loaded.find(rev, '2'), 'b')
+    self.assertEqual(rev.calls, [])
+
+  def test_malformed(self):
+    path = pathlib.Path(self.tmp.name, 'patchid.json')
+    with open(path, 'wt') as f:
+      f.write('{"tip": ')
+    index = self.index(path=path)
+    self.assertEqual((index.tip, index.patch_ids), (None, {}))
+
+
+@unittest.skipUnless(shutil.which('git'), 'needs git')
+class PatchIdGitTest(unittest.TestCase):
+  ENV = dict(os.environ, GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@b',
+             GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@b')
+
+  def git(self, repo, *args):
+    return subprocess.check_output(['git', '-C', repo] + list(args),
+                                   env=self.ENV).decode('UTF-8').strip()
+
+  def commit(self, repo, name, text, msg):
+    with open(os.path.join(repo, name), 'wt') as f:
+      f.write(text)
+    self.git(repo, 'add', name)
+    self.git(repo, 'commit', '-q', '-m', msg)
+    return self.git(repo, 'rev-parse', 'HEAD')
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.upstream = os.path.join(self.tmp.name, 'upstream')
+    self.local = os.path.join(self.tmp.name, 'local')
+    for r in (self.upstream, self.local):
+      subprocess.check_call(['git', 'init', '-q', '-b', 'master', r])
+
+    lines = ['line {}'.format(i) for i in range(40)]
+    self.shas = []
+    for i in range(5):
+      lines[i * 8] = 'changed {}'.format(i)
+      self.shas.append(self.commit(self.upstream, 'f.c',
+                                   '\n'.join(lines) + '\n',
+                                   'upstream change {}'.format(i)))
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_matches_patch_id(self):
+    # The index gives the same answer as running patch-id on each commit
+    rev = Reviewer(git_dir=self.local)
+    ref = CommitRef(sha='', remote=self.upstream, branch='master')
+    index = rev.track_patch_ids(ref.remote, ref.branch)
+    for sha in self.shas:
+      patch = self.git(self.upstream, 'show', '--minimal', '-U5',
+                       '--format=%B', sha) + '\n'
+      self.assertEqual(rev.find_upstream_by_patch(patch).sha, sha)
+
+    # A downstream copy with its own message still finds its way back
+    patch = self.git(self.upstream, 'show', '--minimal', '-U5',
+                     '--format=%B', self.shas[2]) + '\n'
+    patch = patch.replace('upstream change 2', 'BACKPORT: change 2\n\nBUG=1')
+    found = rev.find_upstream_by_patch(patch)
+    self.assertEqual((found.sha, found.remote, found.branch),
+                     (self.shas[2], self.upstream, 'master'))
+    self.assertEqual(rev.find_upstream_by_patch(patch.replace('changed 2',
+                                                              'other')), None)
+    self.assertEqual(index.tip, self.shas[-1])
+
+
+@unittest.skipUnless(HAVE_GIT, 'needs git')
+class FixesIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.repo = ScratchRepo(os.path.join(self.tmp.name, 'repo'))
+    self.index_dir = os.path.join(self.tmp.name, 'index')
+    self.rev = Reviewer(git_dir=self.repo.path, index_dir=self.index_dir)
+    self.index = self.rev.track_fixes(None, 'master')
+    self.shas = [self.repo.commit('base {}'.format(i)) for i in range(3)]
+
+  def tearDown(self):
+    FixesIndex.indexes.pop((self.repo.path, 'refs/heads/master'), None)
+    self.tmp.cleanup()
+
+  def old_lookup(self, sha):
+    # What find_fixes_reference ran before there was an index
+    return self.repo.git('log', '--format=oneline', '--abbrev-commit', '-i',
+                         '--grep', 'Fixes:.*{}'.format(sha[:8]),
+                         '{}..master'.format(sha))
+
+  def find(self, sha):
+    ref = CommitRef(sha=sha, branch='master')
+    return self.rev.find_fixes_reference(ref).strip()
+
+  def fix(self, sha, msg='fix'):
+    return self.repo.commit('{}\n\nFixes: {} ("x")'.format(msg, sha[:12]))
+
+  def test_build(self):
+    self.fix(self.shas[0], 'fix a')
+    self.fix(self.shas[1], 'fix b')
+    self.repo.commit('FIXES: {}'.format(self.shas[0]))
+    for sha in self.shas:
+      self.assertEqual(self.find(sha), self.old_lookup(sha))
+    self.assertEqual(len(self.find(self.shas[0]).splitlines()), 2)
+    self.assertEqual(self.find(self.shas[2]), '')
+    self.assertEqual(self.index.tip, self.repo.rev_parse('master'))
+
+  def test_extend(self):
+    self.fix(self.shas[0], 'fix a')
+    self.assertEqual(self.find(self.shas[0]), self.old_lookup(self.shas[0]))
+    tip = self.index.tip
+    self.fix(self.shas[0], 'fix a again')
+    self.fix(self.shas[1], 'fix b')
+
+    with unittest.mock.patch.object(self.rev, 'log_fixes',
+                                    wraps=self.rev.log_fixes) as log:
+      for sha in self.shas:
+        self.assertEqual(self.find(sha), self.old_lookup(sha))
+    # Only the new commits were walked, newest first like git log
+    log.assert_called_once_with(['{}..{}'.format(tip, self.index.tip)])
+    self.assertTrue(self.find(self.shas[0]).splitlines()[0].endswith('again'))
+
+  def test_rewind(self):
+    self.fix(self.shas[0], 'fix a')
+    self.assertNotEqual(self.find(self.shas[0]), '')
+    # Force push the fix away and replace it with another
+    self.repo.git('reset', '-q', '--hard', self.shas[2])
+    self.fix(self.shas[1], 'fix b')
+    for sha in self.shas:
+      self.assertEqual(self.find(sha), self.old_lookup(sha))
+    self.assertEqual(self.find(self.shas[0]), '')
+
+  def test_short_hash(self):
+    # The old lookup grepped for 8 characters, so missed 7 character
+    # abbreviations (git's shortest). The index finds those too
+    self.repo.commit('fix a\n\nFixes: {}'.format(self.shas[0][:7]))
+    self.assertEqual(self.old_lookup(self.shas[0]), '')
+    self.assertNotEqual(self.find(self.shas[0]), '')
+    # A different commit sharing the key doesn't match a longer hash
+    self.fix(self.shas[1])
+    sha = self.shas[1]
+    other = sha[:8] + ('1' if sha[8] == '0' else '0') + sha[9:]
+    self.assertNotEqual(self.index.find(self.rev, sha), '')
+    self.assertEqual(self.index.find(self.rev, other), '')
+
+  def test_ancestor_filter(self):
+    fix = self.fix(self.shas[0])
+    self.find(self.shas[0])
+    # A fixing commit which is already in the fixed commit's history is never
+    # reported, the old lookup only walked sha..branch
+    key = self.shas[2][:FixesIndex.KEY_LEN]
+    self.index.fixes[key] = [[self.shas[2], self.shas[1], 'x base']]
+    self.assertEqual(self.find(self.shas[2]), self.old_lookup(self.shas[2]))
+    self.assertEqual(self.find(self.shas[2]), '')
+    self.assertNotEqual(self.find(self.shas[0]), '')
+
+  def test_undecodable_body(self):
+    self.repo.commit_raw('fix a\n\nBy J\xf6rg\nFixes: {}\n'.format(
+                            self.shas[0][:12]).encode('latin-1'))
+    self.fix(self.shas[1], 'fix b')
+    self.assertEqual(self.find(self.shas[0]), self.old_lookup(self.shas[0]))
+    self.assertEqual(self.find(self.shas[1]), self.old_lookup(self.shas[1]))
+
+  def test_round_trip(self):
+    self.fix(self.shas[0], 'fix a')
+    self.find(self.shas[0])
+    loaded = FixesIndex('refs/heads/master', self.index.path)
+    self.assertEqual((loaded.tip, loaded.fixes),
+                     (self.index.tip, self.index.fixes))
+    with unittest.mock.patch.object(self.rev, 'log_fixes') as log:
+      self.assertEqual(loaded.find(self.rev, self.shas[0]).strip(),
+                       self.old_lookup(self.shas[0]))
+    log.assert_not_called()
+
+  def test_old_version(self):
+    self.fix(self.shas[0], 'fix a')
+    self.find(self.shas[0])
+    with open(str(self.index.path), 'wt') as f:
+      json.dump({'tip': self.index.tip, 'fixes': self.index.fixes}, f)
+    loaded = FixesIndex('refs/heads/master', self.index.path)
+    self.assertEqual((loaded.tip, loaded.fixes), (None, {}))
+    self.assertEqual(loaded.find(self.rev, self.shas[0]).strip(),
+                     self.old_lookup(self.shas[0]))
+
+
+class ShaTableTest(unittest.TestCase):
+  def test_contains(self):
+    shas = ['{:040x}'.format(i * 7919) for i in range(50)]
+    table = ShaTable.from_hex(reversed(shas))
+    self.assertEqual(len(table), 50)
+    self.assertEqual(list(table), sorted(bytes.fromhex(s) for s in shas))
+    for s in shas:
+      self.assertIn(bytes.fromhex(s), table)
+    self.assertNotIn(bytes.fromhex('{:040x}'.format(1)), table)
+    self.assertNotIn(b'\xff' * 20, table)
+    self.assertEqual(len(ShaTable.from_hex([])), 0)
+    self.assertNotIn(b'\0' * 20, ShaTable.from_hex([]))
+
+  def test_merge(self):
+    table = ShaTable.from_hex(['{:040x}'.format(i) for i in range(0, 20, 2)])
+    new = set(bytes.fromhex('{:040x}'.format(i)) for i in range(10, 30))
+    merged = table.merge(new)
+    # Already present ones aren't duplicated, and the old table is untouched
+    self.assertEqual(list(merged), [bytes.fromhex('{:040x}'.format(i))
+                                    for i in sorted(set(range(0, 20, 2)) |
+                                                    set(range(10, 30)))])
+    self.assertEqual(len(table), 10)
+
+
+@unittest.skipUnless(HAVE_GIT, 'needs git')
+class ReachabilityIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.repo = ScratchRepo(os.path.join(self.tmp.name, 'repo'))
+    self.rev = Reviewer(git_dir=self.repo.path)
+    self.shas = [self.repo.commit('base {}'.format(i)) for i in range(3)]
+    # Some history which never makes it to master
+    self.repo.git('checkout', '-q', '-b', 'side', self.shas[1])
+    self.shas += [self.repo.commit('side {}'.format(i), name='s.c')
+                  for i in range(2)]
+    self.repo.git('checkout', '-q', 'master')
+    self.index = self.track()
+
+  def tearDown(self):
+    ReachabilityIndex.indexes.pop((self.repo.path, 'refs/heads/master'), None)
+    self.tmp.cleanup()
+
+  def track(self):
+    # As every new Reviewer does, which also notices the branch moving
+    return self.rev.track_branch(None, 'master')
+
+  def assertMatchesGit(self, shas):
+    for sha in shas:
+      ret = subprocess.call(['git', '-C', self.repo.path, 'merge-base',
+                             '--is-ancestor', sha, 'master'])
+      ref = CommitRef(sha=sha, branch='master')
+      self.assertEqual(self.rev.is_sha_in_branch(ref), ret == 0, sha)
+
+  def test_build(self):
+    self.assertMatchesGit(self.shas)
+    self.assertEqual(self.index.tip, self.shas[2])
+    self.assertEqual(len(self.index.commits), 3)
+    self.assertFalse(self.rev.is_sha_in_branch(CommitRef(sha='0' * 40,
+                                                         branch='master')))
+
+  def test_fast_forward(self):
+    self.assertMatchesGit(self.shas)
+    table = self.index.commits
+    self.shas.append(self.repo.commit('more'))
+    self.repo.git('merge', '-q', '--no-ff', '-m', 'merge side', 'side')
+    self.shas.append(self.repo.rev_parse('HEAD'))
+    # Not looked at again until the branch is tracked (or fetched)
+    self.assertFalse(self.rev.is_sha_in_branch(CommitRef(sha=self.shas[-1],
+                                                         branch='master')))
+    self.track()
+    self.assertMatchesGit(self.shas)
+    # Extended, not rebuilt
+    self.assertIs(self.index.commits, table)
+    self.assertEqual(len(self.index.recent), 4)
+
+  def test_rewind(self):
+    self.assertMatchesGit(self.shas)
+    # Force push over the last commit
+    self.repo.git('reset', '-q', '--hard', self.shas[1])
+    self.shas.append(self.repo.commit('replacement'))
+    self.track()
+    self.assertMatchesGit(self.shas)
+    self.assertEqual(len(self.index.commits), 3)
+    self.assertEqual(self.index.recent, set())
+
+  def test_many_recent(self):
+    self.assertMatchesGit(self.shas)
+    # Enough new commits to fold the recent ones into the packed table, made
+    # with fast-import since committing them one by one takes too long
+    count = ReachabilityIndex.MAX_RECENT + 10
+    stream = 'reset refs/heads/master\nfrom {}\n\n'.format(self.shas[2])
+    for i in range(count):
+      stream += ('commit refs/heads/master\n'
+                 'committer A <a@example.com> {} +0000\n'
+                 'data 4\n{:04}\n').format(1500000000 + i, i % 10000)
+    self.repo.git('fast-import', '--quiet', input=stream.encode('UTF-8'))
+    new = self.repo.git('rev-list', '{}..master'.format(self.shas[2])).split()
+    self.assertEqual(len(new), count)
+
+    self.track()
+    self.assertMatchesGit(self.shas + new[::400] + new[-1:])
+    self.assertEqual(self.index.recent, set())
+    self.assertEqual(len(self.index.commits), count + 3)
+    self.assertEqual(list(self.index.commits),
+                     sorted(bytes.fromhex(s) for s in
+                            self.repo.git('rev-list', 'master').split()))
+
+    # And it keeps extending from there
+    self.shas.append(self.repo.commit('after'))
+    self.track()
+    self.assertMatchesGit(self.shas + new[:1])
+    self.assertEqual(len(self.index.recent), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,68 @@
+from gitprocess import GitCatFile, GitCatFileCheck, GitObjectStore
+from gitprocess import parse_cat_file_header
+from tests.scratch import HAVE_GIT, ScratchRepo
+
+import os
+import tempfile
+import unittest
+
+class ParseHeaderTest(unittest.TestCase):
+  SHA = 'a' * 40
+
+  def test_object(self):
+    for t in ('blob', 'tree', 'commit', 'tag'):
+      header = '{} {} 12'.format(self.SHA, t).encode('UTF-8')
+      self.assertEqual(parse_cat_file_header(header), (self.SHA, t, 12))
+
+  def test_not_object(self):
+    for line in (b'HEAD missing', b'abc ambiguous', b'HEAD:a b missing',
+                 b'HEAD:a blob missing', b'HEAD:x y ambiguous',
+                 b'HEAD:a b c missing', b'', b'x blob 1 2', b'x bogus 1',
+                 b'x blob 1k'):
+      self.assertEqual(parse_cat_file_header(line), None, line)
+
+
+@unittest.skipUnless(HAVE_GIT, 'needs git')
+class CatFileTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.repo = ScratchRepo(os.path.join(self.tmp.name, 'repo'))
+    self.sha = self.repo.commit('commit', name='a b', text='spaced\n')
+    self.blob = self.repo.rev_parse('HEAD:a b')
+    self.cat = GitCatFile(self.repo.path)
+    self.check = GitCatFileCheck(self.repo.path)
+
+  def tearDown(self):
+    self.cat.stop()
+    self.check.stop()
+    self.tmp.cleanup()
+
+  def test_spaces_in_rev(self):
+    self.assertEqual(self.cat.read_object('HEAD:a b'),
+                     (self.blob, 'blob', b'spaced\n'))
+    self.assertEqual(self.check.check_object('HEAD:a b'),
+                     (self.blob, 'blob', 7))
+    # Missing revs with spaces give a 3 word header
+    for rev in ('HEAD:a c', 'HEAD:a blob', 'HEAD:x 12'):
+      self.assertEqual(self.cat.read_object(rev), None, rev)
+      self.assertEqual(self.check.check_object(rev), None, rev)
+    # Still in step, and never needed a restart
+    self.assertEqual(self.cat.read_object(self.sha)[:2], (self.sha, 'commit'))
+    self.assertEqual(self.check.check_object(self.sha)[:2],
+                     (self.sha, 'commit'))
+    self.assertEqual((self.cat.spawns, self.check.spawns), (1, 1))
+
+  def test_object_store(self):
+    store = GitObjectStore(self.repo.path)
+    try:
+      self.assertEqual(store.resolve('HEAD:a b'), self.blob)
+      self.assertEqual(store.resolve('HEAD:no such file'), None)
+      self.assertEqual(store.read_object('HEAD:no such file'), None)
+      self.assertFalse(store.has_commit('no such commit'))
+      self.assertEqual(store.get_commit_msg('HEAD'), 'commit\n')
+    finally:
+      store.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,263 @@
+from diffengine import with_context
+from patchmodel import LineType, Patch, PatchBuffer, classify_line
+from patchmodel import from_format_patch
+
+import random
+import re
+import unittest
+
+PATCH = '''\
+FROMGIT: drm/foo: Fix the bar
+
+The bar wasn't fixed.
+
+BUG=b:1234
+TEST=Ran it
+Signed-off-by: A Person <a@example.com>
+
+
+diff --git a/drivers/foo.c b/drivers/foo.c
+index 0123456..789abcd 100644
+--- a/drivers/foo.c
++++ b/drivers/foo.c
+@@ -10,7 +10,8 @@ static int foo(void)
+ 	int a;
+ 	int b;
+ 	int c;
+-	a = 1;
++	a = 2;
++	b = 3;
+ 	return a;
+ }
+ 
+@@ -40,6 +41,5 @@ static int bar(void)
+ 	int x;
+ 	int y;
+ 	int z;
+-	x = 4;
+ 	return x;
+ }
+
+diff --git a/drivers/old.c b/drivers/old.c
+deleted file mode 100644
+index 1111111..0000000
+--- a/drivers/old.c
++++ /dev/null
+@@ -1,3 +0,0 @@
+-int old(void)
+-{
+-}
+diff --git a/drivers/a.h b/drivers/b.h
+similarity index 90%
+rename from drivers/a.h
+rename to drivers/b.h
+index 2222222..3333333 100644
+--- a/drivers/a.h
++++ b/drivers/b.h
+@@ -1,2 +1,3 @@
+ #define A 1
++#define B 2
+ #define C 3
+diff --git a/drivers/new.c b/drivers/new.c
+new file mode 100644
+index 0000000..4444444
+--- /dev/null
++++ b/drivers/new.c
+@@ -0,0 +1,2 @@
++int new(void)
++{}
+'''
+
+# What every line was classified with before the Patch model
+def baseline_classify(line):
+  for t in LineType:
+    m = re.match(t.value, line)
+    if m:
+      return (t,m)
+  return None
+
+
+def baseline_strip(patch, context):
+  lines = patch.split('\n')
+  for i,l in enumerate(lines):
+    if re.match('diff --git ', l):
+      lines = lines[i:]
+      break
+  else:
+    lines = []
+
+  ret = []
+  ignore = [LineType.CHUNK, LineType.GITDIFF, LineType.INDEX,
+            LineType.DELETED, LineType.ADDED, LineType.SIMILARITY,
+            LineType.RENAME, LineType.EMPTY]
+  ctx_buffer = []
+  for l in lines:
+    if not l:
+      continue
+    l_type,_ = baseline_classify(l)
+    if l_type == LineType.CONTEXT:
+      ctx_buffer.append(l)
+      continue
+    if ctx_buffer and context:
+      ret.extend(ctx_buffer[-context:])
+    ctx_buffer = []
+    if l_type not in ignore:
+      ret.append(l)
+  if ctx_buffer and context:
+    ret.extend(ctx_buffer[-context:])
+  return ret
+
+
+def baseline_positions(patch):
+  cur_file = '/COMMIT_MSG'
+  cur_line = 6
+  for l in patch.split('\n'):
+    t,m = baseline_classify(l)
+    if t == LineType.FILE_NEW:
+      cur_file = m.group(1)
+      cur_line = 0
+    elif t == LineType.CHUNK:
+      cur_line = int(m.group(3)) - 1
+    elif (t == LineType.CONTEXT or (t == LineType.DIFF and l[0] == '+') or
+          cur_file == '/COMMIT_MSG'):
+      cur_line += 1
+    yield (l, cur_file, cur_line)
+
+
+def flatten(files):
+  ret = []
+  for f in files:
+    if f.old:
+      ret.append(f.old)
+    if f.new:
+      ret.append(f.new)
+    ret.extend([str(l, 'UTF-8') for l in f.lines])
+  return ret
+
+
+def random_patch(rand, files=3):
+  # Hunk counts are kept honest, and none of the body lines look like headers
+  ret = 'Subject\n\nBody\n\n'
+  for f in range(files):
+    name = 'dir/file{}.c'.format(f)
+    ret += 'diff --git a/{0} b/{0}\nindex 1..2 100644\n'.format(name)
+    ret += '--- a/{0}\n+++ b/{0}\n'.format(name)
+    start = 1
+    for h in range(rand.randint(1, 3)):
+      body = []
+      for i in range(rand.randint(1, 12)):
+        c = rand.choice(' ' * 4 + '-+')
+        body.append('{}line {}'.format(c, rand.randint(0, 5)))
+      old = sum(1 for l in body if l[0] != '+')
+      new = sum(1 for l in body if l[0] != '-')
+      ret += '@@ -{},{} +{},{} @@ fn()\n'.format(start, old, start, new)
+      ret += '\n'.join(body) + '\n'
+      start += 20
+  return ret
+
+
+class ClassifyTest(unittest.TestCase):
+  def test_matches_baseline(self):
+    lines = PATCH.split('\n') + ['', '-', '+', '--- ', '+++ ', '@@ bogus',
+                                 'diff', 'index', 'rename from x',
+                                 'similarity index 5%', 'random text',
+                                 ' ', '\t']
+    for l in lines:
+      t,m = classify_line(l)
+      bt,bm = baseline_classify(l)
+      self.assertEqual(t, bt, l)
+      self.assertEqual(m.groups(), bm.groups(), l)
+
+  def test_line_types_match_baseline(self):
+    p = Patch(PATCH)
+    for i,l in enumerate(PATCH.split('\n')[p.first_line:]):
+      self.assertEqual(p.line_type(i), baseline_classify(l)[0], l)
+
+  def test_header_like_lines_in_hunk(self):
+    # The old dispatch took these for file headers, the hunk counts don't
+    patch = ('diff --git a/f b/f\n--- a/f\n+++ b/f\n@@ -1,2 +1,2 @@\n'
+             '--- not a header\n+++ nor this\n x\n')
+    p = Patch(patch)
+    self.assertEqual([f.new_name for f in p.files], ['f'])
+    self.assertEqual(p.line_type(4), LineType.DIFF)
+    self.assertEqual(p.line_type(5), LineType.DIFF)
+
+
+class PatchTest(unittest.TestCase):
+  def test_commit_msg(self):
+    p = Patch(PATCH)
+    self.assertEqual(p.commit_msg, PATCH[:PATCH.find('\ndiff --git ')])
+    self.assertEqual(Patch('no diff here\n').commit_msg, 'no diff here\n')
+    self.assertEqual(Patch(PATCH[PATCH.find('diff --git '):]).commit_msg, '')
+
+  def test_files(self):
+    p = Patch(PATCH)
+    self.assertEqual([(f.old_name, f.new_name) for f in p.files],
+                     [('drivers/foo.c', 'drivers/foo.c'),
+                      ('drivers/old.c', '/dev/null'),
+                      ('drivers/a.h', 'drivers/b.h'),
+                      ('/dev/null', 'drivers/new.c')])
+    self.assertEqual([len(f.hunks) for f in p.files], [2, 1, 1, 1])
+    hunk = p.files[0].hunks[1]
+    self.assertEqual((hunk.old_start, hunk.old_count, hunk.new_start,
+                      hunk.new_count), (40, 6, 41, 5))
+
+  def test_bytes_and_str(self):
+    a = Patch(PATCH)
+    b = Patch(PATCH.encode('UTF-8'))
+    c = Patch(PatchBuffer(PATCH))
+    self.assertEqual(list(a.positions()), list(b.positions()))
+    self.assertEqual(list(a.positions()), list(c.positions()))
+
+  def test_invalid_utf8(self):
+    p = Patch(PATCH.encode('UTF-8').replace(b'a = 2', b'a = \xff'))
+    self.assertIn('+\ta = �;', [l for l,_,_ in p.positions()])
+
+  def test_positions_match_baseline(self):
+    self.assertEqual(list(Patch(PATCH).positions()),
+                     list(baseline_positions(PATCH)))
+
+  def test_stripped_matches_baseline(self):
+    p = Patch(PATCH)
+    for context in range(0, 6):
+      self.assertEqual(flatten(with_context(p.ranked(5), context)),
+                       baseline_strip(PATCH, context), context)
+
+  def test_random_stripped_matches_baseline(self):
+    rand = random.Random(1234)
+    for i in range(50):
+      patch = random_patch(rand)
+      p = Patch(patch)
+      self.assertEqual(list(p.positions()), list(baseline_positions(patch)))
+      for context in (0, 3, 5):
+        self.assertEqual(flatten(with_context(p.ranked(5), context)),
+                         baseline_strip(patch, context))
+
+  def test_fingerprint(self):
+    a = Patch(PATCH)
+    # Only the commit message and hunk headers differ
+    b = Patch(PATCH.replace('Fix the bar', 'Fix bar').replace('@@ -40,6 +41,5',
+                                                              '@@ -50,6 +51,5'))
+    self.assertEqual(a.fingerprint(5), b.fingerprint(5))
+    c = Patch(PATCH.replace('\tint z;', '\tint w;'))
+    self.assertEqual(a.fingerprint(0), c.fingerprint(0))
+    self.assertNotEqual(a.fingerprint(5), c.fingerprint(5))
+
+
+class FormatPatchTest(unittest.TestCase):
+  def test_round_trip(self):
+    # format-patch output parses like the 'git show' output it came from
+    msg,_,diff = PATCH.partition('\n\ndiff --git ')
+    subject,_,body = msg.partition('\n\n')
+    mail = ('From 0123 Mon Sep 17 00:00:00 2001\n'
+            'From: A Person <a@example.com>\n'
+            'Subject: [PATCH 1/2] {}\n\n{}\n---\n drivers/foo.c | 3 ++-\n'
+            ' 1 file changed\n\ndiff --git {}-- \n2.30.0\n\n').format(
+                subject, body.rstrip('\n'), diff)
+    p = Patch(from_format_patch(mail.encode('UTF-8')))
+    self.assertEqual(p.commit_msg, Patch(PATCH).commit_msg)
+    self.assertEqual(flatten(p.ranked(5)), flatten(Patch(PATCH).ranked(5)))
+
+
+if __name__ == '__main__':
+  unittest.main()
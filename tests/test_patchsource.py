@@ -0,0 +1,120 @@
+from patchsource import DownstreamPatchSource, PatchSource
+from trollreviewer import ChangeReviewer
+
+import collections
+import unittest
+
+Project = collections.namedtuple('Project', ['name', 'gerrit_remote_name',
+                                             'downstream_patch_source'])
+Revision = collections.namedtuple('Revision', ['ref'])
+Change = collections.namedtuple('Change', ['subject', 'current_revision'])
+
+class FakeReviewer(object):
+  def __init__(self, local_refs=()):
+    self.local_refs = set(local_refs)
+    self.lookups = []
+
+  def has_gerrit_ref(self, remote, ref):
+    self.lookups.append((remote, ref))
+    return ref in self.local_refs
+
+
+class DownstreamPatchSourceTest(unittest.TestCase):
+  def setUp(self):
+    self.addCleanup(DownstreamPatchSource.sources.pop, 'test', None)
+
+  def source(self, mode='auto'):
+    return DownstreamPatchSource.for_project('test', mode)
+
+  def test_fixed_modes(self):
+    src = self.source('git')
+    src.record(PatchSource.REST, 0.1)
+    src.record(PatchSource.GIT, 10)
+    self.assertEqual(src.choose(False), PatchSource.GIT)
+    src = self.source('rest')
+    self.assertEqual(src.choose(True), PatchSource.REST)
+    # Latencies survive a change of mode
+    self.assertIs(self.source('auto'), src)
+    self.assertEqual(src.latency[PatchSource.REST], 0.1)
+
+  def test_local(self):
+    src = self.source()
+    src.record(PatchSource.GIT, 10)
+    src.record(PatchSource.REST, 0.1)
+    self.assertEqual(src.choose(True), PatchSource.GIT)
+    # Doesn't count as a pick
+    self.assertEqual(src.picks, 0)
+
+  def test_unmeasured(self):
+    # Each source gets tried before comparing them
+    src = self.source()
+    self.assertEqual(src.choose(False), PatchSource.GIT)
+    src.record(PatchSource.GIT, 1)
+    self.assertEqual(src.choose(False), PatchSource.REST)
+    src.record(PatchSource.REST, 2)
+    self.assertEqual(src.choose(False), PatchSource.GIT)
+
+  def test_faster_wins(self):
+    src = self.source()
+    src.record(PatchSource.GIT, 1)
+    src.record(PatchSource.REST, 2)
+    self.assertEqual(src.choose(False), PatchSource.GIT)
+    # One slow sample moves the average, but not all the way
+    src.record(PatchSource.GIT, 3)
+    self.assertAlmostEqual(src.latency[PatchSource.GIT], 1.6)
+    self.assertEqual(src.choose(False), PatchSource.GIT)
+    src.record(PatchSource.GIT, 5)
+    self.assertEqual(src.choose(False), PatchSource.REST)
+
+  def test_probe(self):
+    src = self.source()
+    src.record(PatchSource.GIT, 1)
+    src.record(PatchSource.REST, 2)
+    picks = [src.choose(False) for _ in range(2 * src.PROBE_INTERVAL)]
+    probes = [i for i,p in enumerate(picks) if p == PatchSource.REST]
+    self.assertEqual(probes, [src.PROBE_INTERVAL - 1,
+                              2 * src.PROBE_INTERVAL - 1])
+
+
+class ChooseGerritPatchSourceTest(unittest.TestCase):
+  REF = 'refs/changes/34/1234/2'
+
+  def setUp(self):
+    self.addCleanup(DownstreamPatchSource.sources.pop, 'test', None)
+
+  def choose(self, mode, subject='UPSTREAM: foo', gerrit=True, local=False):
+    project = Project('test', 'cros', mode)
+    reviewer = FakeReviewer([self.REF] if local else [])
+    change = Change(subject, Revision(self.REF))
+    cr = ChangeReviewer(project, reviewer, change, 16384, True)
+    if gerrit:
+      cr.set_gerrit(object())
+    return cr.choose_gerrit_patch_source()
+
+  def test_no_gerrit(self):
+    # Nothing to talk REST to
+    self.assertEqual(self.choose('rest', gerrit=False), PatchSource.GIT)
+
+  def test_git(self):
+    self.assertEqual(self.choose('git'), PatchSource.GIT)
+
+  def test_backport(self):
+    self.assertEqual(self.choose('rest', subject='BACKPORT: foo'),
+                     PatchSource.GIT)
+
+  def test_rest(self):
+    self.assertEqual(self.choose('rest'), PatchSource.REST)
+    self.assertEqual(self.choose('rest', local=True), PatchSource.REST)
+
+  def test_auto(self):
+    src = DownstreamPatchSource.for_project('test', 'auto')
+    src.record(PatchSource.GIT, 10)
+    src.record(PatchSource.REST, 1)
+    self.assertEqual(self.choose('auto'), PatchSource.REST)
+    self.assertEqual(self.choose('auto', local=True), PatchSource.GIT)
+    src.record(PatchSource.REST, 100)
+    self.assertEqual(self.choose('auto'), PatchSource.GIT)
+
+
+if __name__ == '__main__':
+  unittest.main()
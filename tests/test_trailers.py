@@ -0,0 +1,146 @@
+from trailers import commit_message, parse_trailers
+from patchmodel import Patch, PatchBuffer
+
+import re
+import unittest
+
+# The separate patterns each trailer was looked up with before parse_trailers
+def baseline_cherry_picks(msg):
+  nws = r'[^\)^\s]'
+  pattern = (r'\((?:\s*)cherry.picked from commit\s*([0-9a-f]*)([^\)]*?'
+             r'([a-z]*\://{nws}*)\s*({nws}*)?\s*({nws}*)?)?\s*\)').format(
+                 nws=nws)
+  regex = re.compile(pattern, flags=(re.I | re.MULTILINE | re.DOTALL))
+  ret = []
+  for s in regex.findall(msg):
+    if s[3] == 'tag' and s[4]:
+      ret.append((s[0], s[2], None, s[4]))
+    else:
+      ret.append((s[0], s[2], s[3], None))
+  return ret
+
+
+def baseline_links(msg):
+  return re.findall(r'\s*Link:\s+(\S+)', msg)
+
+
+def baseline_am_from(msg):
+  return re.findall(r'\(am from (http.*)\)', msg, flags=re.I)
+
+
+def baseline_fields(msg, name, email):
+  fields = {'sob': False, 'bug': False, 'test': False}
+  sob_name_re = re.compile(r'Signed-off-by:\s+{}'.format(name))
+  sob_email_re = re.compile(r'Signed-off-by:.*?<{}>'.format(email))
+  for l in msg.splitlines():
+    if l.startswith('BUG='):
+      fields['bug'] = True
+    elif l.startswith('TEST='):
+      fields['test'] = True
+    elif sob_name_re.match(l):
+      fields['sob'] = True
+    elif sob_email_re.match(l):
+      fields['sob'] = True
+  return fields
+
+
+MESSAGES = [
+  '''UPSTREAM: drm/foo: Fix the bar
+
+The bar wasn't fixed.
+
+Link: https://lore.kernel.org/r/1234@example.com
+Signed-off-by: Up Stream <up@example.com>
+(cherry picked from commit 0123456789abcdef0123456789abcdef01234567)
+
+BUG=b:1234
+TEST=Ran it
+Change-Id: I0123456789abcdef0123456789abcdef01234567
+Signed-off-by: A Person <a@example.com>
+''',
+  '''FROMGIT: drm/foo: Fix the bar
+
+Signed-off-by: Up Stream <up@example.com>
+(cherry picked from commit 0123456789abcdef0123456789abcdef01234567
+ git://anongit.freedesktop.org/drm/drm-misc drm-misc-next)
+BUG=none
+TEST=none
+Signed-off-by: Someone Else <else@example.com>
+''',
+  '''FROMGIT: tagged
+
+(cherry picked from commit abcdef0
+ from git://git.kernel.org/pub/scm/linux/kernel/git/foo/bar.git tag v5.4-rc1)
+BUG=chromium:1
+TEST=ok
+''',
+  '''FROMLIST: thing
+
+Link: https://patchwork.kernel.org/patch/1/
+    Link: https://patchwork.kernel.org/patch/2/
+(am from https://patchwork.kernel.org/patch/3/)
+(AM FROM https://lore.kernel.org/r/4)
+(am from not-a-url)
+ BUG=indented doesn't count
+TEST=
+''',
+  '''BACKPORT: two picks
+
+( cherry-picked from commit 1111111 )
+(cherry picked from commit 2222222 https://example.com/repo.git)
+no trailers
+''',
+  '',
+]
+
+class TrailersTest(unittest.TestCase):
+  def test_cherry_picks_match_baseline(self):
+    for msg in MESSAGES:
+      got = [(c.sha, c.remote, c.branch, c.tag)
+             for c in parse_trailers(msg).cherry_picks]
+      self.assertEqual(got, baseline_cherry_picks(msg), msg)
+
+  def test_links_match_baseline(self):
+    for msg in MESSAGES:
+      self.assertEqual(parse_trailers(msg).links, baseline_links(msg), msg)
+
+  def test_am_from_matches_baseline(self):
+    for msg in MESSAGES:
+      got = [a for a in parse_trailers(msg).am_from
+             if a.lower().startswith('http')]
+      self.assertEqual(got, baseline_am_from(msg), msg)
+
+  def test_fields_match_baseline(self):
+    people = [('A Person', 'a@example.com'), ('Up Stream', 'nope@x.com'),
+              ('Nobody', 'else@example.com'), ('Nobody', 'nobody@x.com')]
+    for msg in MESSAGES:
+      t = parse_trailers(msg)
+      for name,email in people:
+        fields = {'bug': bool(t.bugs), 'test': bool(t.tests),
+                  'sob': t.has_sob(name=name, email=email)}
+        self.assertEqual(fields, baseline_fields(msg, name, email),
+                         (msg, name))
+
+  def test_values(self):
+    t = parse_trailers(MESSAGES[0])
+    self.assertEqual(t.bugs, ['b:1234'])
+    self.assertEqual(t.tests, ['Ran it'])
+    self.assertEqual(t.change_ids,
+                     ['I0123456789abcdef0123456789abcdef01234567'])
+    self.assertEqual(t.sobs, ['Up Stream <up@example.com>',
+                              'A Person <a@example.com>'])
+
+  def test_commit_message(self):
+    msg = MESSAGES[1]
+    diff = 'diff --git a/f b/f\n--- a/f\n+++ b/f\n@@ -1 +1 @@\n-BUG=x\n+y\n'
+    patch = msg + '\n' + diff
+    for p in (patch, patch.encode('UTF-8'), PatchBuffer(patch)):
+      self.assertEqual(commit_message(p), msg + '\n')
+    self.assertEqual(commit_message(Patch(patch)), msg)
+    self.assertEqual(commit_message(diff), '')
+    # Nothing below the diff is a trailer
+    self.assertEqual(parse_trailers(patch).bugs, ['none'])
+
+
+if __name__ == '__main__':
+  unittest.main()
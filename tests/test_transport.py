@@ -0,0 +1,152 @@
+try:
+  import transport
+except ImportError:
+  transport = None
+
+import email.utils
+import io
+import time
+import unittest
+import unittest.mock
+
+def response(status, retry_after=None, content=b'ok'):
+  resp = transport.requests.Response()
+  resp.status_code = status
+  if retry_after != None:
+    resp.headers['Retry-After'] = retry_after
+  resp.raw = io.BytesIO(content)
+  return resp
+
+
+@unittest.skipUnless(transport, 'needs requests')
+class HostSessionTest(unittest.TestCase):
+  URL = 'https://gerrit.example.com/changes/1234/detail'
+
+  def setUp(self):
+    transport.stats.reset()
+    self.session = transport.HostSession('https://gerrit.example.com', 2)
+    self.responses = []
+    self.calls = []
+    self.delays = []
+
+    def fake_request(session, method, url, *args, **kwargs):
+      self.calls.append((method, url))
+      resp = self.responses.pop(0)
+      if isinstance(resp, Exception):
+        raise resp
+      return resp
+
+    # The session underneath HostSession is the one doing the network part
+    patches = [
+      unittest.mock.patch.object(transport.requests.Session, 'request',
+                                 autospec=True, side_effect=fake_request),
+      unittest.mock.patch.object(transport.time, 'sleep',
+                                 side_effect=self.delays.append),
+    ]
+    for p in patches:
+      p.start()
+      self.addCleanup(p.stop)
+
+  def stats(self):
+    return transport.stats.to_dict()['GET gerrit.example.com/changes/*/detail']
+
+  def test_success(self):
+    self.responses = [response(200)]
+    self.assertEqual(self.session.get(self.URL).status_code, 200)
+    self.assertEqual(len(self.calls), 1)
+    self.assertEqual(self.delays, [])
+    self.assertEqual(self.stats()['status'], {'200': 1})
+
+  def test_retry_after_seconds(self):
+    self.responses = [response(429, '3'), response(200)]
+    with self.assertLogs('rom.transport', level='WARNING'):
+      self.assertEqual(self.session.get(self.URL).status_code, 200)
+    self.assertEqual(self.delays, [3])
+    self.assertEqual(self.stats()['retries'], 1)
+
+  def test_retry_after_date(self):
+    when = email.utils.formatdate(time.time() + 10, usegmt=True)
+    self.responses = [response(503, when), response(200)]
+    with self.assertLogs('rom.transport', level='WARNING'):
+      self.assertEqual(self.session.get(self.URL).status_code, 200)
+    self.assertEqual(len(self.delays), 1)
+    self.assertTrue(8 <= self.delays[0] <= 10, self.delays)
+
+  def test_retry_after_capped(self):
+    self.responses = [response(503, '3600'), response(200)]
+    with self.assertLogs('rom.transport', level='WARNING'):
+      self.session.get(self.URL)
+    self.assertEqual(self.delays, [self.session.BACKOFF_MAX])
+
+  def test_bad_retry_after(self):
+    # Falls back to the usual backoff
+    self.responses = [response(503, 'soon'), response(503), response(200)]
+    with self.assertLogs('rom.transport', level='WARNING') as logs:
+      self.assertEqual(self.session.get(self.URL).status_code, 200)
+    self.assertIn('Ignoring bad Retry-After', '\n'.join(logs.output))
+    self.assertEqual(len(self.delays), 2)
+    for attempt,delay in enumerate(self.delays):
+      self.assertTrue(0 <= delay <= self.session.BACKOFF_BASE * 2 ** attempt)
+
+  def test_attempts_exhausted(self):
+    attempts = self.session.MAX_ATTEMPTS
+    self.responses = [response(503) for _ in range(attempts + 1)]
+    with self.assertLogs('rom.transport', level='WARNING'):
+      self.assertEqual(self.session.get(self.URL).status_code, 503)
+    self.assertEqual(len(self.calls), attempts)
+    self.assertEqual(self.stats()['retries'], attempts - 1)
+
+  def test_connection_error(self):
+    err = transport.requests.exceptions.ConnectionError('refused')
+    self.responses = [err, response(200)]
+    with self.assertLogs('rom.transport', level='WARNING'):
+      self.assertEqual(self.session.get(self.URL).status_code, 200)
+
+    self.responses = [err] * self.session.MAX_ATTEMPTS
+    with self.assertLogs('rom.transport', level='WARNING'):
+      with self.assertRaises(transport.requests.exceptions.ConnectionError):
+        self.session.get(self.URL)
+    self.assertEqual(self.stats()['status']['error'], 1)
+
+  def test_budget_exhausted(self):
+    self.session.budget = transport.RetryBudget(0.5, 1)
+    self.responses = [response(503), response(503)]
+    with self.assertLogs('rom.transport', level='WARNING'):
+      self.assertEqual(self.session.get(self.URL).status_code, 503)
+    # The one token went on the first retry, so no more
+    self.assertEqual(len(self.calls), 2)
+
+    self.calls = []
+    self.responses = [response(503)]
+    self.assertEqual(self.session.get(self.URL).status_code, 503)
+    self.assertEqual(len(self.calls), 1)
+
+    # Successes pay for retries again
+    self.responses = [response(200), response(200), response(503),
+                      response(200)]
+    self.session.get(self.URL)
+    self.session.get(self.URL)
+    with self.assertLogs('rom.transport', level='WARNING'):
+      self.assertEqual(self.session.get(self.URL).status_code, 200)
+    self.assertEqual(self.responses, [])
+
+  def test_not_retryable(self):
+    for status in (404, 500):
+      self.calls = []
+      self.responses = [response(status), response(200)]
+      self.assertEqual(self.session.get(self.URL).status_code, status)
+      self.assertEqual(len(self.calls), 1)
+    self.assertEqual(self.delays, [])
+
+  def test_not_idempotent(self):
+    # A POST may have been acted on, only a 429 says it wasn't
+    self.responses = [response(503), response(200)]
+    self.assertEqual(self.session.post(self.URL).status_code, 503)
+    self.responses = [response(429, '1'), response(200)]
+    with self.assertLogs('rom.transport', level='WARNING'):
+      self.assertEqual(self.session.post(self.URL).status_code, 200)
+    self.assertEqual(self.delays, [1])
+
+
+if __name__ == '__main__':
+  unittest.main()
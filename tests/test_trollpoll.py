@@ -0,0 +1,170 @@
+from trollpoll import TrollPoll
+
+import collections
+import datetime
+import json
+import os
+import random
+import tempfile
+import unittest
+
+Revision = collections.namedtuple('Revision', ['ref'])
+
+class Change(object):
+  def __init__(self, number, updated, status='NEW', revision=1):
+    self.number = number
+    self.last_updated = updated
+    self.status = status
+    self.current_revision = Revision('refs/changes/{:02d}/{}/{}'.format(
+                                        number % 100, number, revision))
+
+
+class FakeGerrit(object):
+  # Changes updated on a clock of our own, a few days back so every query is
+  # well within TrollPoll.MAX_AGE
+  def __init__(self, rand):
+    self.rand = rand
+    self.now = datetime.datetime.utcnow().replace(microsecond=0)
+    self.now -= datetime.timedelta(days=2)
+    self.changes = {}
+    self.next_number = 1
+
+  def tick(self):
+    self.now += datetime.timedelta(minutes=5)
+    for i in range(self.rand.randint(0, 3)):
+      c = Change(self.next_number, self.now)
+      self.changes[c.number] = c
+      self.next_number += 1
+    for c in list(self.changes.values()):
+      if c.status != 'NEW' or self.rand.random() > 0.2:
+        continue
+      status = self.rand.choice(['NEW', 'NEW', 'MERGED', 'ABANDONED'])
+      rev = int(c.current_revision.ref.split('/')[-1]) + 1
+      self.changes[c.number] = Change(c.number, self.now, status, rev)
+
+  def query(self, after):
+    # The baseline query (no after) only wants open changes
+    if not after:
+      return [c for c in self.changes.values() if c.status == 'NEW']
+    return [c for c in self.changes.values() if c.last_updated > after]
+
+
+def run_cycle(poll, gerrit):
+  after = poll.start_cycle('p')
+  ret = [c for c in gerrit.query(after) if poll.update('p', c)]
+  poll.finish_cycle('p')
+  return ret
+
+
+class TrollPollTest(unittest.TestCase):
+  def test_first_cycle_is_full(self):
+    poll = TrollPoll(None, 3600)
+    self.assertEqual(poll.start_cycle('p'), None)
+    self.assertFalse(poll.is_complete('p'))
+
+  def test_incremental_after_full(self):
+    poll = TrollPoll(None, 3600)
+    gerrit = FakeGerrit(random.Random(0))
+    gerrit.tick()
+    run_cycle(poll, gerrit)
+    self.assertTrue(poll.is_complete('p'))
+    after = poll.start_cycle('p')
+    self.assertEqual(after, gerrit.now - TrollPoll.OVERLAP)
+
+  def test_full_poll_interval(self):
+    poll = TrollPoll(None, 0)
+    gerrit = FakeGerrit(random.Random(0))
+    gerrit.tick()
+    run_cycle(poll, gerrit)
+    self.assertEqual(poll.start_cycle('p'), None)
+
+  def test_max_age(self):
+    poll = TrollPoll(None, 3600)
+    poll.state['p'] = {'hwm': '2000-01-01 00:00:00', 'last_full': 2e9}
+    after = poll.start_cycle('p')
+    oldest = datetime.datetime.utcnow() - TrollPoll.MAX_AGE
+    self.assertLess(abs((after - oldest).total_seconds()), 60)
+
+  def test_unfinished_cycle_keeps_hwm(self):
+    poll = TrollPoll(None, 3600)
+    gerrit = FakeGerrit(random.Random(0))
+    gerrit.tick()
+    run_cycle(poll, gerrit)
+    hwm = poll.state['p']['hwm']
+    gerrit.tick()
+    gerrit.changes[1000] = Change(1000, gerrit.now)
+    after = poll.start_cycle('p')
+    for c in gerrit.query(after):
+      poll.update('p', c)
+    # Gerrit failed part way through, finish_cycle() is never called
+    self.assertEqual(poll.state['p']['hwm'], hwm)
+    self.assertEqual(poll.start_cycle('p'), after)
+
+  def test_matches_full_polls(self):
+    # Every cycle reviews everything a full poll would have found updated, and
+    # knows the same set of open changes
+    rand = random.Random(1234)
+    gerrit = FakeGerrit(rand)
+    poll = TrollPoll(None, 3600)
+    seen = {}
+    for cycle in range(100):
+      gerrit.tick()
+      reviewed = run_cycle(poll, gerrit)
+      full = gerrit.query(None)
+      expected = set(c.current_revision.ref for c in full
+                     if seen.get(c.number) != c.current_revision.ref)
+      got = set(c.current_revision.ref for c in reviewed)
+      self.assertTrue(expected <= got, cycle)
+      self.assertEqual(sorted(poll.open_refs('p')),
+                       sorted(c.current_revision.ref for c in full))
+      for c in full:
+        seen[c.number] = c.current_revision.ref
+
+  def test_track_and_forget(self):
+    poll = TrollPoll(None, 3600)
+    now = datetime.datetime.utcnow()
+    self.assertTrue(poll.track('p', Change(1, now)))
+    self.assertFalse(poll.track('p', Change(2, now, status='MERGED')))
+    self.assertEqual(poll.open_refs('p'), ['refs/changes/01/1/1'])
+    self.assertFalse(poll.track('p', Change(1, now, status='ABANDONED')))
+    self.assertEqual(poll.open_refs('p'), [])
+
+  def test_full_poll_drops_unseen(self):
+    poll = TrollPoll(None, 0)
+    now = datetime.datetime.utcnow()
+    poll.track('p', Change(1, now))
+    poll.start_cycle('p')
+    poll.update('p', Change(2, now))
+    poll.finish_cycle('p')
+    self.assertEqual(poll.open_refs('p'), ['refs/changes/02/2/1'])
+
+
+class TrollPollStateTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.tmp.name, 'state', 'poll.json')
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_round_trip(self):
+    poll = TrollPoll(self.path, 3600)
+    gerrit = FakeGerrit(random.Random(0))
+    gerrit.tick()
+    run_cycle(poll, gerrit)
+    loaded = TrollPoll(self.path, 3600)
+    self.assertEqual(loaded.state, poll.state)
+    self.assertEqual(loaded.start_cycle('p'), gerrit.now - TrollPoll.OVERLAP)
+
+  def test_malformed(self):
+    os.makedirs(os.path.dirname(self.path))
+    for data in ('not json', json.dumps(['a list'])):
+      with open(self.path, 'wt') as f:
+        f.write(data)
+      poll = TrollPoll(self.path, 3600)
+      self.assertEqual(poll.state, {})
+      self.assertEqual(poll.start_cycle('p'), None)
+
+
+if __name__ == '__main__':
+  unittest.main()
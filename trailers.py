@@ -0,0 +1,159 @@
+from patchmodel import Patch, PatchBuffer, decode_line
+
+import collections
+import logging
+import re
+import threading
+
+logger = logging.getLogger('rom.trailers')
+
+# Helper pattern to match any character that isn't whitespace or )
+NON_WS = '[^\)^\s]'
+
+# The cherry-pick pattern has gotten a bit hard to parse, so i'll do my best.
+#
+# Start with an opening paren and allow for whitespace, then look for the
+# "cherry picked from commit" string taking into account space or dash between
+# cherry and picked, and allowing for multiple spaces after commit. Then we grab
+# the hexidecimal hash string. Everything after this is optional.
+#
+# Optionally gobble up everything (including newlines) until we hit the remote.
+# This allows for extra fluff in between the hash and URL (like an extra 'from'
+# as seen in http://crosreview.com/1537900). Instead of just .* explicitly
+# forbid matching ) since it could go looking through the source for a URL
+# (like in http://crosreview.com/1544916). Finally, use a non-greedy algorithm
+# to avoid gobbling the URL.
+#
+# The remote matches any protocol (git://, http://, https://, madeup://) and
+# then all non-whitespace characters. The next run of non-whitespace characters
+# could either be 'tag' or the remote branch, and is optional in case they want
+# to use the default remote branch. If it's a tag, the tag name follows.
+CHERRY_PICK_PATTERN = (
+  '(?is:\(\s*cherry.picked from commit\s*(?P<cp_sha>[0-9a-f]*)'
+  '(?:[^\)]*?(?P<cp_remote>[a-z]*\://{nws}*)\s*(?P<cp_word>{nws}*)?\s*'
+  '(?P<cp_tag>{nws}*)?)?\s*\))'.format(nws=NON_WS))
+
+# Each trailer on its own, in the order they're tried at a given position
+TRAILER_PATTERNS = collections.OrderedDict([
+  ('cherry_pick', CHERRY_PICK_PATTERN),
+  ('am_from', '(?i:\(am from (?P<am_from>[^\n]*)\))'),
+  ('link', 'Link:\s+(?P<link>\S+)'),
+  ('bug', '^BUG=(?P<bug>[^\n]*)'),
+  ('test', '^TEST=(?P<test>[^\n]*)'),
+  ('sob', '^Signed-off-by:[ \t]+(?P<sob>[^\n]*)'),
+  ('change_id', '^Change-Id:[ \t]+(?P<change_id>I[0-9a-f]+)'),
+])
+# All of the above in one pattern so the message is only walked once
+TRAILERS_RE = re.compile('|'.join(TRAILER_PATTERNS.values()),
+                         flags=re.MULTILINE)
+
+DIFF_START = 'diff --git '
+
+
+class CherryPick(object):
+  def __init__(self, sha, remote, branch, tag):
+    self.sha = sha
+    self.remote = remote
+    self.branch = branch
+    self.tag = tag
+
+  def __str__(self):
+    return 'sha={} remote={} branch={} tag={}'.format(self.sha, self.remote,
+                                                      self.branch, self.tag)
+
+  def __repr__(self):
+    return self.__str__()
+
+
+class Trailers(object):
+  def __init__(self, msg):
+    self.cherry_picks = []
+    self.am_from = []
+    self.links = []
+    self.bugs = []
+    self.tests = []
+    self.sobs = []
+    self.change_ids = []
+
+    for m in TRAILERS_RE.finditer(msg):
+      if m.group('cp_sha') != None:
+        self.__add_cherry_pick(m)
+      elif m.group('am_from') != None:
+        self.am_from.append(m.group('am_from'))
+      elif m.group('link') != None:
+        self.links.append(m.group('link'))
+      elif m.group('bug') != None:
+        self.bugs.append(m.group('bug'))
+      elif m.group('test') != None:
+        self.tests.append(m.group('test'))
+      elif m.group('sob') != None:
+        self.sobs.append(m.group('sob'))
+      elif m.group('change_id') != None:
+        self.change_ids.append(m.group('change_id'))
+
+  def __add_cherry_pick(self, m):
+    sha = m.group('cp_sha')
+    remote = m.group('cp_remote') or ''
+    word = m.group('cp_word') or ''
+    tag = m.group('cp_tag') or ''
+    if word == 'tag' and tag:
+      self.cherry_picks.append(CherryPick(sha, remote, None, tag))
+    else:
+      self.cherry_picks.append(CherryPick(sha, remote, word, None))
+
+  def has_sob(self, name=None, email=None):
+    for s in self.sobs:
+      if name and s.startswith(name):
+        return True
+      if email and '<{}>'.format(email) in s:
+        return True
+    return False
+
+  def __str__(self):
+    return ('cherry_picks={} am_from={} links={} bugs={} tests={} sobs={} '
+            'change_ids={}').format(self.cherry_picks, self.am_from,
+                                    self.links, self.bugs, self.tests,
+                                    self.sobs, self.change_ids)
+
+
+def commit_message(patch):
+  # Everything before the diff, the trailers never live below it
+  if isinstance(patch, Patch):
+    return patch.commit_msg
+  if isinstance(patch, (bytes, bytearray)):
+    patch = PatchBuffer(patch)
+  if isinstance(patch, PatchBuffer):
+    i = patch.find_line(DIFF_START.encode('UTF-8'))
+    if i == None:
+      return str(patch)
+    return decode_line(patch.view[:patch.offsets[i]])
+
+  if patch.startswith(DIFF_START):
+    return ''
+  pos = patch.find('\n' + DIFF_START)
+  if pos < 0:
+    return patch
+  return patch[:pos + 1]
+
+
+# Parsed trailers keyed by commit message, which is as good as keying by
+# revision since every revision of a change carries its own message
+MAX_CACHED_TRAILERS = 64
+cached_trailers = collections.OrderedDict()
+cached_trailers_lock = threading.Lock()
+
+def parse_trailers(patch):
+  msg = commit_message(patch)
+  with cached_trailers_lock:
+    ret = cached_trailers.get(msg)
+    if ret:
+      cached_trailers.move_to_end(msg)
+      return ret
+
+  ret = Trailers(msg)
+  with cached_trailers_lock:
+    cached_trailers[msg] = ret
+    while len(cached_trailers) > MAX_CACHED_TRAILERS:
+      cached_trailers.popitem(last=False)
+  return ret
+
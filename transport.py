@@ -0,0 +1,209 @@
+import collections
+import email.utils
+import logging
+import random
+import re
+import requests
+import threading
+import time
+import urllib
+
+logger = logging.getLogger('rom.transport')
+
+class EndpointStats(object):
+  def __init__(self):
+    self.count = 0
+    self.retries = 0
+    self.total_time = 0.0
+    self.max_time = 0.0
+    self.total_bytes = 0
+    self.status = collections.Counter()
+
+  def to_dict(self):
+    return {
+      'count': self.count,
+      'retries': self.retries,
+      'total_time': round(self.total_time, 6),
+      'max_time': round(self.max_time, 6),
+      'total_bytes': self.total_bytes,
+      'status': dict(sorted(self.status.items())),
+    }
+
+
+class TransportStats(object):
+  # Ids, numbers and hashes are folded out of the path so that requests for
+  # different changes/patches count against the same endpoint
+  ID_RE = re.compile('/(?:[0-9]+|[0-9a-f]{7,40}|[^/]*~[^/]*|I[0-9a-f]{40})'
+                     '(?=/|$)', flags=re.I)
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.endpoints = collections.defaultdict(EndpointStats)
+
+  @classmethod
+  def endpoint(cls, method, url):
+    parsed = urllib.parse.urlsplit(url)
+    return '{} {}{}'.format(method.upper(), parsed.netloc,
+                            cls.ID_RE.sub('/*', parsed.path))
+
+  def record(self, endpoint, elapsed, status, nbytes, retries):
+    with self.lock:
+      s = self.endpoints[endpoint]
+      s.count += 1
+      s.retries += retries
+      s.total_time += elapsed
+      s.max_time = max(s.max_time, elapsed)
+      s.total_bytes += nbytes
+      s.status[str(status)] += 1
+
+  def to_dict(self):
+    with self.lock:
+      return {k: v.to_dict() for k,v in sorted(self.endpoints.items())}
+
+  def summarize(self, level):
+    logger.log(level, 'HTTP requests:')
+    with self.lock:
+      for endpoint,s in sorted(self.endpoints.items()):
+        logger.log(level, '   {}: count={} retries={} time={:.2f}s max={:.2f}s '
+                          'bytes={}'.format(endpoint, s.count, s.retries,
+                                            s.total_time, s.max_time,
+                                            s.total_bytes))
+
+
+stats = TransportStats()
+
+
+class RetryBudget(object):
+  # Retries are paid for by successful requests, so a host which is down (or
+  # throttling us) doesn't get hammered with retries of every single request
+  def __init__(self, ratio, max_tokens):
+    self.ratio = ratio
+    self.max_tokens = max_tokens
+    self.tokens = max_tokens
+    self.lock = threading.Lock()
+
+  def deposit(self):
+    with self.lock:
+      self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+  def withdraw(self):
+    with self.lock:
+      if self.tokens < 1:
+        return False
+      self.tokens -= 1
+      return True
+
+
+class HostSession(requests.Session):
+  # One per host, shared by everyone talking to it. The underlying connection
+  # pool keeps connections alive between requests.
+  RETRY_STATUS = (502, 503, 504)
+  IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+  MAX_ATTEMPTS = 4
+  BACKOFF_BASE = 1.0
+  BACKOFF_MAX = 60.0
+  DEFAULT_TIMEOUT = 90
+
+  def __init__(self, host, max_concurrent):
+    super().__init__()
+    self.host = host
+    self.slots = threading.BoundedSemaphore(max_concurrent)
+    self.budget = RetryBudget(0.1, 10)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=max_concurrent)
+    self.mount('https://', adapter)
+    self.mount('http://', adapter)
+
+  def retry_delay(self, attempt, resp):
+    if resp != None:
+      retry_after = resp.headers.get('Retry-After')
+      if retry_after:
+        if retry_after.isdigit():
+          return min(int(retry_after), self.BACKOFF_MAX)
+        try:
+          when = email.utils.parsedate_to_datetime(retry_after)
+          return min(max(when.timestamp() - time.time(), 0), self.BACKOFF_MAX)
+        except (TypeError, ValueError):
+          logger.warning('Ignoring bad Retry-After "{}"'.format(retry_after))
+    # Full jitter, so everyone who failed together doesn't retry together
+    return random.uniform(0, min(self.BACKOFF_BASE * (2 ** attempt),
+                                 self.BACKOFF_MAX))
+
+  def should_retry(self, method, resp):
+    # Anything but a 429 might have been acted on, which is only safe to repeat
+    # for idempotent requests
+    if resp.status_code == 429:
+      return True
+    return (method.upper() in self.IDEMPOTENT and
+            resp.status_code in self.RETRY_STATUS)
+
+  def request(self, method, url, *args, **kwargs):
+    kwargs.setdefault('timeout', self.DEFAULT_TIMEOUT)
+    endpoint = stats.endpoint(method, url)
+    start = time.monotonic()
+    retries = 0
+    resp = None
+    try:
+      while True:
+        err = None
+        with self.slots:
+          try:
+            resp = super().request(method, url, *args, **kwargs)
+          except (requests.exceptions.ConnectionError,
+                  requests.exceptions.Timeout) as e:
+            err = e
+
+        if err == None and not self.should_retry(method, resp):
+          self.budget.deposit()
+          return resp
+
+        if retries + 1 >= self.MAX_ATTEMPTS or not self.budget.withdraw():
+          if err != None:
+            raise err
+          return resp
+
+        delay = self.retry_delay(retries, resp if err == None else None)
+        logger.warning('Retrying {} in {:.1f}s ({})'.format(
+                          endpoint, delay, err or resp.status_code))
+        if resp != None:
+          resp.close()
+        retries += 1
+        time.sleep(delay)
+    finally:
+      status = resp.status_code if resp != None else 'error'
+      nbytes = 0
+      if resp != None:
+        if kwargs.get('stream'):
+          nbytes = int(resp.headers.get('Content-Length', 0))
+        else:
+          nbytes = len(resp.content)
+      stats.record(endpoint, time.monotonic() - start, status, nbytes, retries)
+
+
+MAX_CONCURRENT_PER_HOST = 4
+sessions = {}
+sessions_lock = threading.Lock()
+
+def configure(max_concurrent_per_host):
+  # Only affects hosts which haven't been talked to yet
+  global MAX_CONCURRENT_PER_HOST
+  MAX_CONCURRENT_PER_HOST = max_concurrent_per_host
+
+
+def session_for(url):
+  parsed = urllib.parse.urlsplit(url)
+  host = '{}://{}'.format(parsed.scheme, parsed.netloc)
+  with sessions_lock:
+    s = sessions.get(host)
+    if not s:
+      s = HostSession(host, MAX_CONCURRENT_PER_HOST)
+      sessions[host] = s
+    return s
+
+
+def get(url, **kwargs):
+  return session_for(url).get(url, **kwargs)
@@ -2,6 +2,8 @@
 
 from reviewer import Reviewer
 from gerrit import Gerrit, GerritRevision, GerritMessage
+from gitstats import GitStats
+from patchcache import PatchCache
 
 from trollconfig import TrollConfig
 from trollreview import ReviewType
@@ -10,13 +12,19 @@ from trollreviewerfromgit import FromgitChangeReviewer
 from trollreviewerupstream import UpstreamChangeReviewer
 from trollreviewerfromlist import FromlistChangeReviewer
 from trollreviewerchromium import ChromiumChangeReviewer
+from trollpoll import TrollPoll
 from trollstats import TrollStats
+import events
+import transport
 
 import argparse
+import collections
 import datetime
+import itertools
 import json
 import logging
 from logging import handlers
+import pathlib
 import re
 import requests
 import sys
@@ -30,16 +38,33 @@ class Troll(object):
 
   def __init__(self, config):
     self.config = config
+    transport.configure(config.http_concurrency)
     self.gerrit = Gerrit(config.gerrit_url)
     self.tag = 'autogenerated:review-o-matic'
     self.ignore_list = {}
     self.stats = TrollStats('{}'.format(self.config.stats_file))
+    self.git_stats = None
+    if self.config.git_stats_file:
+      self.git_stats = GitStats(self.config.git_stats_file)
+    self.patch_cache = None
+    self.index_dir = None
+    if self.config.cache_dir:
+      self.index_dir = pathlib.Path(self.config.cache_dir, 'indexes')
+      self.patch_cache = PatchCache(
+              pathlib.Path(self.config.cache_dir, 'patches'),
+              self.config.patch_cache_size * 1024 * 1024)
+    poll_file = None
+    if self.config.cache_dir:
+      poll_file = pathlib.Path(self.config.cache_dir, 'poll.json')
+    self.poll = TrollPoll(poll_file, self.config.full_poll_interval)
 
   def do_review(self, project, change, review):
     logger.info('Review for change: {}'.format(change.url()))
     logger.info('  Issues: {}, Feedback: {}, Vote:{}, Notify:{}'.format(
         review.issues.keys(), review.feedback.keys(), review.vote,
         review.notify))
+    if review.fingerprint:
+      logger.info('  Fingerprint: {}'.format(review.fingerprint))
 
     if review.dry_run:
       print(review.generate_review_message(self.RETRY_REVIEW_KEY))
@@ -67,13 +92,29 @@ class Troll(object):
           change.url(), review.issues.keys(), review.feedback.keys(),
           review.vote, review.notify))
 
-  def get_changes(self, project, prefix):
+  def get_changes(self, project, prefix, after=None):
+    # Pages of changes, as they arrive from gerrit. With no after, every open
+    # change from the last few days is returned. Otherwise only those updated
+    # since after, closed ones included so they can be forgotten.
     message = '{}:'.format(prefix)
-    after = datetime.date.today() - datetime.timedelta(days=5)
-    changes = self.gerrit.query_changes(status='open', message=message,
+    status = None
+    if not after:
+      status = 'open'
+      after = datetime.date.today() - datetime.timedelta(days=5)
+    pages = self.gerrit.iter_query_pages(status=status, message=message,
                     after=after, project=project.gerrit_project,
                     branches=project.monitor_branches)
-    return changes
+    for changes in pages:
+      if self.config.chatty:
+        logger.debug('{} changes for prefix {}'.format(len(changes), prefix))
+      ret = []
+      for c in changes:
+        if self.poll.update(project.name, c):
+          ret.append(c)
+        else:
+          self.ignore_list.pop(c.number, None)
+      if ret:
+        yield ret
 
   def add_change_to_ignore_list(self, change):
     self.ignore_list[change.number] = change.current_revision.number
@@ -141,40 +182,218 @@ class Troll(object):
     if not reviewer:
       self.add_change_to_ignore_list(c)
       return None
+    reviewer.set_gerrit(self.gerrit)
 
     if not force_review and self.is_change_in_ignore_list(c):
       return None
 
     return reviewer.review_patch()
 
-  def process_changes(self, project, changes):
+  def is_branch_ignored(self, project, change):
+    for b in project.ignore_branches:
+      if re.match(b, change.branch):
+        return True
+    return False
+
+  def fetch_changes(self, project, rev, changes):
+    # Fetch every revision in a page which might be reviewed in one go, so the
+    # reviewers can read them locally instead of fetching one at a time
+    source = project.downstream_patch_source
+    if source == 'rest':
+      return
+
+    force_review = self.config.force_cl or self.config.force_all
+    refs = []
+    for c in changes:
+      if self.is_branch_ignored(project, c):
+        continue
+      # With 'auto', a prefetched ref would always win. Leave the choice to the
+      # reviewer, except for BACKPORTs which always read from git.
+      if source == 'auto' and 'BACKPORT' not in c.subject:
+        continue
+      if force_review or not self.is_change_in_ignore_list(c):
+        refs.append(c.current_revision.ref)
+
+    try:
+      rev.fetch_gerrit_refs(project.gerrit_remote_name, refs)
+    except Exception as e:
+      logger.error('Could not fetch changes for {}'.format(project.name))
+      logger.exception('Exception: {}'.format(e))
+
+  def prune_changes(self, project, rev):
+    # A forced review only sees one change, don't let it prune the others.
+    # Until a full poll has run we don't know every open change either.
+    if project.downstream_patch_source == 'rest' or self.config.force_cl:
+      return
+    if not self.poll.is_complete(project.name):
+      return
+
+    try:
+      rev.prune_gerrit_refs(project.gerrit_remote_name,
+                            self.poll.open_refs(project.name))
+    except Exception as e:
+      logger.error('Could not prune changes for {}'.format(project.name))
+      logger.exception('Exception: {}'.format(e))
+
+  def process_changes(self, project, pages):
     rev = Reviewer(git_dir=project.local_repo, verbose=self.config.verbose,
-                   chatty=self.config.chatty)
+                   chatty=self.config.chatty, patch_cache=self.patch_cache,
+                   fetch_ttl=self.config.fetch_ttl, index_dir=self.index_dir,
+                   compare_time_limit=self.config.compare_time_limit,
+                   compare_size_limit=self.config.compare_size_limit,
+                   compare_workers=self.config.compare_workers,
+                   compare_parallel_lines=self.config.compare_parallel_lines,
+                   diff_memo_size=self.config.diff_memo_size,
+                   git_stats=self.git_stats,
+                   max_git_procs=self.config.max_git_procs)
+    rev.track_branch(project.mainline_repo, project.mainline_branch,
+                     monotonic=True)
+    rev.track_fixes(project.mainline_repo, project.mainline_branch)
+    rev.track_patch_ids(project.mainline_repo, project.mainline_branch,
+                        depth=self.config.patch_id_depth)
+    for t in project.patch_id_trees:
+      rev.track_patch_ids(t.location, t.branch,
+                          depth=self.config.patch_id_depth)
     ret = 0
-    for c in changes:
-      ignore = False
-      for b in project.ignore_branches:
-        if re.match(b, c.branch):
-          ignore = True
-          break
-      if ignore:
-        if self.config.chatty:
-          logger.debug('Ignoring change {}'.format(c))
+    for changes in pages:
+      self.fetch_changes(project, rev, changes)
+      for c in changes:
+        if self.is_branch_ignored(project, c):
+          if self.config.chatty:
+            logger.debug('Ignoring change {}'.format(c))
+          self.add_change_to_ignore_list(c)
+          continue
+
+        try:
+          result = self.process_change(project, rev, c)
+          if result:
+            self.do_review(project, c, result)
+            ret += 1
+        except Exception as e:
+          logger.error('Exception processing change {}'.format(c.url()))
+          logger.exception('Exception: {}'.format(e))
+
         self.add_change_to_ignore_list(c)
+    self.prune_changes(project, rev)
+
+    if self.config.chatty:
+      logger.debug('{} git forks saved for {}'.format(rev.forks_saved(),
+                                                      project.name))
+      logger.debug('{} fetches, {} skipped, {} coalesced for {}'.format(
+                      rev.fetches.fetches, rev.fetches.skipped,
+                      rev.fetches.coalesced, project.name))
+      if rev.diff_memo:
+        logger.debug('{} diff memo hits, {} misses'.format(rev.diff_memo.hits,
+                                                           rev.diff_memo.misses))
+    return ret
+
+  def finish_cycle_stats(self, summarize):
+    if self.config.chatty:
+      transport.stats.summarize(logging.DEBUG)
+    transport.stats.reset()
+
+    if not self.git_stats:
+      return
+    if summarize:
+      self.git_stats.summarize(logging.INFO)
+    if not self.config.dry_run:
+      self.git_stats.save()
+    self.git_stats.reset()
+
+  def finish_cycle(self, did_review):
+    if did_review > 0:
+      self.stats.summarize(logging.INFO)
+      if not self.config.dry_run:
+        self.stats.save()
+    self.finish_cycle_stats(did_review > 0)
+
+  def is_project_ignored(self, project):
+    return (self.config.force_project and
+            project.name != self.config.force_project)
+
+  def run_cycle(self):
+    did_review = 0
+    for project in self.config.projects.values():
+      if self.is_project_ignored(project):
+        continue
+      if self.config.chatty:
+        logger.debug('Running for project {}'.format(project.name))
+      # Review each page as it arrives, all prefixes share one reviewer
+      after = self.poll.start_cycle(project.name)
+      pages = itertools.chain.from_iterable(
+                  [self.get_changes(project, p, after)
+                   for p in project.prefixes])
+      did_review += self.process_changes(project, pages)
+      self.poll.finish_cycle(project.name)
+    self.finish_cycle(did_review)
+
+  def is_event_wanted(self, project, event):
+    # The same filters the poll's query applies, so changes can be skipped
+    # without asking gerrit about them
+    if event.type == events.COMMENT_ADDED:
+      if self.RETRY_REVIEW_KEY not in event.comment:
+        return False
+    if (project.monitor_branches and
+        event.branch not in project.monitor_branches):
+      return False
+    return any('{}:'.format(p) in event.subject for p in project.prefixes)
+
+  def process_events(self, batch):
+    numbers = collections.defaultdict(collections.OrderedDict)
+    projects = {}
+    for e in batch:
+      project = self.config.get_project(e.project)
+      if not project or self.is_project_ignored(project):
+        continue
+      if e.type in events.CLOSED_TYPES:
+        self.poll.forget(project.name, e.number)
+        self.ignore_list.pop(e.number, None)
+        numbers[project.name].pop(e.number, None)
         continue
+      if self.is_event_wanted(project, e):
+        projects[project.name] = project
+        numbers[project.name][e.number] = e
 
+    did_review = 0
+    for name,changes in numbers.items():
+      if not changes:
+        continue
+      project = projects[name]
+      page = []
+      for n in changes:
+        c = self.gerrit.get_change(n)
+        if self.poll.track(project.name, c):
+          page.append(c)
+      if self.config.chatty:
+        logger.debug('{} changes from events for {}'.format(len(page), name))
+      if page:
+        did_review += self.process_changes(project, [page])
+    self.finish_cycle(did_review)
+
+  def run_events(self):
+    # Changes are reviewed as soon as gerrit says they've been touched. The
+    # (incremental) poll still runs every so often to catch anything the event
+    # stream missed.
+    listener = events.EventListener(
+                  events.source_for(self.config.event_source))
+    listener.start()
+    next_poll = 0
+    while True:
       try:
-        result = self.process_change(project, rev, c)
-        if result:
-          self.do_review(project, c, result)
-          ret += 1
-      except Exception as e:
-        logger.error('Exception processing change {}'.format(c.url()))
-        logger.exception('Exception: {}'.format(e))
+        if time.monotonic() >= next_poll:
+          self.run_cycle()
+          next_poll = time.monotonic() + self.config.reconcile_interval
+          if self.config.chatty:
+            logger.debug('Finished poll, waiting for events')
 
-      self.add_change_to_ignore_list(c)
+        batch = listener.wait(max(next_poll - time.monotonic(), 0))
+        if batch:
+          self.process_events(batch)
 
-    return ret
+      except (requests.exceptions.HTTPError, OSError) as e:
+        logger.error('Error getting changes: ({})'.format(str(e)))
+        logger.exception('Exception getting changes: {}'.format(e))
+        time.sleep(60)
 
   def run(self):
     if self.config.force_cl:
@@ -183,28 +402,17 @@ class Troll(object):
       project = self.config.get_project(c.project)
       if not project:
         raise ValueError('Could not find project!')
-      self.process_changes(project, [c])
+      self.process_changes(project, [[c]])
+      self.finish_cycle_stats(True)
+      return
+
+    if self.config.daemon and self.config.event_source:
+      self.run_events()
       return
 
     while True:
       try:
-        did_review = 0
-        for project in self.config.projects.values():
-          if (self.config.force_project and
-              project.name != self.config.force_project):
-            continue
-          if self.config.chatty:
-            logger.debug('Running for project {}'.format(project.name))
-          for p in project.prefixes:
-            changes = self.get_changes(project, p)
-            if self.config.chatty:
-              logger.debug('{} changes for prefix {}'.format(len(changes), p))
-            did_review += self.process_changes(project, changes)
-
-        if did_review > 0:
-          self.stats.summarize(logging.INFO)
-          if not self.config.dry_run:
-            self.stats.save()
+        self.run_cycle()
 
         if not self.config.daemon:
           return
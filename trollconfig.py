@@ -21,6 +21,15 @@ TrollConfigProject = collections.namedtuple('TrollConfigProject',
                                               'monitor_branches',
                                               'ignore_branches',
                                               'ignore_sob',
+                                              'patch_id_trees',
+                                              'downstream_patch_source',
+                                            ])
+
+TrollConfigGitTree = collections.namedtuple('TrollConfigGitTree',
+                                            [
+                                              'name',
+                                              'location',
+                                              'branch',
                                             ])
 
 TrollConfigPatchwork = collections.namedtuple('TrollConfigPatchwork',
@@ -50,6 +59,34 @@ class TrollConfig(object):
     self.stats_file = self.config.get('global', 'StatsFile', fallback=None)
     self.results_file = self.config.get('global', 'ResultsFile', fallback=None)
     self.log_file = self.config.get('global', 'LogFile', fallback=None)
+    self.cache_dir = self.config.get('global', 'CacheDir', fallback=None)
+    self.patch_cache_size = self.config.getint('global', 'PatchCacheSize',
+                                               fallback=512)
+    self.fetch_ttl = self.config.getint('global', 'FetchTtl', fallback=0)
+    self.patch_id_depth = self.config.getint('global', 'PatchIdDepth',
+                                             fallback=10000)
+    self.compare_time_limit = self.config.getint('global', 'CompareTimeLimit',
+                                                 fallback=0)
+    self.compare_size_limit = self.config.getint('global', 'CompareSizeLimit',
+                                                 fallback=0)
+    self.compare_workers = self.config.getint('global', 'CompareWorkers',
+                                              fallback=0)
+    self.compare_parallel_lines = self.config.getint('global',
+                                                     'CompareParallelLines',
+                                                     fallback=20000)
+    self.diff_memo_size = self.config.getint('global', 'DiffMemoSize',
+                                             fallback=64)
+    self.max_git_procs = self.config.getint('global', 'MaxGitProcs',
+                                            fallback=4)
+    self.git_stats_file = self.config.get('global', 'GitStatsFile',
+                                          fallback=None)
+    self.http_concurrency = self.config.getint('global', 'HttpConcurrency',
+                                               fallback=4)
+    self.full_poll_interval = self.config.getint('global', 'FullPollInterval',
+                                                 fallback=3600)
+    self.event_source = self.config.get('global', 'EventSource', fallback=None)
+    self.reconcile_interval = self.config.getint('global', 'ReconcileInterval',
+                                                 fallback=1800)
     self.project_names = self.config.get('global', 'Projects').split(',')
 
   def parse_projects(self):
@@ -88,6 +125,18 @@ class TrollConfig(object):
       ignore_branches.append(self.config.get('ignorebranch_{}'.format(b),
                                             'Regex'))
 
+    patch_id_trees = []
+    for t in self.config.get(sec, 'PatchIdTrees', fallback='').split(','):
+      if not t:
+        continue
+      patch_id_trees.append(self.build_git_tree('patchidtree_{}'.format(t)))
+
+    downstream_patch_source = self.config.get(sec, 'DownstreamPatchSource',
+                                              fallback='git')
+    if downstream_patch_source not in ('git', 'rest', 'auto'):
+      raise ValueError('Invalid DownstreamPatchSource {} for {}'.format(
+                          downstream_patch_source, sec))
+
     return TrollConfigProject(self.config.get(sec, 'Name'),
                               self.config.get(sec, 'GerritProject'),
                               self.config.get(sec, 'MainlineLocation'),
@@ -99,7 +148,13 @@ class TrollConfig(object):
                               prefixes, patchworks, blocked_repos,
                               monitor_branches, ignore_branches,
                               self.config.getboolean(sec, 'IgnoreSignedOffBy',
-                                                     fallback=False))
+                                                     fallback=False),
+                              patch_id_trees, downstream_patch_source)
+
+  def build_git_tree(self, sec):
+    return TrollConfigGitTree(self.config.get(sec, 'Name'),
+                              self.config.get(sec, 'Location'),
+                              self.config.get(sec, 'Branch'))
 
   def build_patchwork(self, sec):
     return TrollConfigPatchwork(self.config.get(sec, 'Name'),
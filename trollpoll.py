@@ -0,0 +1,120 @@
+import collections
+import datetime
+import json
+import logging
+import os
+import pathlib
+import time
+
+logger = logging.getLogger('rom.troll.poll')
+
+class TrollPoll(object):
+  # Tracks how far each project has been polled, so a cycle only has to ask
+  # gerrit for changes updated since the last one. Every full_poll_interval
+  # seconds all open changes are queried again to resync.
+
+  # Looked back past the high-water mark, covers changes updated while the last
+  # poll was running
+  OVERLAP = datetime.timedelta(minutes=10)
+  # Never look further back than a full poll would
+  MAX_AGE = datetime.timedelta(days=5)
+  TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+  def __init__(self, filepath, full_poll_interval):
+    self.filepath = filepath
+    self.full_poll_interval = full_poll_interval
+    self.state = {}
+    # Open changes of each project as of the last poll, number -> revision ref
+    self.open_changes = collections.defaultdict(dict)
+    # Projects whose open_changes have been filled in by a full poll
+    self.complete = set()
+    self.cycles = {}
+    self.load()
+
+  def load(self):
+    if not self.filepath:
+      return
+    try:
+      with open(str(self.filepath), 'rt') as f:
+        self.state = json.load(f)
+      if not isinstance(self.state, dict):
+        raise ValueError('Expected a dict')
+    except FileNotFoundError:
+      logger.info('Poll state {} missing, will create'.format(self.filepath))
+    except ValueError as e:
+      logger.error('Discarding malformed poll state {} ({})'.format(
+                      self.filepath, e))
+      self.state = {}
+
+  def save(self):
+    if not self.filepath:
+      return
+    path = pathlib.Path(self.filepath)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name('{}.{}.tmp'.format(path.name, os.getpid()))
+    with open(str(tmp), 'wt') as f:
+      json.dump(self.state, f, sort_keys=True, indent=2)
+    os.replace(str(tmp), str(path))
+
+  def start_cycle(self, project):
+    # Returns the time to query changes updated after, or None if this cycle
+    # should be a full poll of all open changes
+    state = self.state.get(project, {})
+    hwm = state.get('hwm')
+    full = (not hwm or
+            time.time() - state.get('last_full', 0) >= self.full_poll_interval)
+    self.cycles[project] = {'full': full, 'hwm': hwm, 'seen': set()}
+    if full:
+      logger.debug('Full poll of {}'.format(project))
+      return None
+
+    after = datetime.datetime.strptime(hwm, self.TIME_FORMAT) - self.OVERLAP
+    after = max(after, datetime.datetime.utcnow() - self.MAX_AGE)
+    logger.debug('Polling {} for changes after {}'.format(project, after))
+    return after
+
+  def update(self, project, change):
+    # Returns whether the change is still open (and so worth reviewing)
+    cycle = self.cycles[project]
+    updated = change.last_updated.strftime(self.TIME_FORMAT)
+    if not cycle['hwm'] or updated > cycle['hwm']:
+      cycle['hwm'] = updated
+
+    if not self.track(project, change):
+      return False
+    cycle['seen'].add(change.number)
+    return True
+
+  def track(self, project, change):
+    # Keeps the open change view current outside of a poll, returns whether the
+    # change is open
+    if change.status != 'NEW':
+      self.forget(project, change.number)
+      return False
+    self.open_changes[project][change.number] = change.current_revision.ref
+    return True
+
+  def forget(self, project, number):
+    self.open_changes[project].pop(number, None)
+
+  def finish_cycle(self, project):
+    # Only called once every page was seen, otherwise the next cycle has to
+    # start from the old high-water mark
+    cycle = self.cycles.pop(project)
+    state = self.state.setdefault(project, {})
+    if cycle['hwm']:
+      state['hwm'] = cycle['hwm']
+    if cycle['full']:
+      state['last_full'] = time.time()
+      # Anything a full poll didn't turn up has closed or gone stale
+      changes = self.open_changes[project]
+      for n in [n for n in changes if n not in cycle['seen']]:
+        del changes[n]
+      self.complete.add(project)
+    self.save()
+
+  def is_complete(self, project):
+    return project in self.complete
+
+  def open_refs(self, project):
+    return list(self.open_changes[project].values())
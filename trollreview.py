@@ -17,6 +17,7 @@ class ReviewType(enum.Enum):
   UPSTREAM_COMMENTS = 'upstream_comments'
   NOT_IN_MAINLINE = 'not_in_mainline'
   FORBIDDEN_TREE = 'forbidden_tree'
+  DEGRADED_COMPARE = 'degraded_compare'
 
   def __str__(self):
     return self.value
@@ -35,6 +36,10 @@ class ReviewResult(object):
     self.feedback = {}
     self.web_link = None
     self.inline_comments = {}
+    # Fingerprint of the reviewed diff, identical uploads share one
+    self.fingerprint = None
+    # Why the comparison was cut short, if it was ('size' and/or 'time')
+    self.degraded = set()
 
   def add_review(self, review_type, msg, vote=0, notify=False, dry_run=False):
     # Take the lowest negative, or the highest positive
@@ -61,6 +66,12 @@ class ReviewResult(object):
   def add_web_link(self, link):
     self.web_link = link
 
+  def set_fingerprint(self, fingerprint):
+    self.fingerprint = fingerprint
+
+  def set_degraded(self, reasons):
+    self.degraded.update(reasons)
+
   def generate_issues(self, retry_key):
     num_issues = len(self.issues)
     if not num_issues:
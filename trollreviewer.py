@@ -1,13 +1,20 @@
+import diffengine
+from patchmodel import from_format_patch
+from patchsource import DownstreamPatchSource, PatchSource
+from trailers import parse_trailers
 from trollreview import ReviewType
 
 import logging
 import random
-import re
+import time
 
 logger = logging.getLogger('rom')
 logger.setLevel(logging.DEBUG) # leave this to handlers
 
 class ChangeReviewer(object):
+  # Context used to double check a BACKPORT which appears to be clean
+  BACKPORT_CONTEXT = 3
+
   def __init__(self, project, reviewer, change, msg_limit, dry_run):
     self.project = project
     self.reviewer = reviewer
@@ -15,11 +22,18 @@ class ChangeReviewer(object):
     self.change = change
     self.msg_limit = msg_limit
     self.dry_run = dry_run
+    self.gerrit = None
     self.gerrit_patch = None
+    self.gerrit_patch_source = None
     self.upstream_patch = None
     self.review_result = None
     self.strings = None
     self.diff = None
+    self.diff_key = None
+    self.gerrit_fingerprint = None
+    self.upstream_fingerprint = None
+    self.deadline = None
+    self.degraded = False
 
   @staticmethod
   def can_review_change(project, change, days_since_last_review):
@@ -35,16 +49,31 @@ class ChangeReviewer(object):
   def format_diff(self):
     # Leave room for boilerplate and other review feedback, 2k chars for now
     max_size = self.msg_limit - 2048
-    msg = ''
+    msg = []
+    size = 0
     for l in self.diff:
-      msg += '  {}\n'.format(l)
+      line = '  {}\n'.format(l)
+      if size + len(line) > max_size:
+        break
+      msg.append(line)
+      size += len(line)
+    else:
+      return ''.join(msg)
 
-    if len(msg) > max_size:
-      trunc_msg = '\n\n  !!!! Diff truncated !!!!'
-      msg = msg[:(max_size - len(trunc_msg))]
-      msg += trunc_msg
+    # Stop reading the diff here, only count what's left so the rest of it
+    # never has to be computed
+    trunc_msg = '\n\n  !!!! Diff truncated, {} more lines omitted !!!!'
+    files_msg = '\n  !!!! ({} more files not compared) !!!!'
+    while True:
+      lines,files = self.diff.omitted(len(msg))
+      trunc = trunc_msg.format(lines)
+      if files:
+        trunc += files_msg.format(files)
+      if not msg or size + len(trunc) <= max_size:
+        break
+      size -= len(msg.pop())
 
-    return msg
+    return ''.join(msg) + trunc
 
   def add_successful_review(self):
     msg = self.strings.SUCCESS.format(random.choice(self.strings.SWAG))
@@ -56,6 +85,21 @@ class ChangeReviewer(object):
     self.review_result.add_review(ReviewType.INCORRECT_PREFIX, msg, vote=-1,
                                   notify=True)
 
+  def add_degraded_compare_review(self, reasons):
+    self.review_result.add_review(ReviewType.DEGRADED_COMPARE,
+                                  self.strings.DEGRADED_COMPARE)
+    self.review_result.set_degraded(reasons)
+
+  def degraded_reasons(self):
+    # Anything which ran out of time is on the clock, a diff summarized from
+    # the start was over the size limit
+    ret = set()
+    if self.degraded or self.diff.timed_out:
+      ret.add('time')
+    if self.diff.degraded and not self.diff.timed_out:
+      ret.add('size')
+    return ret
+
   def add_missing_fields_review(self, fields):
     missing = []
     if not fields['bug']:
@@ -71,18 +115,64 @@ class ChangeReviewer(object):
     self.review_result.add_review(ReviewType.MISSING_FIELDS, msg, vote=-1,
                                   notify=True)
 
-  def get_gerrit_patch(self):
+  def set_gerrit(self, gerrit):
+    # Only needed to read the patch over REST
+    self.gerrit = gerrit
+
+  def choose_gerrit_patch_source(self):
+    mode = self.project.downstream_patch_source
+    if not self.gerrit or mode == PatchSource.GIT.value:
+      return PatchSource.GIT
+    # /patch only has 3 lines of context, too few for the BACKPORT double check
+    if self.is_backport:
+      return PatchSource.GIT
+
+    source = DownstreamPatchSource.for_project(self.project.name, mode)
+    is_local = self.reviewer.has_gerrit_ref(self.project.gerrit_remote_name,
+                                            self.change.current_revision.ref)
+    return source.choose(is_local)
+
+  def get_gerrit_rest_patch(self):
+    source = DownstreamPatchSource.for_project(
+                  self.project.name, self.project.downstream_patch_source)
+    try:
+      start = time.monotonic()
+      self.gerrit_patch = from_format_patch(
+                              self.gerrit.get_formatted_patch(self.change))
+      source.record(PatchSource.REST, time.monotonic() - start)
+      self.gerrit_patch_source = PatchSource.REST
+      return True
+    except Exception as e:
+      logger.error('Could not get gerrit patch over REST {} ({})'.format(
+                      self.change, e))
+      return False
+
+  def get_gerrit_git_patch(self):
+    remote = self.project.gerrit_remote_name
+    ref = self.change.current_revision.ref
+    is_local = self.reviewer.has_gerrit_ref(remote, ref)
+    start = time.monotonic()
     for i in range(0, 4):
       try:
-        self.gerrit_patch = self.reviewer.get_commit_from_remote(
-                                  self.project.gerrit_remote_name,
-                                  self.change.current_revision.ref)
+        self.gerrit_patch = self.reviewer.get_commit_from_remote(remote, ref)
+        self.gerrit_patch_source = PatchSource.GIT
+        # Only a real fetch says anything about how fast git is
+        if not is_local:
+          source = DownstreamPatchSource.for_project(
+                        self.project.name, self.project.downstream_patch_source)
+          source.record(PatchSource.GIT, time.monotonic() - start)
         return True
       except:
         continue
     raise ValueError('ERROR: Could not get gerrit patch {}\n'.format(
                                                       self.change))
 
+  def get_gerrit_patch(self):
+    if (self.choose_gerrit_patch_source() == PatchSource.REST and
+        self.get_gerrit_rest_patch()):
+      return True
+    return self.get_gerrit_git_patch()
+
   def get_upstream_patch(self):
     raise NotImplementedError()
 
@@ -95,31 +185,78 @@ class ChangeReviewer(object):
 
   def validate_commit_message(self):
     cur_rev = self.change.current_revision
+    trailers = parse_trailers(cur_rev.commit_message)
     fields={'sob':False, 'bug':False, 'test':False}
-    sob_name_re = re.compile('Signed-off-by:\s+{}'.format(
-                                cur_rev.uploader_name))
-    sob_email_re = re.compile('Signed-off-by:.*?<{}>'.format(
-                                cur_rev.uploader_email))
-
-    if self.project.ignore_sob:
-      fields['sob'] = True
-
-    for l in cur_rev.commit_message.splitlines():
-      if l.startswith('BUG='):
-        fields['bug'] = True
-      elif l.startswith('TEST='):
-        fields['test'] = True
-      elif sob_name_re.match(l):
-        fields['sob'] = True
-      elif sob_email_re.match(l):
-        fields['sob'] = True
+    fields['bug'] = bool(trailers.bugs)
+    fields['test'] = bool(trailers.tests)
+    fields['sob'] = (self.project.ignore_sob or
+                     trailers.has_sob(name=cur_rev.uploader_name,
+                                      email=cur_rev.uploader_email))
 
     if not fields['bug'] or not fields['test'] or not fields['sob']:
       self.add_missing_fields_review(fields)
 
+  def get_upstream_sha(self):
+    return None
+
+  def fingerprint_patches(self):
+    self.gerrit_fingerprint = self.reviewer.get_fingerprint(self.gerrit_patch)
+    self.upstream_fingerprint = self.reviewer.get_fingerprint(
+                                    self.upstream_patch,
+                                    sha=self.get_upstream_sha())
+    if self.review_result:
+      self.review_result.set_fingerprint(self.gerrit_fingerprint)
+
+  def memoize_diff(self):
+    # Only once the diff has been read, the memo won't take it otherwise
+    if self.diff_key:
+      self.reviewer.diff_memo.put(self.diff_key, self.diff)
+      self.diff_key = None
+
   def diff_patches(self, context=0):
-    self.diff = self.reviewer.compare_diffs(self.upstream_patch,
-                                            self.gerrit_patch, context=context)
+    self.memoize_diff()
+    # Matching fingerprints mean the diff would come back empty, skip the work
+    if (self.gerrit_fingerprint and
+        self.gerrit_fingerprint == self.upstream_fingerprint):
+      logger.debug('Patches match ({}), skipping diff'.format(
+                      self.gerrit_fingerprint[:12]))
+      self.diff = diffengine.DiffStream([], [])
+      return
+
+    memo = self.reviewer.diff_memo
+    key = None
+    if memo and self.gerrit_fingerprint and self.upstream_fingerprint:
+      key = (self.upstream_fingerprint, self.gerrit_fingerprint, context)
+      self.diff = memo.get(key)
+      if self.diff != None:
+        logger.debug('Reusing diff of {}/{} at context={}'.format(
+                        self.upstream_fingerprint[:12],
+                        self.gerrit_fingerprint[:12], context))
+        return
+
+    self.diff = self.reviewer.iter_diffs(self.upstream_patch,
+                                         self.gerrit_patch, context=context,
+                                         a_sha=self.get_upstream_sha(),
+                                         deadline=self.deadline)
+    self.diff_key = key
+
+  def diff_backport_patches(self):
+    # If a BACKPORT appears to be clean, increase the context to be sure before
+    # suggesting switching to UPSTREAM prefix. Both come from the same ranked
+    # strip, and files which are equal without context are skipped without
+    # diffing them, so only one of the two passes does any real diffing.
+    self.diff_patches()
+    if self.diff:
+      return
+    self.diff_patches(context=self.BACKPORT_CONTEXT)
+
+  def start_compare_budget(self):
+    limit = self.reviewer.compare_time_limit
+    if limit:
+      self.deadline = time.monotonic() + limit
+
+  def is_over_compare_budget(self):
+    return self.deadline != None and time.monotonic() > self.deadline
 
   def compare_patches_clean(self):
     raise NotImplementedError()
@@ -129,11 +266,6 @@ class ChangeReviewer(object):
 
   def compare_patches(self):
     if self.is_backport:
-      # If a BACKPORT appears to be clean, increase the context to be sure
-      # before suggesting switching to UPSTREAM prefix
-      if len(self.diff) == 0:
-        self.diff_patches(context=3)
-
       self.compare_patches_backport()
     else:
       self.compare_patches_clean()
@@ -144,8 +276,17 @@ class ChangeReviewer(object):
     self.get_patches()
     self.validate_commit_message()
     if self.gerrit_patch and self.upstream_patch:
-      self.diff_patches()
+      self.start_compare_budget()
+      self.fingerprint_patches()
+      if self.is_backport:
+        self.diff_backport_patches()
+      else:
+        self.diff_patches()
       self.compare_patches()
+      self.memoize_diff()
+      reasons = self.degraded_reasons()
+      if reasons:
+        self.add_degraded_compare_review(reasons)
 
     if self.upstream_patch:
       self.get_upstream_web_link()
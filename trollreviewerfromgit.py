@@ -13,6 +13,13 @@ class FromgitReviewStrings(ReviewStrings):
   INVALID_HASH_FOOTER='''
 Please double check your commit hash is valid in the upstream tree, and please
 fully specify the remote tree and branch for FROMGIT changes (see below):
+'''
+  HASH_SUGGESTION='''
+The contents of this patch match the following upstream commit, perhaps you
+meant to use:
+
+    (cherry picked from commit {}
+     {} {})
 '''
   CLEAN_BACKPORT_FOOTER='''
 Consider changing your subject prefix to FROMGIT to better reflect the
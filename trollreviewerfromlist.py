@@ -1,5 +1,4 @@
 from patchwork import PatchworkPatch
-from reviewer import LineType
 from trollreview import ReviewResult
 from trollreview import ReviewType
 from trollreviewer import ChangeReviewer
@@ -110,7 +109,7 @@ class FromlistChangeReviewer(ChangeReviewer):
       pass
 
   def compare_patches_clean(self):
-    if len(self.diff) == 0:
+    if not self.diff:
       self.add_successful_review()
     elif self.review_backports:
       self.add_altered_fromlist_review()
@@ -118,43 +117,33 @@ class FromlistChangeReviewer(ChangeReviewer):
       self.add_clear_votes_review()
 
   def compare_patches_backport(self):
-    if len(self.diff) == 0:
+    if not self.diff:
       self.add_clean_backport_review()
     elif self.review_backports:
       self.add_fromlist_backport_review()
     else:
       self.add_clear_votes_review()
 
-  def find_line_for_inline_msg(self, diff, msg):
-    cur_file = '/COMMIT_MSG'
-    cur_line = 6 # The COMMIT_MSG "file" has a 6 line header
+  # How many patch lines to scan between checks of the compare budget
+  BUDGET_CHECK_LINES = 4096
+
+  def find_line_for_inline_msg(self, patch, msg):
     ctx_counter = 0
 
-    for l in diff:
-      t,m = self.reviewer.classify_line(l)
-      # If a file is being deleted, the file below will be /dev/null. Gerrit
-      # (rightfully) doesn't know what to do with a comment on the file
-      # /dev/null, so it will throw a 400-BAD_REQUEST if we try.
-      #
-      # TODO: We should store FILE_OLD as cur_file and then update cur_file to
-      #       FILE_NEW if it is not /dev/null. I _think_ it's that easy, but
-      #       don't have time to actually test the edge cases. So for now we'll
-      #       store /dev/null and then discard the comment because
-      #       msg.has_filename() will fail. All this work for nothing :(
-      if t == LineType.FILE_NEW:
-        cur_file = m.group(1)
-        cur_line = 0
-      elif t == LineType.CHUNK:
-        cur_line = int(m.group(3)) - 1 # Take away one since we add it back
-
-      # Increment the line count if we're counting up from a chunk or parsing
-      # the commit message
-      elif (t == LineType.CONTEXT or
-            (t == LineType.DIFF and l[0] == '+') or
-            cur_file == '/COMMIT_MSG'):
-        cur_line += 1
-
-      ratio = fuzz.token_set_ratio(l, msg.context[ctx_counter])
+    # If a file is being deleted, the file below will be /dev/null. Gerrit
+    # (rightfully) doesn't know what to do with a comment on the file
+    # /dev/null, so it will throw a 400-BAD_REQUEST if we try.
+    #
+    # TODO: We should store FILE_OLD as cur_file and then update cur_file to
+    #       FILE_NEW if it is not /dev/null. I _think_ it's that easy, but
+    #       don't have time to actually test the edge cases. So for now we'll
+    #       store /dev/null and then discard the comment because
+    #       msg.has_filename() will fail. All this work for nothing :(
+    for i,(l,cur_file,cur_line) in enumerate(patch.positions()):
+      if (i % self.BUDGET_CHECK_LINES == 0 and i and
+          self.is_over_compare_budget()):
+        return False
+
       gerrit_line = l.strip('+- \t')
       context_line = msg.context[ctx_counter].strip('+- \t')
 
@@ -169,10 +158,11 @@ class FromlistChangeReviewer(ChangeReviewer):
           msg.set_line(cur_line)
         ctx_counter += 1
 
-      #logging.debug('R: f={} l={} cc={} ratio={}'.format(msg.filename, msg.line, ctx_counter, ratio))
+      #logging.debug('R: f={} l={} cc={}'.format(msg.filename, msg.line, ctx_counter))
 
       if ctx_counter and ctx_counter == len(msg.context):
         break
+    return True
 
   def find_parent_comment(self, msg):
     msg_test = ' '.join(msg.context).lower()
@@ -196,15 +186,23 @@ class FromlistChangeReviewer(ChangeReviewer):
     if not self.patchwork_comments:
       return
 
-    split_patch = self.gerrit_patch.split('\n')
+    # Comments which can't be placed before the compare budget runs out are
+    # dropped, the review is marked as degraded instead
+    parsed_patch = self.reviewer.parse_patch(self.gerrit_patch)
     for c in self.patchwork_comments:
       for m in c.inline_comments:
-        self.find_line_for_inline_msg(split_patch, m)
+        if self.degraded:
+          break
+        if not self.find_line_for_inline_msg(parsed_patch, m):
+          self.degraded = True
 
     for c in self.patchwork_comments:
       for m in c.inline_comments:
         if m.has_filename() and m.has_line():
           continue
+        if self.is_over_compare_budget():
+          self.degraded = True
+          break
         self.find_parent_comment(m)
 
     for c in self.patchwork_comments:
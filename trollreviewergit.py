@@ -1,10 +1,11 @@
+from patchsource import PatchSource
 from reviewer import CommitRef
 from trollreview import ReviewType
 from trollreviewer import ChangeReviewer
+import transport
 
 import logging
 import re
-import requests
 import sys
 import urllib
 
@@ -19,6 +20,11 @@ class GitChangeReviewer(ChangeReviewer):
   def can_review_change(project, change, days_since_last_review):
     raise NotImplementedError()
 
+  def get_upstream_sha(self):
+    if not self.upstream_ref:
+      return None
+    return self.upstream_ref.sha
+
   def get_cgit_web_link_path(self):
     ret = '/commit/?id={}'.format(self.upstream_ref.sha)
     if self.upstream_ref.branch:
@@ -69,7 +75,7 @@ class GitChangeReviewer(ChangeReviewer):
       logger.warning('Could not parse web link for {}'.format(remote))
       return
 
-    r = requests.get(l)
+    r = transport.get(l)
     if r.status_code == 200:
       self.review_result.add_web_link(l)
     else:
@@ -84,12 +90,16 @@ class GitChangeReviewer(ChangeReviewer):
       self.review_result.add_review(ReviewType.MISSING_HASH, msg, vote=-1,
                                     notify=True)
 
-  def add_invalid_hash_review(self, refs):
+  def add_invalid_hash_review(self, refs, suggested_ref=None):
     msg = self.strings.INVALID_HASH_HEADER
     for r in refs:
       msg += self.strings.INVALID_HASH_LINE.format(str(r))
     msg += self.strings.INVALID_HASH_FOOTER
     msg += self.strings.HASH_EXAMPLE
+    if suggested_ref:
+      msg += self.strings.HASH_SUGGESTION.format(suggested_ref.sha,
+                                                 suggested_ref.remote,
+                                                 suggested_ref.branch)
     self.review_result.add_review(ReviewType.INVALID_HASH, msg, vote=-1,
                                   notify=True)
 
@@ -119,13 +129,15 @@ class GitChangeReviewer(ChangeReviewer):
       self.add_missing_hash_review()
       return
 
-    for r in reversed(upstream_refs):
+    for r in upstream_refs:
       if not r.remote:
         r.set_remote(self.project.mainline_repo)
       if not r.branch and not r.tag:
         r.branch = self.project.mainline_branch
 
-      self.reviewer.fetch_remote(r)
+    self.reviewer.fetch_remotes(upstream_refs)
+
+    for r in reversed(upstream_refs):
       if not self.reviewer.is_sha_in_branch(r):
         continue
 
@@ -133,9 +145,20 @@ class GitChangeReviewer(ChangeReviewer):
       self.upstream_ref = r
 
     if not self.upstream_patch:
-      self.add_invalid_hash_review(upstream_refs)
+      self.add_invalid_hash_review(upstream_refs,
+                                   self.find_upstream_ref_by_patch())
       return
 
+  def find_upstream_ref_by_patch(self):
+    try:
+      # patch-ids depend on context, so they have to come from git
+      if self.gerrit_patch_source != PatchSource.GIT:
+        self.get_gerrit_git_patch()
+      return self.reviewer.find_upstream_by_patch(self.gerrit_patch)
+    except Exception as e:
+      logger.exception('Exception finding upstream by patch-id: {}'.format(e))
+      return None
+
   def is_sha_in_mainline(self):
     if not self.upstream_ref:
       return False
@@ -158,13 +181,13 @@ class GitChangeReviewer(ChangeReviewer):
         self.add_fixes_ref_review(fixes_ref)
 
   def compare_patches_backport(self):
-    if len(self.diff) == 0:
+    if not self.diff:
       self.add_clean_backport_review()
     else:
       self.add_backport_diff_review()
 
   def compare_patches_clean(self):
-    if len(self.diff):
+    if self.diff:
       self.add_altered_upstream_review()
     else:
       self.add_successful_review()
@@ -10,6 +10,12 @@ class UpstreamReviewStrings(ReviewStrings):
   INVALID_HASH_FOOTER='''
 Please double check your commit hash is valid in the upstream tree and the hash
 is formatted properly in your commit message (see below):
+'''
+  HASH_SUGGESTION='''
+The contents of this patch match the following upstream commit, perhaps you
+meant to use:
+
+    (cherry picked from commit {})
 '''
   CLEAN_BACKPORT_FOOTER='''
 Consider changing your subject prefix to UPSTREAM to better reflect the
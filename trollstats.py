@@ -32,6 +32,12 @@ class TrollStats(object):
       self.increment(project, i)
     for f in review.feedback:
       self.increment(project, f)
+    self.update_for_degraded(project, review.degraded)
+
+  def update_for_degraded(self, project, reasons):
+    # Comparisons which were cut short, by what cut them short
+    for r in sorted(reasons):
+      self.increment(project, 'degraded_compare_{}'.format(r))
 
   def increment(self, project, review_type):
     pkey = project.name
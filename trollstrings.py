@@ -56,6 +56,11 @@ upstream. The following hash/remote/branch tuple(s) were tried:
 Your commit message is missing the patchwork URL. It should be in the
 form:
     (am from https://patchwork.project.org/.../)
+'''
+  DEGRADED_COMPARE='''
+This patch was too large to compare line by line in the time available, so
+some files were only checked for whether they differ. Any diff above may be
+incomplete, please take a closer look yourself.
 '''
   DIFFERS_HEADER='''
 This patch differs from the source commit.